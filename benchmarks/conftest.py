@@ -0,0 +1,4 @@
+import fake_kerberos
+
+# Must happen before the manager imports kerberos
+fake_kerberos.install()
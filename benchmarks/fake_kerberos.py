@@ -0,0 +1,84 @@
+'''
+Deterministic, in-process stand-in for the pykerberos acceptor API
+
+Tokens starting with VALID_PREFIX complete the handshake, anything else
+raises GSSError. No libkrb5 work happens, so benchmarks using it measure
+the overhead of the login manager itself.
+'''
+from __future__ import absolute_import, print_function, unicode_literals
+
+import sys
+import types
+
+
+AUTH_GSS_CONTINUE = 0
+AUTH_GSS_COMPLETE = 1
+
+VALID_PREFIX = 'VkFMSUQ'
+VALID_TOKEN = VALID_PREFIX + 'gVE9LRU4='
+INVALID_TOKEN = 'SU5WQUxJRCBUT0tFTg=='
+PRINCIPAL = 'user@EXAMPLE.ORG'
+RESPONSE_TOKEN = 'U0VSVkVSIFRPS0VO'
+
+
+class KrbError(Exception):
+    pass
+
+
+class GSSError(KrbError):
+    pass
+
+
+class _State(object):
+    __slots__ = ('complete',)
+
+    def __init__(self):
+        self.complete = False
+
+
+def getServerPrincipalDetails(service, hostname):
+    return '{}/{}@EXAMPLE.ORG'.format(service, hostname)
+
+
+def authGSSServerInit(service):
+    return AUTH_GSS_COMPLETE, _State()
+
+
+def authGSSServerStep(state, token):
+    if not token.startswith(VALID_PREFIX):
+        raise GSSError(('Invalid token', -1))
+    state.complete = True
+    return AUTH_GSS_COMPLETE
+
+
+def authGSSServerUserName(state):
+    return PRINCIPAL
+
+
+def authGSSServerResponse(state):
+    return RESPONSE_TOKEN
+
+
+def authGSSServerClean(state):
+    return AUTH_GSS_COMPLETE
+
+
+_API = (
+    'AUTH_GSS_CONTINUE', 'AUTH_GSS_COMPLETE', 'KrbError', 'GSSError',
+    'getServerPrincipalDetails', 'authGSSServerInit', 'authGSSServerStep',
+    'authGSSServerUserName', 'authGSSServerResponse', 'authGSSServerClean',
+)
+
+
+def install():
+    '''
+    Makes `import kerberos` resolve to this fake. When pykerberos was
+    already imported, its acceptor functions are replaced in place.
+    '''
+    this = sys.modules[__name__]
+    module = sys.modules.get('kerberos')
+    if module is None:
+        module = sys.modules['kerberos'] = types.ModuleType(str('kerberos'))
+    for name in _API:
+        setattr(module, name, getattr(this, name))
+    return module
@@ -0,0 +1,167 @@
+'''
+End-to-end Negotiate benchmark against a throwaway local MIT KDC
+
+Starts a temporary realm with k5test, creates an HTTP service keytab and a
+client ticket, serves examples/simple.py in a separate process and measures
+real handshakes per second and latency percentiles at several client
+concurrencies. Everything stays on the local machine.
+
+Requires the MIT krb5 server tools (krb5kdc, kdb5_util, kadmin.local),
+pykerberos and k5test::
+
+    pip install k5test
+    python benchmarks/kdc_bench.py --clients 1 4 16 --duration 10
+
+``--rcache`` compares the libkrb5 file replay cache (``file``, the default)
+with no replay detection at all (``none``) and the in-memory detectors of
+`flask_kerberos_login.replay` (``sets``, ``bloom``).
+'''
+from __future__ import absolute_import, print_function
+
+import argparse
+import multiprocessing
+import os
+import socket
+import sys
+import time
+
+try:
+    from http.client import HTTPConnection
+except ImportError:
+    from httplib import HTTPConnection
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EXAMPLE = os.path.join(HERE, os.pardir, 'examples', 'simple.py')
+
+
+def load_example(hostname, config):
+    '''
+    Imports examples/simple.py and points it at the test realm
+    '''
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        module = imp.load_source('simple', EXAMPLE)
+    else:
+        spec = importlib.util.spec_from_file_location('simple', EXAMPLE)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    module.app.config['DEBUG'] = False
+    module.app.config['KRB5_HOSTNAME'] = hostname
+    module.app.config.update(config)
+    module.kerberos_manager.init_config(module.app.config)
+    return module.app
+
+
+def serve(port, hostname, config, ready):
+    from werkzeug.serving import make_server
+    import logging
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', port, load_example(hostname, config), threaded=True)
+    ready.set()
+    server.serve_forever()
+
+
+def client(port, hostname, duration, results):
+    import kerberos
+    service = 'HTTP@{}'.format(hostname)
+    connection = HTTPConnection('127.0.0.1', port)
+    latencies = []
+    failures = 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        start = time.time()
+        _, context = kerberos.authGSSClientInit(service)
+        kerberos.authGSSClientStep(context, '')
+        token = kerberos.authGSSClientResponse(context)
+        kerberos.authGSSClientClean(context)
+        connection.request('GET', '/', headers={'Authorization': 'Negotiate ' + token})
+        response = connection.getresponse()
+        response.read()
+        if response.status == 200:
+            latencies.append(time.time() - start)
+        else:
+            failures += 1
+    results.put((latencies, failures))
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run(port, hostname, clients, duration):
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=client, args=(port, hostname, duration, results))
+               for _ in range(clients)]
+    for worker in workers:
+        worker.start()
+    latencies, failures = [], 0
+    for _ in workers:
+        worker_latencies, worker_failures = results.get()
+        latencies.extend(worker_latencies)
+        failures += worker_failures
+    for worker in workers:
+        worker.join()
+    return latencies, failures
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--backend', choices=['pykerberos', 'gssapi'], default='pykerberos')
+    parser.add_argument('--rcache', choices=['file', 'none', 'sets', 'bloom'], default='file')
+    args = parser.parse_args(argv)
+
+    from k5test import K5Realm
+    realm = K5Realm()
+    try:
+        service = 'HTTP/{}'.format(realm.hostname)
+        realm.addprinc(service)
+        realm.extract_keytab(service, realm.keytab)
+        # libkrb5 in this process and its children must use the test realm
+        os.environ.update(realm.env)
+
+        config = {'KRB5_GSSAPI_BACKEND': args.backend}
+        if args.rcache != 'file':
+            config['KRB5_DISABLE_RCACHE'] = True
+        if args.rcache in ('sets', 'bloom'):
+            config['KRB5_REPLAY_DETECTOR'] = args.rcache
+        port = free_port()
+        ready = multiprocessing.Event()
+        server = multiprocessing.Process(target=serve, args=(port, realm.hostname, config, ready))
+        server.daemon = True
+        server.start()
+        ready.wait(30)
+
+        print('{:>8} {:>10} {:>9} {:>9} {:>9} {:>9}'.format(
+            'clients', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'failures'))
+        for clients in args.clients:
+            latencies, failures = run(port, realm.hostname, clients, args.duration)
+            print('{:>8} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9}'.format(
+                clients,
+                len(latencies) / args.duration,
+                percentile(latencies, 0.50) * 1000,
+                percentile(latencies, 0.90) * 1000,
+                percentile(latencies, 0.99) * 1000,
+                failures,
+            ))
+        server.terminate()
+    finally:
+        realm.stop()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+'''
+Micro-benchmarks of the login manager hooks through the Flask test client
+
+Run with::
+
+    pip install pytest-benchmark
+    python -m pytest benchmarks/test_bench_manager.py
+
+The kerberos module is replaced by `fake_kerberos`, so the numbers measure
+the per-request overhead of `extract_token` and `append_header`, not libkrb5.
+'''
+import itertools
+
+import flask
+import flask_login
+import pytest
+
+from flask_kerberos_login import KerberosLoginManager
+from flask_kerberos_login.cookie import AuthCookie
+from flask_kerberos_login.manager import _gssapi_authenticate
+from flask_kerberos_login.replay import BloomReplayDetector
+from flask_kerberos_login.replay import ReplayDetector
+from flask_kerberos_login.replay import authenticator_digest
+import fake_kerberos
+
+
+class User(flask_login.UserMixin):
+    def __init__(self, principal):
+        self.id = principal
+
+
+def make_app(kerberos=True, **config):
+    app = flask.Flask(__name__)
+    app.config['TESTING'] = True
+    app.config['KRB5_SERVICE_NAME'] = 'HTTP'
+    app.config['KRB5_HOSTNAME'] = 'example.org'
+    app.config.update(config)
+
+    login_manager = flask_login.LoginManager(app)
+    if kerberos:
+        manager = KerberosLoginManager(app)
+
+        @manager.save_user
+        def save_user(principal):
+            login_manager.reload_user(User(principal))
+
+    @app.route('/')
+    @flask_login.login_required
+    def index():
+        return flask_login.current_user.id
+
+    @app.route('/public')
+    def public():
+        return 'ok'
+
+    return app
+
+
+def negotiate(token):
+    return {'Authorization': 'Negotiate {}'.format(token)}
+
+
+@pytest.fixture
+def client():
+    return make_app().test_client()
+
+
+def run(benchmark, client, path, status, headers=None):
+    response = benchmark(client.get, path, headers=headers)
+    assert response.status_code == status
+    return response
+
+
+def test_baseline_without_manager(benchmark):
+    '''
+    The same public request through an app without the extension, to
+    subtract Flask's own cost from the other cases.
+    '''
+    run(benchmark, make_app(kerberos=False).test_client(), '/public', 200)
+
+
+def test_no_header(benchmark, client):
+    run(benchmark, client, '/public', 200)
+
+
+def test_challenge(benchmark, client):
+    response = run(benchmark, client, '/', 401)
+    assert response.headers['WWW-Authenticate'] == 'Negotiate'
+
+
+def test_valid_token(benchmark, client):
+    response = run(benchmark, client, '/', 200, negotiate(fake_kerberos.VALID_TOKEN))
+    assert response.headers['WWW-Authenticate'] == 'Negotiate {}'.format(
+        fake_kerberos.RESPONSE_TOKEN)
+
+
+def test_invalid_token(benchmark, client):
+    run(benchmark, client, '/', 403, negotiate(fake_kerberos.INVALID_TOKEN))
+
+
+def test_auth_cookie(benchmark):
+    '''
+    A request authenticated by the signed cookie of an earlier handshake,
+    to compare with `test_valid_token`.
+    '''
+    client = make_app(KRB5_AUTH_COOKIE=True, KRB5_AUTH_COOKIE_KEYS=['secret']).test_client()
+    client.get('/', headers=negotiate(fake_kerberos.VALID_TOKEN))
+    run(benchmark, client, '/', 200)
+
+
+def test_auth_cookie_verify(benchmark):
+    '''
+    The HMAC verification alone, to compare with `test_gssapi_authenticate`.
+    '''
+    cookie = AuthCookie(['secret'])
+    value = cookie.issue('user@EXAMPLE.ORG')
+    assert benchmark(cookie.verify, value) == 'user@EXAMPLE.ORG'
+
+
+def test_gssapi_authenticate(benchmark):
+    '''
+    The handshake alone, against the fake kerberos module; with libkrb5 it
+    also decrypts the ticket and writes the replay cache.
+    '''
+    user, _ = benchmark(_gssapi_authenticate, fake_kerberos.VALID_TOKEN, 'HTTP@example.org')
+    assert user is not None
+
+
+@pytest.mark.parametrize('detector', [
+    ReplayDetector,
+    BloomReplayDetector,
+])
+def test_replay_check(benchmark, detector):
+    '''
+    The per-handshake cost of in-memory replay detection, which replaces a
+    synchronized write to the libkrb5 file replay cache (see kdc_bench.py
+    --rcache for the end-to-end comparison).
+    '''
+    replay = detector()
+    tokens = itertools.count()
+
+    def check():
+        return replay.check(authenticator_digest('{:012d}'.format(next(tokens))))
+
+    assert benchmark(check) is False
@@ -44,6 +44,7 @@ def save_user(email):
     user = users[email] = User(email)
     # generate a cookie/session for this user the first time we see them.
     login_user(user)
+    return user
 
 @app.route('/')
 @login_required
@@ -1,9 +1,9 @@
 from __future__ import absolute_import
-from flask_kerberos_login.manager import KerberosLoginManager
+from flask_kerberos_login.manager import KerberosLoginManager, kerberos_required
 
 from ._version import get_versions
 __version__ = get_versions()['version']
 del get_versions
 
 
-__all__ = ['__version__', 'KerberosLoginManager']
+__all__ = ['__version__', 'KerberosLoginManager', 'kerberos_required']
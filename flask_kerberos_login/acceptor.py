@@ -0,0 +1,337 @@
+'''
+Persistent GSSAPI acceptor credentials, backed by python-gssapi
+
+pykerberos acquires acceptor credentials from the keytab inside every
+`authGSSServerInit` call. python-gssapi exposes credential handles, so the
+service name is imported and the credentials acquired once, then reused
+until they expire or the keytab changes.
+
+With a `KeytabWatcher`, reloads happen on a background thread instead and
+each generation of credentials reads a private snapshot of the keytab, so
+tickets for the previous key version keep being accepted while clients
+pick up the new one.
+'''
+from __future__ import absolute_import, print_function, unicode_literals
+
+import base64
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+try:
+    import gssapi
+except ImportError:
+    gssapi = None
+
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+def keytab_path(keytab=None):
+    '''
+    Returns the filesystem path of the acceptor keytab, taken from `keytab`
+    or the KRB5_KTNAME environment variable, or None if neither names a file.
+    '''
+    keytab = keytab or os.environ.get('KRB5_KTNAME')
+    if not keytab:
+        return None
+    for prefix in ('FILE:', 'WRFILE:'):
+        if keytab.startswith(prefix):
+            return keytab[len(prefix):]
+    if ':' in keytab.split('/', 1)[0]:
+        # Some other keytab type (MEMORY:, KEYRING:...), nothing to stat
+        return None
+    return keytab
+
+
+def _keytab_mtime(path):
+    if path is None:
+        return None
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class AcceptorCredentials(object):
+    '''
+    Holds acceptor credentials for a service and authenticates tokens with
+    them.
+
+    Parameters:
+        service_name (str): GSSAPI host based service name, e.g. HTTP@host
+        keytab (str | None): keytab to read, defaults to KRB5_KTNAME
+        check_interval (float | None): minimum seconds between keytab mtime
+            checks on the request path, None to leave it to a watcher
+        overlap (float): seconds the previous credentials stay usable after
+            a reload
+    '''
+
+    def __init__(self, service_name, keytab=None, check_interval=5, overlap=0):
+        if gssapi is None:
+            raise ImportError('The gssapi backend requires python-gssapi')
+        if isinstance(service_name, bytes):
+            service_name = service_name.decode('utf-8')
+        self.service_name = service_name
+        self.keytab = keytab_path(keytab)
+        self.check_interval = check_interval
+        self.overlap = overlap
+        self.acquisitions = 0
+        self.reloads = 0
+        self.last_reload = None
+        self._lock = threading.Lock()
+        self._creds = None
+        self._expires = None
+        self._mtime = None
+        self._next_check = 0
+        self._snapshot = None
+        # (credentials, snapshot path, monotonic deadline) of the generation
+        # replaced by the last reload
+        self._previous = None
+
+    def credentials(self):
+        '''
+        Returns the current credentials, acquiring them on first use and
+        whenever they expire or the keytab is modified.
+        '''
+        creds = self._creds
+        if creds is None or self._stale():
+            with self._lock:
+                if self._creds is None or self._stale():
+                    snapshot = self._snapshot
+                    self._acquire()
+                    _remove_snapshot(snapshot)
+                creds = self._creds
+        return creds
+
+    def invalidate(self):
+        '''
+        Forces the credentials to be acquired again on next use
+        '''
+        with self._lock:
+            self._creds = None
+
+    def keytab_changed(self):
+        '''
+        Returns whether the keytab was modified since it was last read
+        '''
+        return self.keytab is not None and _keytab_mtime(self.keytab) != self._mtime
+
+    def reload(self):
+        '''
+        Acquires a new generation of credentials. The replaced generation is
+        kept for `overlap` seconds so tickets encrypted with the previous key
+        version are still accepted.
+        '''
+        with self._lock:
+            previous = (self._creds, self._snapshot)
+            self._acquire()
+            self._retire(previous)
+            self.reloads += 1
+            self.last_reload = time.time()
+        log.info('Reloaded acceptor credentials for %s', self.service_name)
+
+    def close(self):
+        '''
+        Releases the credentials and removes keytab snapshots
+        '''
+        with self._lock:
+            self._retire((None, None))
+            self._creds = None
+            _remove_snapshot(self._snapshot)
+            self._snapshot = None
+
+    def _retire(self, previous):
+        if self._previous is not None:
+            _remove_snapshot(self._previous[1])
+            self._previous = None
+        creds, snapshot = previous
+        if creds is not None and self.overlap > 0:
+            self._previous = (creds, snapshot, _monotonic() + self.overlap)
+        else:
+            _remove_snapshot(snapshot)
+
+    def _previous_credentials(self):
+        previous = self._previous
+        if previous is None:
+            return None
+        if _monotonic() >= previous[2]:
+            with self._lock:
+                if self._previous is previous:
+                    self._retire((None, None))
+            return None
+        return previous[0]
+
+    def _stale(self):
+        now = _monotonic()
+        if self._expires is not None and now >= self._expires:
+            return True
+        if self.keytab is None or self.check_interval is None or now < self._next_check:
+            return False
+        self._next_check = now + self.check_interval
+        return self.keytab_changed()
+
+    def _acquire(self):
+        name = gssapi.Name(self.service_name, gssapi.NameType.hostbased_service)
+        mtime = _keytab_mtime(self.keytab)
+        keytab = self.keytab
+        snapshot = None
+        if keytab is not None and self.overlap > 0:
+            # Credentials read their keytab lazily, so each generation needs
+            # its own copy to keep the previous key versions around.
+            snapshot = keytab = _snapshot_keytab(keytab)
+        if keytab is not None:
+            creds = gssapi.Credentials(name=name, usage='accept',
+                                       store={'keytab': keytab})
+        else:
+            creds = gssapi.Credentials(name=name, usage='accept')
+
+        try:
+            lifetime = creds.lifetime
+        except gssapi.exceptions.GSSError:
+            lifetime = None
+        now = _monotonic()
+        self._creds = creds
+        self._snapshot = snapshot
+        self._expires = None if lifetime is None else now + lifetime
+        self._mtime = mtime
+        self._next_check = now + (self.check_interval or 0)
+        self.acquisitions += 1
+        log.info('Acquired acceptor credentials for %s', self.service_name)
+
+    def authenticate(self, token):
+        '''
+        Performs GSSAPI Negotiate Authentication with the held credentials
+
+        Parameters:
+            token (str): base64 encoded GSSAPI Authentication Token
+
+        Returns:
+            tuple of
+            (str | None) username
+            (str | None) GSSAPI token
+
+        Raises:
+            VerificationUnavailable: when no credentials can be acquired
+        '''
+        try:
+            data = base64.b64decode(token)
+        except (TypeError, ValueError):
+            log.info('Malformed GSSAPI token', exc_info=True)
+            return None, None
+
+        try:
+            creds = self.credentials()
+        except gssapi.exceptions.GSSError:
+            from flask_kerberos_login.manager import VerificationUnavailable
+            log.warn('Unable to acquire acceptor credentials', exc_info=True)
+            raise VerificationUnavailable()
+
+        try:
+            context = gssapi.SecurityContext(creds=creds, usage='accept')
+            output = context.step(data)
+        except gssapi.exceptions.GSSError:
+            previous = self._previous_credentials()
+            if previous is None:
+                log.info('Unable to authenticate', exc_info=True)
+                return None, None
+            try:
+                context = gssapi.SecurityContext(creds=previous, usage='accept')
+                output = context.step(data)
+            except gssapi.exceptions.GSSError:
+                log.info('Unable to authenticate', exc_info=True)
+                return None, None
+            log.debug('Accepted token with the previous keytab generation')
+
+        if not context.complete:
+            log.info('Multi-leg GSSAPI negotiation is not supported')
+            return None, None
+
+        log.debug('Completed GSSAPI negotiation')
+        if output:
+            output = base64.b64encode(output).decode('ascii')
+        return '{}'.format(context.initiator_name), output or None
+
+
+def _snapshot_keytab(path):
+    fd, snapshot = tempfile.mkstemp(prefix='krb5_', suffix='.keytab')
+    try:
+        with os.fdopen(fd, 'wb') as dst, open(path, 'rb') as src:
+            shutil.copyfileobj(src, dst)
+    except Exception:
+        _remove_snapshot(snapshot)
+        raise
+    return snapshot
+
+
+def _remove_snapshot(path):
+    if path is None:
+        return
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+class KeytabWatcher(object):
+    '''
+    Polls the keytab of an `AcceptorCredentials` on a daemon thread and
+    reloads the credentials when it changes, so requests never wait on
+    keytab I/O.
+
+    Parameters:
+        acceptor (AcceptorCredentials): credentials to reload
+        interval (float): seconds between keytab mtime checks
+    '''
+
+    def __init__(self, acceptor, interval=10):
+        self.acceptor = acceptor
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        '''
+        Starts the watcher thread unless it already runs in this process.
+        Safe to call on every request, e.g. after a pre-fork server forked.
+        '''
+        if self._pid == os.getpid():
+            return
+        with self.acceptor._lock:
+            if self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name='krb5-keytab-watcher')
+                self._thread.daemon = True
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join()
+        self._thread = None
+        self._pid = None
+
+    def check(self):
+        '''
+        Reloads the credentials if the keytab changed. Returns whether a
+        reload happened.
+        '''
+        if not self.acceptor.keytab_changed():
+            return False
+        try:
+            self.acceptor.reload()
+        except Exception:
+            log.warn('Unable to reload keytab %s', self.acceptor.keytab, exc_info=True)
+            return False
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.check()
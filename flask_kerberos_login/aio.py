@@ -0,0 +1,132 @@
+'''
+Asyncio support: runs the blocking GSSAPI calls on a bounded thread pool
+
+pykerberos blocks while it reads the keytab, writes the replay cache and
+decrypts the ticket. Under async views these calls would stall the event
+loop, so they are handed to a dedicated executor instead::
+
+    from flask_kerberos_login.aio import async_kerberos_required
+
+    @app.route('/')
+    @async_kerberos_required
+    async def index():
+        ...
+
+Requires Python 3.7 or later.
+'''
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import threading
+
+from flask import abort
+from flask import current_app
+from flask import request
+import flask_login
+
+from flask_kerberos_login.manager import _is_authenticated
+
+
+class AsyncAuthenticator(object):
+    '''
+    Authenticates GSSAPI tokens for a login manager on a bounded thread
+    pool, keeping track of how many handshakes wait for a worker.
+
+    Parameters:
+        manager (KerberosLoginManager): manager whose backend, caches and
+            statistics are used
+        workers (int): number of threads running GSSAPI calls
+    '''
+
+    def __init__(self, manager, workers=4):
+        self.manager = manager
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='krb5-gssapi')
+        self._lock = threading.Lock()
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.running = 0
+        self.completed = 0
+
+    async def authenticate(self, token, client=None, negotiation=None):
+        '''
+        Authenticates `token`, sent by the remote address `client`, without
+        blocking the event loop. See `KerberosLoginManager._authenticate`.
+
+        Returns:
+            tuple of
+            (str | None) username
+            (str | None) GSSAPI token
+        '''
+        with self._lock:
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, self._run, token, client, negotiation)
+
+    def _run(self, token, client, negotiation):
+        with self._lock:
+            self.queue_depth -= 1
+            self.running += 1
+        try:
+            return self.manager._authenticate(token, client, negotiation)
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+
+    async def extract_token(self):
+        '''
+        Asynchronous counterpart of `KerberosLoginManager.extract_token`
+        '''
+        token = self.manager._request_token()
+        if token is not None:
+            self.manager._complete(*await self.authenticate(
+                token, request.remote_addr, self.manager._negotiation_key(request.environ)))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queue_depth': self.queue_depth,
+                'max_queue_depth': self.max_queue_depth,
+                'running': self.running,
+                'completed': self.completed,
+            }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+_lock = threading.Lock()
+
+
+def get_authenticator(manager):
+    '''
+    Returns the `AsyncAuthenticator` of `manager`, creating it on first use
+    with KRB5_ASYNC_WORKERS threads
+    '''
+    authenticator = manager.async_authenticator
+    if authenticator is None:
+        with _lock:
+            authenticator = manager.async_authenticator
+            if authenticator is None:
+                authenticator = AsyncAuthenticator(manager, manager._async_workers)
+                manager.async_authenticator = authenticator
+    return authenticator
+
+
+def async_kerberos_required(view):
+    '''
+    Asynchronous counterpart of `kerberos_required`, for `async def` views
+    '''
+    @functools.wraps(view)
+    async def decorated(*args, **kwargs):
+        manager = current_app.kerberos_manager
+        await get_authenticator(manager).extract_token()
+        if not _is_authenticated(flask_login.current_user):
+            abort(401)
+        return await view(*args, **kwargs)
+    return decorated
@@ -0,0 +1,145 @@
+'''
+Authenticates requests in an ASGI middleware, for async servers such as
+uvicorn
+
+Usage::
+
+    from flask_kerberos_login import KerberosLoginManager
+    from flask_kerberos_login.asgi import KerberosASGIMiddleware
+
+    manager = KerberosLoginManager()
+    manager.init_config({'KRB5_ASYNC_WORKERS': 16})
+    application = KerberosASGIMiddleware(app, manager)
+
+GSSAPI calls run on the manager's bounded thread pool (see
+`flask_kerberos_login.aio`), so the event loop keeps serving other
+connections during a handshake. Authenticated requests reach the wrapped
+application with ``kerberos.principal`` and the mapped ``kerberos.user`` in
+the scope; rejected ones are answered directly.
+
+Requires Python 3.7 or later.
+'''
+import logging
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.exceptions import Unauthorized
+
+from flask_kerberos_login.aio import get_authenticator
+from flask_kerberos_login.manager import ENVIRON_NEGOTIATION
+from flask_kerberos_login.manager import ENVIRON_PRINCIPAL
+from flask_kerberos_login.manager import ENVIRON_TOKEN
+from flask_kerberos_login.policy import EXEMPT
+from flask_kerberos_login.policy import REQUIRED
+from flask_kerberos_login.wsgi import local_name
+from flask_kerberos_login.wsgi import negotiate_headers
+
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+#: Scope key holding the local user name of the principal
+SCOPE_USER = 'kerberos.user'
+
+
+class KerberosASGIMiddleware(object):
+    '''
+    ASGI middleware running the GSSAPI handshake of a `KerberosLoginManager`
+
+    Parameters:
+        app: the ASGI application to wrap
+        manager (KerberosLoginManager): a configured manager, with or
+            without a Flask app. Only path policies apply here.
+    '''
+
+    def __init__(self, app, manager):
+        self.app = app
+        self.manager = manager
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        state = {}
+        send = self._send(state, send)
+        try:
+            scope = await self._authenticate(scope, state)
+        except HTTPException as e:
+            response = e.get_response()
+            await send({
+                'type': 'http.response.start',
+                'status': response.status_code,
+                'headers': [(key.encode('latin-1'), value.encode('latin-1'))
+                            for key, value in response.headers.items()],
+            })
+            await send({'type': 'http.response.body', 'body': response.get_data()})
+            return
+        return await self.app(scope, receive, send)
+
+    async def _authenticate(self, scope, state):
+        '''
+        Authenticates the request described by `scope`, raising an
+        `HTTPException` to reject it
+
+        Returns:
+            the scope to pass to the wrapped application
+        '''
+        manager = self.manager
+        policy = None
+        if manager._policy is not None:
+            policy = manager._policy.lookup(path=scope.get('path'))
+            if policy == EXEMPT:
+                return scope
+
+        header = cookie = None
+        for name, value in scope['headers']:
+            if name == b'authorization':
+                header = value
+            elif name == b'cookie':
+                cookie = value
+        if header is None or not header.startswith(b'Negotiate '):
+            if policy == REQUIRED:
+                raise Unauthorized()
+            return scope
+
+        token = header[10:].decode('latin-1')
+        manager._check_token(token)
+        client = scope.get('client') or (None, None)
+        negotiation = None
+        if manager._contexts is not None:
+            environ = {'REMOTE_ADDR': client[0], 'REMOTE_PORT': client[1]}
+            if cookie is not None:
+                environ['HTTP_COOKIE'] = cookie.decode('latin-1')
+            negotiation = manager._negotiation_key(environ)
+            state[ENVIRON_NEGOTIATION] = environ.get(ENVIRON_NEGOTIATION)
+
+        user, token = await get_authenticator(manager).authenticate(
+            token, client[0], negotiation)
+        state[ENVIRON_TOKEN] = token
+        name = local_name(manager, user, token)
+
+        scope = dict(scope)
+        scope[ENVIRON_PRINCIPAL] = user
+        scope[SCOPE_USER] = name
+        return scope
+
+    def _send(self, state, send):
+        '''
+        Wraps `send` to add the Negotiate challenge or response token to the
+        response headers
+        '''
+        async def wrapped(message):
+            if message['type'] == 'http.response.start':
+                headers = message.get('headers', ())
+                negotiates = any(
+                    key.lower() == b'www-authenticate' and value.startswith(b'Negotiate')
+                    for key, value in headers)
+                extra = negotiate_headers(
+                    self.manager, message['status'], negotiates,
+                    state.get(ENVIRON_TOKEN), state.get(ENVIRON_NEGOTIATION))
+                if extra:
+                    headers = list(headers)
+                    headers.extend((key.encode('latin-1'), value.encode('latin-1'))
+                                   for key, value in extra)
+                    message = dict(message, headers=headers)
+            await send(message)
+        return wrapped
@@ -0,0 +1,230 @@
+'''
+Bounded caches used to avoid repeating expensive GSSAPI work
+'''
+from __future__ import absolute_import, print_function, unicode_literals
+
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+#: Rough per-entry bookkeeping overhead, in bytes, charged against max_bytes
+ENTRY_OVERHEAD = 256
+
+
+class TTLCache(object):
+    '''
+    A thread-safe LRU cache whose entries expire after a fixed time-to-live
+
+    Parameters:
+        max_entries (int): maximum number of entries kept
+        ttl (float | None): seconds an entry stays valid, None to never expire
+        max_bytes (int | None): hard cap on the estimated size of all entries
+        sizeof (callable | None): estimates the size of a (key, value) pair
+        on_evict (callable | None): called with (key, value) for every entry
+            dropped because of expiry, size limits or invalidation
+    '''
+
+    def __init__(self, max_entries, ttl=None, max_bytes=None, sizeof=None,
+                 on_evict=None, clock=_monotonic):
+        if max_entries < 1:
+            raise ValueError('max_entries must be positive')
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof or (lambda key, value: ENTRY_OVERHEAD)
+        self._on_evict = on_evict
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def get(self, key, default=None, count=True):
+        '''
+        Returns the cached value for `key`, or `default` when it is missing
+        or expired. A hit marks the entry as most recently used.
+        '''
+        dropped = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= self._clock():
+                dropped.append(self._remove(key))
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                if count:
+                    self.misses += 1
+            else:
+                self._move_to_end(key)
+                if count:
+                    self.hits += 1
+        self._notify(dropped)
+        return default if entry is None else entry[0]
+
+    def set(self, key, value, ttl=None):
+        '''
+        Stores `value` under `key`, evicting least recently used entries
+        until the entry count and size limits hold again.
+
+        `ttl` may only shorten the cache-wide time-to-live.
+        '''
+        if ttl is None or (self.ttl is not None and ttl > self.ttl):
+            ttl = self.ttl
+        size = self._sizeof(key, value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return False
+
+        expires = None if ttl is None else self._clock() + ttl
+        dropped = []
+        with self._lock:
+            if key in self._entries:
+                dropped.append(self._remove(key))
+            self._entries[key] = (value, expires, size)
+            self._bytes += size
+            while (len(self._entries) > self.max_entries or
+                   (self.max_bytes is not None and self._bytes > self.max_bytes)):
+                oldest = next(iter(self._entries))
+                dropped.append(self._remove(oldest))
+                self.evictions += 1
+        self._notify(dropped)
+        return True
+
+    def pop(self, key, default=None):
+        '''
+        Removes `key` from the cache and returns its value, or `default` when
+        it is missing or expired. An expired entry is handed to the eviction
+        callback instead.
+        '''
+        dropped = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[1] is not None and entry[1] <= self._clock():
+                dropped.append(self._remove(key))
+                self.expirations += 1
+                value = default
+            else:
+                _, value = self._remove(key)
+        self._notify(dropped)
+        return value
+
+    def invalidate(self, key):
+        '''
+        Drops `key` from the cache, notifying the eviction callback
+        '''
+        with self._lock:
+            dropped = [self._remove(key)] if key in self._entries else []
+        self._notify(dropped)
+
+    def clear(self):
+        with self._lock:
+            dropped = [(key, entry[0]) for key, entry in self._entries.items()]
+            self._entries.clear()
+            self._bytes = 0
+        self._notify(dropped)
+
+    def purge(self):
+        '''
+        Drops all expired entries and returns how many were removed
+        '''
+        now = self._clock()
+        with self._lock:
+            expired = [key for key, entry in self._entries.items()
+                       if entry[1] is not None and entry[1] <= now]
+            dropped = [self._remove(key) for key in expired]
+            self.expirations += len(dropped)
+        self._notify(dropped)
+        return len(dropped)
+
+    def purge_oldest(self):
+        '''
+        Drops expired entries from the least recently used end, stopping at
+        the first live one, and returns how many were removed. Unlike `purge`
+        it does not scan the whole cache, and finds every expired entry when
+        they expire in insertion order: with a fixed time-to-live and no
+        `get` reordering them.
+        '''
+        now = self._clock()
+        dropped = []
+        with self._lock:
+            while self._entries:
+                key = next(iter(self._entries))
+                expires = self._entries[key][1]
+                if expires is None or expires > now:
+                    break
+                dropped.append(self._remove(key))
+            self.expirations += len(dropped)
+        self._notify(dropped)
+        return len(dropped)
+
+    def stats(self):
+        '''
+        Returns hit/miss/eviction statistics and the current occupancy
+        '''
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
+
+    def _remove(self, key):
+        value, _, size = self._entries.pop(key)
+        self._bytes -= size
+        return key, value
+
+    def _move_to_end(self, key):
+        self._entries[key] = self._entries.pop(key)
+
+    def _notify(self, dropped):
+        if self._on_evict is not None:
+            for key, value in dropped:
+                self._on_evict(key, value)
+
+
+def token_digest(token):
+    '''
+    Returns a fixed-size digest identifying a GSSAPI token
+    '''
+    if not isinstance(token, bytes):
+        # Headers are latin-1 under WSGI: never fail on a malformed token
+        token = token.encode('latin-1')
+    return hashlib.sha256(token).digest()
+
+
+def _result_size(key, value):
+    user, token = value
+    return ENTRY_OVERHEAD + len(key) + len(user or '') + len(token or '')
+
+
+class TokenCache(TTLCache):
+    '''
+    Maps the digest of a verified GSSAPI token, see `token_digest`, to its
+    authentication result, a tuple of (principal, response token).
+
+    Only completed handshakes should be stored: a cached result is returned
+    without consulting libkrb5 again, so the time-to-live must not exceed
+    the window in which the acceptor would accept the same authenticator.
+    '''
+
+    def __init__(self, max_entries, ttl, max_bytes=None, clock=_monotonic):
+        super(TokenCache, self).__init__(
+            max_entries, ttl=ttl, max_bytes=max_bytes, sizeof=_result_size,
+            clock=clock)
@@ -0,0 +1,74 @@
+'''
+Keeps GSSAPI server contexts between the legs of a multi-round negotiation
+
+A context that needs another round trip is stored under a key identifying
+the client, either its connection or a negotiation cookie, and picked up
+again by the next request carrying that key. The table is bounded in size
+and age; every context dropped from it is released with
+`authGSSServerClean`.
+'''
+from __future__ import absolute_import, print_function, unicode_literals
+
+import binascii
+import os
+
+from flask_kerberos_login.cache import TTLCache, _monotonic
+
+
+def new_negotiation_id():
+    '''
+    Returns a random identifier for the negotiation cookie
+    '''
+    return binascii.hexlify(os.urandom(16)).decode('ascii')
+
+
+class ContextTable(object):
+    '''
+    Contexts are only stored and taken, never looked up in place, so they
+    expire in the order they were stored.
+
+    Parameters:
+        clean (callable): releases a server context, e.g.
+            kerberos.authGSSServerClean
+        max_contexts (int): contexts kept, least recently used first out
+        ttl (float): seconds a context waits for the next leg
+    '''
+
+    def __init__(self, clean, max_contexts=1024, ttl=30, clock=_monotonic):
+        self._clean = clean
+        self._contexts = TTLCache(max_contexts, ttl=ttl, on_evict=self._release,
+                                  clock=clock)
+
+    def take(self, key):
+        '''
+        Removes and returns the context stored under `key`, or None when it
+        is missing or expired. The caller owns the returned context; expired
+        contexts are released.
+        '''
+        if key is None:
+            return None
+        self._contexts.purge_oldest()
+        return self._contexts.pop(key)
+
+    def discard(self, key):
+        '''
+        Releases the context stored under `key`, if any
+        '''
+        if key is not None:
+            self._contexts.invalidate(key)
+
+    def put(self, key, state):
+        '''
+        Stores a context that awaits the next leg of its negotiation
+        '''
+        self._contexts.purge_oldest()
+        self._contexts.set(key, state)
+
+    def clear(self):
+        self._contexts.clear()
+
+    def stats(self):
+        return self._contexts.stats()
+
+    def _release(self, key, state):
+        self._clean(state)
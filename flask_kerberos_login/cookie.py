@@ -0,0 +1,124 @@
+'''
+Stateless authentication cookie issued after a successful handshake
+
+The cookie carries the principal, an expiry time and the id of the signing
+key, authenticated with HMAC-SHA256::
+
+    <base64 principal>.<expiry>.<key id>.<base64 signature>
+
+Verifying it costs one HMAC, against a GSSAPI step or a session lookup.
+'''
+from __future__ import absolute_import, print_function, unicode_literals
+
+import base64
+import binascii
+import hashlib
+import hmac
+import threading
+import time
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(data):
+    data = data.encode('ascii')
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+def _key_bytes(key):
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return key
+
+
+class AuthCookie(object):
+    '''
+    Issues and verifies signed authentication cookies
+
+    Parameters:
+        keys (list): secret keys. The first one signs new cookies; all of
+            them verify, so a new key can be put first while cookies signed
+            with the previous one stay valid until they expire.
+        name (str): cookie name
+        max_age (int): lifetime of issued cookies, in seconds
+        clock_skew (int): seconds a cookie is still accepted after expiry
+        secure (bool): whether browsers should only send it over HTTPS
+    '''
+
+    def __init__(self, keys, name='krb5_auth', max_age=3600, clock_skew=300,
+                 secure=True, clock=time.time):
+        if not keys:
+            raise ValueError('At least one key is needed to sign cookies')
+        if isinstance(keys, (bytes, type(''))):
+            keys = [keys]
+        self._keys = []
+        for key in keys:
+            key = _key_bytes(key)
+            kid = hashlib.sha256(key).hexdigest()[:8]
+            self._keys.append((kid, key))
+        self._by_kid = dict(self._keys)
+        self.name = name
+        self.max_age = int(max_age)
+        self.clock_skew = clock_skew
+        self.secure = secure
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.issued = 0
+        self.verified = 0
+        self.expired = 0
+        self.invalid = 0
+
+    def _signature(self, key, payload):
+        return _b64encode(hmac.new(key, payload.encode('ascii'), hashlib.sha256).digest())
+
+    def issue(self, principal, lifetime=None):
+        '''
+        Returns a cookie value for `principal`, expiring after `max_age`
+        seconds or `lifetime`, the remaining ticket lifetime, when shorter
+        '''
+        age = self.max_age if lifetime is None else min(self.max_age, int(lifetime))
+        kid, key = self._keys[0]
+        payload = '{}.{}.{}'.format(
+            _b64encode(principal.encode('utf-8')), int(self._clock()) + age, kid)
+        with self._lock:
+            self.issued += 1
+        return '{}.{}'.format(payload, self._signature(key, payload))
+
+    def verify(self, value):
+        '''
+        Returns the principal of a cookie value, or None when it is missing,
+        forged, signed with an unknown key or expired
+        '''
+        if not value:
+            return None
+        try:
+            payload, signature = value.rsplit('.', 1)
+            encoded, expiry, kid = payload.split('.')
+            key = self._by_kid.get(kid)
+            if key is None or not hmac.compare_digest(
+                    self._signature(key, payload), signature):
+                raise ValueError('bad signature')
+            expiry = int(expiry)
+            principal = _b64decode(encoded).decode('utf-8')
+        except (ValueError, TypeError, UnicodeError, binascii.Error):
+            with self._lock:
+                self.invalid += 1
+            return None
+        if self._clock() > expiry + self.clock_skew:
+            with self._lock:
+                self.expired += 1
+            return None
+        with self._lock:
+            self.verified += 1
+        return principal
+
+    def stats(self):
+        with self._lock:
+            return {
+                'issued': self.issued,
+                'verified': self.verified,
+                'expired': self.expired,
+                'invalid': self.invalid,
+            }
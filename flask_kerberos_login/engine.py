@@ -0,0 +1,263 @@
+'''
+Verifies GSSAPI tokens on a pool of worker processes
+
+Ticket decryption and PAC parsing are CPU bound and hold the GIL inside
+pykerberos, so a single process cannot use more than one core for
+handshakes. The engine forwards tokens to pre-forked worker processes that
+each hold warm acceptor state, batching tokens that arrive together into a
+single round trip.
+
+A worker crashing on a token breaks the whole `ProcessPoolExecutor`; the
+engine then starts a new pool and retries each affected token once on its
+own, so only a token that crashes a worker twice is rejected.
+
+Requires Python 3.7 or later.
+'''
+from __future__ import absolute_import, print_function, unicode_literals
+
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import os
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from werkzeug.exceptions import ServiceUnavailable
+
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+class EngineBusy(ServiceUnavailable):
+    '''
+    Raised when too many tokens already wait for verification. Responds
+    503 when it escapes a request.
+    '''
+
+
+# Verification function of the current worker process, see _init_worker
+_verify = None
+
+
+def _init_worker(service_name, backend, keytab):
+    global _verify
+    if backend == 'gssapi':
+        from flask_kerberos_login.acceptor import AcceptorCredentials
+        acceptor = AcceptorCredentials(service_name, keytab)
+        acceptor.credentials()
+        _verify = acceptor.authenticate
+    else:
+        from flask_kerberos_login.manager import _gssapi_authenticate
+
+        def _verify(token):
+            return _gssapi_authenticate(token, service_name)
+
+
+def _verify_batch(tokens):
+    results = []
+    for token in tokens:
+        try:
+            result = _verify(token)
+        except ServiceUnavailable:
+            # The worker cannot verify anything, e.g. without credentials;
+            # None tells `verify` that the token is not at fault
+            result = None
+        except Exception:
+            log.info('Unable to authenticate', exc_info=True)
+            result = (None, None)
+        if result is not None and not isinstance(result, tuple):
+            result = (None, None)
+        results.append(result)
+    return results
+
+
+class VerificationEngine(object):
+    '''
+    Parameters:
+        service_name (str): GSSAPI service name
+        processes (int): number of worker processes
+        backend (str): 'pykerberos' or 'gssapi', see KRB5_GSSAPI_BACKEND
+        keytab (str | None): keytab for the gssapi backend
+        max_pending (int | None): tokens allowed to wait for verification
+            before `verify` raises EngineBusy, defaults to 16 per process
+        batch_size (int): maximum tokens sent to a worker in one round trip
+        batch_window (float): seconds to wait for more tokens to fill a batch
+        timeout (float): seconds `verify` waits for a result
+    '''
+
+    def __init__(self, service_name, processes, backend='pykerberos', keytab=None,
+                 max_pending=None, batch_size=8, batch_window=0.001, timeout=10):
+        self.service_name = service_name
+        self.processes = processes
+        self.backend = backend
+        self.keytab = keytab
+        self.max_pending = max_pending or 16 * processes
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._executor = None
+        self._dispatcher = None
+        self._pid = None
+        self.pending = 0
+        self.batches = 0
+        self.verified = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.restarts = 0
+
+    def verify(self, token):
+        '''
+        Verifies `token` on a worker process
+
+        Returns:
+            tuple of
+            (str | None) username
+            (str | None) GSSAPI token
+
+        Raises:
+            EngineBusy: when too many tokens already wait
+            VerificationUnavailable: when no result came within `timeout` or
+                the worker could not verify tokens at all
+        '''
+        from flask_kerberos_login.manager import VerificationUnavailable
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise EngineBusy()
+            self.pending += 1
+        try:
+            self._start()
+            future = Future()
+            self._queue.put((token, future, True))
+            try:
+                result = future.result(self.timeout)
+            except TimeoutError:
+                with self._lock:
+                    self.timeouts += 1
+                log.warn('Timed out waiting for token verification')
+                raise VerificationUnavailable()
+            if result is None:
+                raise VerificationUnavailable()
+            return result
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'processes': self.processes,
+                'pending': self.pending,
+                'batches': self.batches,
+                'verified': self.verified,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'restarts': self.restarts,
+            }
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+            self._pid = None
+        if self._dispatcher is not None:
+            self._queue.put(None)
+            self._dispatcher = None
+        if executor is not None:
+            # Without joining, Python 3.8 leaves the workers running and
+            # blocks the interpreter at exit
+            executor.shutdown(wait=True)
+
+    def _start(self):
+        # Pools and threads do not survive a fork, e.g. by a pre-fork server
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            self._executor = self._new_executor()
+            self._dispatcher = threading.Thread(target=self._dispatch, args=(self._queue,),
+                                                name='krb5-verification-engine')
+            self._dispatcher.daemon = True
+            self._dispatcher.start()
+            self._pid = os.getpid()
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(
+            max_workers=self.processes,
+            initializer=_init_worker,
+            initargs=(self.service_name, self.backend, self.keytab),
+        )
+
+    def _dispatch(self, requests):
+        while True:
+            item = requests.get()
+            if item is None:
+                return
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = requests.get(timeout=self.batch_window)
+                except queue.Empty:
+                    break
+                if item is None:
+                    requests.put(None)
+                    break
+                batch.append(item)
+            self._submit(batch)
+
+    def _submit(self, batch):
+        executor = self._executor
+        try:
+            future = executor.submit(_verify_batch, [token for token, _, _ in batch])
+        except (BrokenProcessPool, RuntimeError):
+            self._recover(executor, batch)
+            return
+        with self._lock:
+            self.batches += 1
+        future.add_done_callback(lambda done: self._deliver(executor, batch, done))
+
+    def _deliver(self, executor, batch, done):
+        # Not raising the error keeps its traceback, and with it the pool's
+        # management thread, out of a reference cycle
+        error = done.exception()
+        if isinstance(error, BrokenProcessPool):
+            self._recover(executor, batch)
+            return
+        elif error is not None:
+            log.warn('Token verification failed', exc_info=error)
+            results = [None] * len(batch)
+        else:
+            results = done.result()
+        with self._lock:
+            self.verified += len(batch)
+        for (_, future, _), result in zip(batch, results):
+            future.set_result(result)
+
+    def _recover(self, executor, batch):
+        with self._lock:
+            if self._executor is executor:
+                log.warn('Verification worker crashed, restarting the pool')
+                self._executor = self._new_executor()
+                self.restarts += 1
+        # Usually called by the pool's own management thread, which cannot
+        # join itself; closing the pool under it leaves it half shut down
+        reaper = threading.Thread(target=executor.shutdown, name='krb5-verification-reaper')
+        reaper.daemon = True
+        reaper.start()
+        for token, future, retry in batch:
+            if retry:
+                # Retry alone, so a poisonous token only takes itself down
+                self._submit([(token, future, False)])
+            else:
+                log.warn('Rejecting a token that crashed a verification worker twice')
+                future.set_result((None, None))
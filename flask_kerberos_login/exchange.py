@@ -0,0 +1,252 @@
+'''
+Exchanges a Kerberos handshake for a short-lived signed JWT
+
+A front-end authenticates the user once with Negotiate and hands the JWT to
+internal services, which verify it locally with `JWTVerifier` instead of
+running their own handshake::
+
+    from flask_kerberos_login.exchange import exchange_blueprint
+
+    app.register_blueprint(exchange_blueprint(
+        kerberos_manager, private_key=open('signing.pem').read(),
+        issuer='https://front.example.org', groups=lookup_groups))
+
+The blueprint serves the token at ``/token`` and the public key set at
+``/jwks.json``. Downstream::
+
+    verifier = JWTVerifier('https://front.example.org/jwks.json',
+                           issuer='https://front.example.org')
+    claims = verifier.verify(bearer_token)
+
+Requires PyJWT with its cryptography extra (``pip install PyJWT[crypto]``).
+'''
+from __future__ import absolute_import, print_function, unicode_literals
+
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+
+from flask import Blueprint
+from flask import abort
+from flask import jsonify
+
+try:
+    import jwt
+    from jwt.algorithms import RSAAlgorithm
+except ImportError:
+    jwt = None
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+def _require_jwt():
+    if jwt is None:
+        raise ImportError('The token exchange requires PyJWT[crypto]')
+
+
+class TokenIssuer(object):
+    '''
+    Mints JWTs for principals authenticated by a login manager
+
+    Parameters:
+        manager (KerberosLoginManager): manager authenticating the requests
+        private_key (str): PEM encoded RSA private key signing the tokens
+        kid (str | None): key id, by default derived from the public key
+        issuer (str | None): `iss` claim
+        audience (str | list | None): `aud` claim
+        lifetime (int): seconds until tokens expire
+        groups (callable | None): called with the local user name, returns
+            the groups to put in the `groups` claim
+        algorithm (str): RS256, RS384 or RS512
+    '''
+
+    def __init__(self, manager, private_key, kid=None, issuer=None, audience=None,
+                 lifetime=300, groups=None, algorithm='RS256'):
+        _require_jwt()
+        self.manager = manager
+        self.issuer = issuer
+        self.audience = audience
+        self.lifetime = int(lifetime)
+        self.groups = groups
+        self.algorithm = algorithm
+        self._private_key = private_key
+        rsa = RSAAlgorithm(RSAAlgorithm.SHA256)
+        jwk = json.loads(RSAAlgorithm.to_jwk(rsa.prepare_key(private_key).public_key()))
+        if kid is None:
+            kid = hashlib.sha256(
+                json.dumps(jwk, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        jwk.update({'kid': kid, 'use': 'sig', 'alg': algorithm})
+        self.kid = kid
+        self.jwks = {'keys': [jwk]}
+
+    def issue(self, principal):
+        '''
+        Returns a signed JWT for `principal`
+        '''
+        name = principal
+        if self.manager._mapper is not None:
+            name = self.manager._mapper.map(principal)
+            if name is None:
+                abort(403)
+        now = int(time.time())
+        claims = {
+            'sub': principal,
+            'preferred_username': name,
+            'iat': now,
+            'nbf': now,
+            'exp': now + self.lifetime,
+            'jti': uuid.uuid4().hex,
+        }
+        if self.issuer is not None:
+            claims['iss'] = self.issuer
+        if self.audience is not None:
+            claims['aud'] = self.audience
+        if self.groups is not None:
+            claims['groups'] = list(self.groups(name))
+        token = jwt.encode(claims, self._private_key, algorithm=self.algorithm,
+                           headers={'kid': self.kid})
+        if isinstance(token, bytes):
+            token = token.decode('ascii')
+        return token
+
+    def token_view(self):
+        '''
+        Authenticates the request with Negotiate and returns a token
+        '''
+        self.manager.extract_token()
+        principal = self.manager.principal()
+        if principal is None:
+            abort(401)
+        response = jsonify(
+            access_token=self.issue(principal),
+            token_type='Bearer',
+            expires_in=self.lifetime,
+        )
+        # Bearer tokens must not be kept by caches, see RFC 6749 section 5.1
+        response.headers['Cache-Control'] = 'no-store'
+        response.headers['Pragma'] = 'no-cache'
+        return response
+
+    def jwks_view(self):
+        return jsonify(self.jwks)
+
+
+def exchange_blueprint(manager, private_key, url='/token', jwks_url='/jwks.json',
+                       name='kerberos_exchange', **kwargs):
+    '''
+    Returns a blueprint exchanging Negotiate handshakes for JWTs at `url`
+    and serving the public key set at `jwks_url`. Other keyword arguments
+    are passed to `TokenIssuer`.
+    '''
+    issuer = TokenIssuer(manager, private_key, **kwargs)
+    blueprint = Blueprint(name, __name__)
+    blueprint.add_url_rule(url, 'token', issuer.token_view, methods=['GET', 'POST'])
+    blueprint.add_url_rule(jwks_url, 'jwks', issuer.jwks_view)
+    blueprint.issuer = issuer
+    return blueprint
+
+
+class JWTVerifier(object):
+    '''
+    Verifies JWTs minted by the exchange blueprint, with a cached key set
+
+    The key set is fetched once and refetched when a token names an
+    unknown key id, at most once per `min_refresh_interval` seconds, so
+    signing key rotation needs no restart and forged key ids cannot flood
+    the issuer.
+
+    Parameters:
+        jwks (str | dict): URL of the key set, or the key set itself
+        issuer (str | None): required `iss` claim
+        audience (str | None): required `aud` claim
+        algorithms (list): accepted signature algorithms
+        leeway (int): seconds of clock skew tolerated on `exp` and `nbf`
+        min_refresh_interval (float): minimum seconds between two fetches
+        timeout (float): seconds to wait for the key set
+    '''
+
+    def __init__(self, jwks, issuer=None, audience=None, algorithms=('RS256',),
+                 leeway=30, min_refresh_interval=60, timeout=5, clock=_monotonic):
+        _require_jwt()
+        self.issuer = issuer
+        self.audience = audience
+        self.algorithms = list(algorithms)
+        self.leeway = leeway
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._url = None
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._keys = {}
+        self._fetched = None
+        self.refreshes = 0
+        if isinstance(jwks, dict):
+            self._load(jwks)
+        else:
+            self._url = jwks
+
+    def _load(self, jwks):
+        keys = {}
+        for jwk in jwks.get('keys', ()):
+            if jwk.get('kty') == 'RSA':
+                keys[jwk.get('kid')] = RSAAlgorithm.from_jwk(json.dumps(jwk))
+        self._keys = keys
+
+    def _fetch(self):
+        response = urlopen(self._url, timeout=self.timeout)
+        try:
+            return json.loads(response.read().decode('utf-8'))
+        finally:
+            response.close()
+
+    def key(self, kid):
+        '''
+        Returns the public key `kid`, refreshing the key set when it is
+        unknown, or None
+        '''
+        key = self._keys.get(kid)
+        if key is not None or self._url is None:
+            return key
+        with self._lock:
+            key = self._keys.get(kid)
+            now = self._clock()
+            if key is None and (self._fetched is None or
+                                now - self._fetched >= self.min_refresh_interval):
+                self._fetched = now
+                self.refreshes += 1
+                try:
+                    self._load(self._fetch())
+                except (IOError, OSError, ValueError):
+                    log.warn('Unable to fetch the key set %s', self._url, exc_info=True)
+                key = self._keys.get(kid)
+        return key
+
+    def verify(self, token):
+        '''
+        Returns the claims of `token`
+
+        Raises:
+            jwt.InvalidTokenError: when the token is malformed, expired,
+                signed by an unknown key or for another issuer or audience
+        '''
+        kid = jwt.get_unverified_header(token).get('kid')
+        key = self.key(kid)
+        if key is None:
+            raise jwt.InvalidTokenError('Unknown key id {}'.format(kid))
+        claims = jwt.decode(token, key, algorithms=self.algorithms, audience=self.audience,
+                            issuer=self.issuer, leeway=self.leeway)
+        if 'exp' not in claims:
+            raise jwt.InvalidTokenError('Token without expiry')
+        return claims
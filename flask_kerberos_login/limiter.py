@@ -0,0 +1,78 @@
+'''
+Per-client token buckets used to shed clients sending invalid tokens
+'''
+from __future__ import absolute_import, print_function, unicode_literals
+
+from collections import OrderedDict
+import threading
+import time
+
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+class TokenBucketLimiter(object):
+    '''
+    Keeps a token bucket per client. Each failure consumes a token, and
+    tokens come back at `rate` per second up to `burst`. A client whose
+    bucket is empty is refused until it refills.
+
+    Parameters:
+        rate (float): tokens added per second
+        burst (int): bucket capacity
+        max_clients (int): buckets kept, least recently used first out
+    '''
+
+    def __init__(self, rate, burst, max_clients=10000, clock=_monotonic):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_clients = max_clients
+        self._clock = clock
+        self._lock = threading.Lock()
+        # client -> (tokens, time of last update)
+        self._buckets = OrderedDict()
+        self.shed = 0
+        self.failures = 0
+        self.evictions = 0
+
+    def _tokens(self, client, now):
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            return self.burst
+        tokens, updated = bucket
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def allow(self, client):
+        '''
+        Returns whether `client` may attempt a handshake, counting refusals
+        '''
+        with self._lock:
+            if client not in self._buckets:
+                return True
+            if self._tokens(client, self._clock()) >= 1:
+                return True
+            self.shed += 1
+            return False
+
+    def failure(self, client):
+        '''
+        Charges a failed handshake to `client`
+        '''
+        with self._lock:
+            now = self._clock()
+            tokens = max(0.0, self._tokens(client, now) - 1)
+            self._buckets.pop(client, None)
+            self._buckets[client] = (tokens, now)
+            self.failures += 1
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'clients': len(self._buckets),
+                'failures': self.failures,
+                'shed': self.shed,
+                'evictions': self.evictions,
+            }
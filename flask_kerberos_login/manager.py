@@ -3,69 +3,272 @@ Provides a pluggable login manager that uses Kerberos for authentication
 '''
 from __future__ import absolute_import, print_function, unicode_literals
 
+import atexit
+import functools
 import logging
+import os
 import socket
+import sys
+import time
 
 from flask import _request_ctx_stack as stack
 from flask import abort
+from flask import current_app
 from flask import request
-import kerberos
+from flask import session
+import flask_login
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.http import parse_cookie
+
+from flask_kerberos_login.cache import TTLCache
+from flask_kerberos_login.cache import TokenCache
+from flask_kerberos_login.cache import token_digest
+from flask_kerberos_login.contexts import ContextTable
+from flask_kerberos_login.contexts import new_negotiation_id
+from flask_kerberos_login.cookie import AuthCookie
+from flask_kerberos_login.limiter import TokenBucketLimiter
+from flask_kerberos_login.mapping import PrincipalMapper
+from flask_kerberos_login.mapping import split_principal
+from flask_kerberos_login.policy import EXEMPT, REQUIRED, PolicyTable
+from flask_kerberos_login.prevalidate import UNSUPPORTED, VALID, inspect_token
+from flask_kerberos_login.prevalidate import is_initial_token
+from flask_kerberos_login.proxy import TrustedProxy
+from flask_kerberos_login.replay import BloomReplayDetector
+from flask_kerberos_login.replay import ReplayDetector
+from flask_kerberos_login.replay import authenticator_digest
+from flask_kerberos_login.sidecar import SidecarClient
+from flask_kerberos_login.sidecar import SidecarUnavailable
+from flask_kerberos_login.stats import Counters
+from flask_kerberos_login.stats import Timings
+from flask_kerberos_login.writer import WriteBehindQueue
 
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
+_monotonic = getattr(time, 'monotonic', time.time)
+
 
-def _gssapi_authenticate(token, service_name):
+class VerificationUnavailable(ServiceUnavailable):
+    '''
+    Raised when a token cannot be verified because of the server, e.g. the
+    acceptor has no credentials, the verification engine timed out or the
+    sidecar is unreachable. Responds 503 when it escapes a request; the
+    token is not held against the client.
+    '''
+
+
+class _LazyKerberos(object):
+    '''
+    Stands in for the kerberos module, importing pykerberos, and with it
+    libkrb5, on first use. Workers in KRB5_TRUSTED_PROXY mode never load it.
+
+    The module is then bound in place of the proxy, so later calls skip the
+    import machinery. References to the proxy taken earlier, such as default
+    arguments, go through its cached module.
+    '''
+    _module = None
+
+    def __getattr__(self, name):
+        module = self._module
+        if module is None:
+            global kerberos
+            import kerberos as module
+            self._module = kerberos = module
+        return getattr(module, name)
+
+
+kerberos = _LazyKerberos()
+
+
+def _gssapi_authenticate(token, service_name, gss=kerberos):
     '''
     Performs GSSAPI Negotiate Authentication
 
     Parameters:
         token (str): GSSAPI Authentication Token
         service_name (str): GSSAPI service name
+        gss: the kerberos module, or a proxy of it such as `_TimedKerberos`
 
     Returns:
         tuple of
         (str | None) username
         (str | None) GSSAPI token
     '''
-    state = None
+    user, token, state = _gssapi_step(token, service_name, gss=gss)
+    if state is not None:
+        log.info('Multi-leg GSSAPI negotiation requires KRB5_CONTEXT_TABLE')
+        gss.authGSSServerClean(state)
+        return None, None
+    return user, token
+
+
+def _gssapi_step(token, service_name, state=None, gss=kerberos):
+    '''
+    Performs one leg of GSSAPI Negotiate Authentication
+
+    Parameters:
+        token (str): GSSAPI Authentication Token
+        service_name (str): GSSAPI service name
+        state: server context kept from the previous leg, or None
+        gss: the kerberos module, or a proxy of it such as `_TimedKerberos`
+
+    Returns:
+        tuple of
+        (str | None) username, once the negotiation completed
+        (str | None) GSSAPI token
+        server context when the negotiation continues, or None. The caller
+        then owns the context and must clean it.
+
+    Raises:
+        VerificationUnavailable: when the server context cannot be created
+    '''
+    keep = False
 
     try:
-        rc, state = kerberos.authGSSServerInit(service_name)
-        if rc != kerberos.AUTH_GSS_COMPLETE:
-            log.warn('Unable to initialize server context')
-            return None, None
-        rc = kerberos.authGSSServerStep(state, token)
-        if rc == kerberos.AUTH_GSS_COMPLETE:
+        if state is None:
+            try:
+                rc, state = gss.authGSSServerInit(service_name)
+            except gss.GSSError:
+                log.warn('Unable to initialize server context', exc_info=True)
+                raise VerificationUnavailable()
+            if rc != gss.AUTH_GSS_COMPLETE:
+                log.warn('Unable to initialize server context')
+                raise VerificationUnavailable()
+        rc = gss.authGSSServerStep(state, token)
+        if rc == gss.AUTH_GSS_COMPLETE:
             log.debug('Completed GSSAPI negotiation')
             return (
-                kerberos.authGSSServerUserName(state),
-                kerberos.authGSSServerResponse(state),
+                gss.authGSSServerUserName(state),
+                gss.authGSSServerResponse(state),
+                None,
             )
-        elif rc == kerberos.AUTH_GSS_CONTINUE:
+        elif rc == gss.AUTH_GSS_CONTINUE:
             log.debug('Continuing GSSAPI negotiation')
-            return kerberos.AUTH_GSS_CONTINUE
+            keep = True
+            return None, gss.authGSSServerResponse(state), state
         else:
             log.info('Unable to step server context')
-            return None, None
-    except kerberos.GSSError:
+            return None, None, None
+    except gss.GSSError:
         log.info('Unable to authenticate', exc_info=True)
-        return None, None
+        keep = False
+        return None, None, None
     finally:
-        if state:
-            kerberos.authGSSServerClean(state)
+        if state and not keep:
+            gss.authGSSServerClean(state)
+
+
+#: pykerberos functions timed by `_TimedKerberos`, and their phase names
+GSSAPI_PHASES = {
+    'authGSSServerInit': 'init',
+    'authGSSServerStep': 'step',
+    'authGSSServerUserName': 'username',
+    'authGSSServerResponse': 'response',
+    'authGSSServerClean': 'clean',
+}
+
+
+class _TimedKerberos(object):
+    '''
+    Stands in for the kerberos module, recording the duration of each GSSAPI
+    call in `timings`. Only used when timing is enabled, so disabled timing
+    costs nothing on the hot path.
+    '''
+
+    def __init__(self, timings):
+        self._timings = timings
+
+    def __getattr__(self, name):
+        attr = getattr(kerberos, name)
+        phase = GSSAPI_PHASES.get(name)
+        if phase is None:
+            return attr
+        observe = self._timings.histograms[phase].observe
+
+        def timed(*args):
+            start = _monotonic()
+            try:
+                return attr(*args)
+            finally:
+                observe(_monotonic() - start)
+        return timed
 
 
 def default_save_callback(user):
     pass
 
 
+def _is_authenticated(user):
+    '''
+    Returns whether a flask-login user is authenticated, on both the old
+    (method) and new (property) flask-login APIs
+    '''
+    authenticated = getattr(user, 'is_authenticated', False)
+    if callable(authenticated):
+        authenticated = authenticated()
+    return bool(authenticated)
+
+
+def kerberos_required(view):
+    '''
+    Decorates a view so that Kerberos authentication runs only when that view
+    is dispatched. Responds 401 with a Negotiate challenge when the request
+    does not end up with an authenticated flask-login user.
+    '''
+    @functools.wraps(view)
+    def decorated(*args, **kwargs):
+        current_app.kerberos_manager.extract_token()
+        if not _is_authenticated(flask_login.current_user):
+            abort(401)
+        return view(*args, **kwargs)
+    return decorated
+
+
+#: Cookie identifying a multi-leg negotiation, with KRB5_CONTEXT_KEY 'cookie'
+NEGOTIATION_COOKIE = 'krb5_negotiation'
+
+#: WSGI environ keys set by KerberosMiddleware and the manager
+ENVIRON_PRINCIPAL = 'kerberos.principal'
+ENVIRON_TOKEN = 'kerberos.token'
+ENVIRON_NEGOTIATION = 'kerberos.negotiation'
+
+#: Session key holding the principal that completed the last handshake
+SESSION_PRINCIPAL_KEY = '_kerberos_principal'
+
+
 class KerberosLoginManager(object):
 
     def __init__(self, app=None):
         self._save_user = default_save_callback
+        self._persist_users = None
+        self._writer = None
         self._service_name = None
+        self._session_fast_path = False
+        self._auth_cookie = None
+        self._proxy = None
+        self._token_cache = None
+        self._replay = None
+        self._negative_cache = None
+        self._limiter = None
+        self._user_cache = None
+        self._mapper = None
+        self._acceptor = None
+        self._keytab_watcher = None
+        self._engine = None
+        self._sidecar = None
+        self._sidecar_fallback = True
+        self._saved_rcache_type = None
+        self._contexts = None
+        self._context_key = 'connection'
+        self._policy = None
+        self._prevalidate = False
+        self._max_token_length = None
+        self._timings = None
+        self._gss = kerberos
+        self._async_workers = 4
+        self.async_authenticator = None
+        self._counters = Counters()
         self.app = app
 
         if app is not None:
@@ -74,34 +277,371 @@ class KerberosLoginManager(object):
     def save_user(self, callback):
         '''
         This sets the callback for saving a user that has been loaded from a
-        kerberos ticket.
+        kerberos ticket. It receives the principal, or the local name when
+        KRB5_AUTH_TO_LOCAL rules are configured.
+
+        With KRB5_USER_CACHE enabled, a callback that returns the user object
+        is skipped for principals it resolved recently; the cached user is
+        then logged in with `flask_login.login_user`.
         '''
         self._save_user = callback
         return callback
 
 
+    def persist_users(self, callback):
+        '''
+        This sets the callback persisting users in batches, called from a
+        background thread with a list of principals when KRB5_WRITE_BEHIND
+        is enabled. The `save_user` callback should then only build the user
+        in memory and log it in.
+        '''
+        self._persist_users = callback
+        return callback
+
+
+    def flush_users(self):
+        '''
+        Persists the principals queued by write-behind mode now. Also runs
+        when the interpreter exits.
+        '''
+        if self._writer is not None:
+            self._writer.flush()
+
+
+    def invalidate_user(self, principal):
+        '''
+        Forgets the cached user of `principal`, e.g. after its roles changed
+        '''
+        if self._user_cache is not None:
+            self._user_cache.invalidate(principal)
+
+
+    def invalidate_users(self):
+        '''
+        Forgets all cached users
+        '''
+        if self._user_cache is not None:
+            self._user_cache.clear()
+
+
     def init_app(self, app):
         '''
         Initializes the extension with the application object
         '''
         self.app = app
         app.kerberos_manager = self
-        app.before_request(self.extract_token)
-        app.after_request(self.append_header)
         self.init_config(app.config)
+        # Without the global hook, authentication only runs for views that
+        # use `kerberos_required` or blueprints passed to `init_blueprint`.
+        if app.config.setdefault('KRB5_GLOBAL_HOOK', True):
+            app.before_request(self.extract_token)
+        app.after_request(self.append_header)
+
+
+    def init_blueprint(self, blueprint):
+        '''
+        Authenticates every request dispatched to `blueprint`. Useful with
+        KRB5_GLOBAL_HOOK disabled.
+        '''
+        blueprint.before_request(self.extract_token)
 
 
     def init_config(self, config):
-        service = config.setdefault('KRB5_SERVICE_NAME', b'HTTP')
+        service = config.setdefault('KRB5_SERVICE_NAME', 'HTTP')
         hostname = config.setdefault('KRB5_HOSTNAME', socket.gethostname())
-        self._service_name = b'{}@{}'.format(service, hostname)
+        self._service_name = '{}@{}'.format(service, hostname)
 
-        try:
-            principal = kerberos.getServerPrincipalDetails(service, hostname)
-        except kerberos.KrbError:
-            log.warn("Error initializing Kerberos for %s", self._service_name, exc_info=True)
+        # Trusted front-end proxy mode: a proxy terminates GSSAPI and passes
+        # the principal in KRB5_PROXY_HEADER, honored from KRB5_TRUSTED_PROXIES
+        # or with a valid KRB5_PROXY_SECRET signature. No handshake happens
+        # in this process, and the kerberos module is never imported.
+        config.setdefault('KRB5_TRUSTED_PROXY', False)
+        config.setdefault('KRB5_PROXY_HEADER', 'X-Remote-User')
+        config.setdefault('KRB5_TRUSTED_PROXIES', ())
+        config.setdefault('KRB5_PROXY_SECRET', None)
+        config.setdefault('KRB5_PROXY_SIGNATURE_HEADER', 'X-Remote-User-Signature')
+        if config['KRB5_TRUSTED_PROXY']:
+            self._proxy = TrustedProxy(
+                config['KRB5_PROXY_HEADER'],
+                proxies=config['KRB5_TRUSTED_PROXIES'],
+                secret=config['KRB5_PROXY_SECRET'],
+                signature_header=config['KRB5_PROXY_SIGNATURE_HEADER'],
+                max_age=config.get('KRB5_CLOCK_SKEW', 300),
+            )
+        else:
+            self._proxy = None
+
+        # Digests of recently rejected tokens, answered with 403 without a
+        # handshake, and per remote address buckets of allowed failures:
+        # clients failing faster than KRB5_FAILURE_RATE per second, beyond a
+        # burst of KRB5_FAILURE_BURST, get 429 until their bucket refills.
+        config.setdefault('KRB5_NEGATIVE_CACHE', False)
+        config.setdefault('KRB5_NEGATIVE_CACHE_SIZE', 10000)
+        config.setdefault('KRB5_NEGATIVE_CACHE_TTL', 60)
+        rate = config.setdefault('KRB5_FAILURE_RATE', None)
+        config.setdefault('KRB5_FAILURE_BURST', 10)
+        config.setdefault('KRB5_FAILURE_MAX_CLIENTS', 10000)
+        if config['KRB5_NEGATIVE_CACHE']:
+            self._negative_cache = TTLCache(
+                config['KRB5_NEGATIVE_CACHE_SIZE'], ttl=config['KRB5_NEGATIVE_CACHE_TTL'])
+        else:
+            self._negative_cache = None
+        if rate:
+            self._limiter = TokenBucketLimiter(
+                rate, config['KRB5_FAILURE_BURST'], config['KRB5_FAILURE_MAX_CLIENTS'])
+        else:
+            self._limiter = None
+
+        # Users returned by the save_user callback, keyed by principal
+        config.setdefault('KRB5_USER_CACHE', False)
+        config.setdefault('KRB5_USER_CACHE_SIZE', 4096)
+        config.setdefault('KRB5_USER_CACHE_TTL', 300)
+        if config['KRB5_USER_CACHE']:
+            self._user_cache = TTLCache(
+                config['KRB5_USER_CACHE_SIZE'], ttl=config['KRB5_USER_CACHE_TTL'])
+        else:
+            self._user_cache = None
+
+        # Hand principals to the persist_users callback from a background
+        # thread, in batches, instead of persisting them inside the request
+        config.setdefault('KRB5_WRITE_BEHIND', False)
+        config.setdefault('KRB5_WRITE_BEHIND_INTERVAL', 1.0)
+        config.setdefault('KRB5_WRITE_BEHIND_BATCH', 500)
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if config['KRB5_WRITE_BEHIND']:
+            self._writer = WriteBehindQueue(
+                self._flush_users,
+                interval=config['KRB5_WRITE_BEHIND_INTERVAL'],
+                max_batch=config['KRB5_WRITE_BEHIND_BATCH'],
+            )
+            atexit.register(self._writer.close)
+
+        # 'pykerberos' acquires acceptor credentials on every request;
+        # 'gssapi' acquires them once and reuses them until they expire or
+        # the keytab changes.
+        backend = config.setdefault('KRB5_GSSAPI_BACKEND', 'pykerberos')
+        keytab = config.setdefault('KRB5_KEYTAB', None)
+        # Seconds between background keytab checks, None to disable the
+        # watcher, and how long the previous key version stays accepted.
+        watch_interval = config.setdefault('KRB5_KEYTAB_WATCH_INTERVAL', None)
+        overlap = config.setdefault('KRB5_KEYTAB_OVERLAP', 36000)
+        if backend not in ('gssapi', 'pykerberos'):
+            raise ValueError('Invalid KRB5_GSSAPI_BACKEND: {!r}'.format(backend))
+        if watch_interval and backend != 'gssapi':
+            raise ValueError('KRB5_KEYTAB_WATCH_INTERVAL requires the gssapi backend')
+
+        if self._keytab_watcher is not None:
+            self._keytab_watcher.stop()
+            self._keytab_watcher = None
+        if backend == 'gssapi':
+            # Imports python-gssapi, and with it libkrb5
+            from flask_kerberos_login.acceptor import AcceptorCredentials
+            from flask_kerberos_login.acceptor import KeytabWatcher
+            from flask_kerberos_login.acceptor import keytab_path
+        if backend == 'gssapi' and watch_interval:
+            if keytab_path(keytab) is None:
+                raise ValueError('KRB5_KEYTAB_WATCH_INTERVAL requires KRB5_KEYTAB or '
+                                 'KRB5_KTNAME to name a keytab file')
+            self._acceptor = AcceptorCredentials(
+                self._service_name, keytab, check_interval=None, overlap=overlap)
+            self._keytab_watcher = KeytabWatcher(self._acceptor, watch_interval)
+        elif backend == 'gssapi':
+            self._acceptor = AcceptorCredentials(self._service_name, keytab)
+        else:
+            self._acceptor = None
+
+        # False disables the fast path; 'session' skips the handshake for any
+        # authenticated flask-login session; 'principal' (or True) only skips
+        # it when the session was established by a Kerberos handshake.
+        fast_path = config.setdefault('KRB5_SESSION_FAST_PATH', False)
+        if fast_path is True:
+            fast_path = 'principal'
+        if fast_path not in (False, None, 'session', 'principal'):
+            raise ValueError('Invalid KRB5_SESSION_FAST_PATH: {!r}'.format(fast_path))
+        self._session_fast_path = fast_path or False
+
+        # Verify tokens on a pool of worker processes when KRB5_VERIFY_PROCESSES
+        # is set, see flask_kerberos_login.engine
+        processes = config.setdefault('KRB5_VERIFY_PROCESSES', 0)
+        if self._engine is not None:
+            self._engine.shutdown()
+            self._engine = None
+        if processes:
+            if sys.version_info < (3, 7):
+                raise ValueError('KRB5_VERIFY_PROCESSES requires Python 3.7 or later')
+            from flask_kerberos_login.engine import VerificationEngine
+            self._engine = VerificationEngine(
+                self._service_name,
+                processes,
+                backend=backend,
+                keytab=keytab,
+                max_pending=config.setdefault('KRB5_VERIFY_MAX_PENDING', None),
+                batch_size=config.setdefault('KRB5_VERIFY_BATCH_SIZE', 8),
+                batch_window=config.setdefault('KRB5_VERIFY_BATCH_WINDOW', 0.001),
+                timeout=config.setdefault('KRB5_VERIFY_TIMEOUT', 10),
+            )
+
+        # Verify tokens in the host's sidecar, see flask_kerberos_login.sidecar.
+        # When it is unreachable, tokens are verified in-process unless
+        # KRB5_SIDECAR_FALLBACK is disabled.
+        sidecar = config.setdefault('KRB5_SIDECAR_SOCKET', None)
+        config.setdefault('KRB5_SIDECAR_POOL', 4)
+        config.setdefault('KRB5_SIDECAR_TIMEOUT', 5)
+        config.setdefault('KRB5_SIDECAR_RETRY_INTERVAL', 5)
+        self._sidecar_fallback = config.setdefault('KRB5_SIDECAR_FALLBACK', True)
+        if self._sidecar is not None:
+            self._sidecar.close()
+            self._sidecar = None
+        if sidecar:
+            self._sidecar = SidecarClient(
+                sidecar,
+                pool_size=config['KRB5_SIDECAR_POOL'],
+                timeout=config['KRB5_SIDECAR_TIMEOUT'],
+                retry_interval=config['KRB5_SIDECAR_RETRY_INTERVAL'],
+            )
+
+        # Keep server contexts between the legs of multi-round negotiations,
+        # keyed by client connection or by a negotiation cookie
+        config.setdefault('KRB5_CONTEXT_TABLE', False)
+        config.setdefault('KRB5_CONTEXT_TABLE_SIZE', 1024)
+        config.setdefault('KRB5_CONTEXT_TTL', 30)
+        self._context_key = config.setdefault('KRB5_CONTEXT_KEY', 'connection')
+        if self._context_key not in ('connection', 'cookie'):
+            raise ValueError('Invalid KRB5_CONTEXT_KEY: {!r}'.format(self._context_key))
+        if self._contexts is not None:
+            self._contexts.clear()
+        if config['KRB5_CONTEXT_TABLE']:
+            if backend != 'pykerberos' or processes or sidecar:
+                raise ValueError('KRB5_CONTEXT_TABLE requires the in-process pykerberos backend')
+            self._contexts = ContextTable(
+                lambda state: kerberos.authGSSServerClean(state),
+                max_contexts=config['KRB5_CONTEXT_TABLE_SIZE'],
+                ttl=config['KRB5_CONTEXT_TTL'],
+            )
+        else:
+            self._contexts = None
+
+        # Per-phase GSSAPI latency histograms; 'total' covers every backend
+        if config.setdefault('KRB5_TIMINGS', False):
+            self._timings = Timings(list(GSSAPI_PHASES.values()) + ['total'])
+            self._gss = _TimedKerberos(self._timings)
         else:
-            log.info("Server principal is %s", principal)
+            self._timings = None
+            self._gss = kerberos
+
+        # Threads running GSSAPI calls for async views, see flask_kerberos_login.aio
+        self._async_workers = config.setdefault('KRB5_ASYNC_WORKERS', 4)
+
+        # Reject malformed tokens (403) and re-challenge NTLM or empty tokens
+        # (401) before they reach libkrb5, see flask_kerberos_login.prevalidate
+        self._prevalidate = config.setdefault('KRB5_PREVALIDATE', False)
+        self._max_token_length = config.setdefault('KRB5_MAX_TOKEN_LENGTH', 65536)
+
+        # Only consulted when some policy is configured, so the default
+        # behaviour pays nothing for it.
+        self._policy = PolicyTable.from_config(config) or None
+
+        # Verified-token cache, off by default. Entries never outlive the
+        # clock skew, the window in which libkrb5 accepts an authenticator.
+        skew = config.setdefault('KRB5_CLOCK_SKEW', 300)
+        config.setdefault('KRB5_TOKEN_CACHE', False)
+        config.setdefault('KRB5_TOKEN_CACHE_SIZE', 1024)
+        config.setdefault('KRB5_TOKEN_CACHE_MAX_BYTES', 4 * 1024 * 1024)
+        config.setdefault('KRB5_TOKEN_CACHE_TTL', 60)
+        if config['KRB5_TOKEN_CACHE']:
+            self._token_cache = TokenCache(
+                config['KRB5_TOKEN_CACHE_SIZE'],
+                ttl=min(config['KRB5_TOKEN_CACHE_TTL'], skew),
+                max_bytes=config['KRB5_TOKEN_CACHE_MAX_BYTES'],
+            )
+        else:
+            self._token_cache = None
+
+        # KRB5_DISABLE_RCACHE turns off the libkrb5 replay cache, whose
+        # synchronous writes serialize the workers of a host, and
+        # KRB5_REPLAY_DETECTOR ('sets' or 'bloom') replaces it in memory, see
+        # flask_kerberos_login.replay. The token cache, when enabled, still
+        # answers repeated tokens within its time-to-live. libkrb5 reads the
+        # setting from the environment, so it applies to the whole process;
+        # the previous value is restored when the option is turned off.
+        # The sidecar has its own --disable-rcache option.
+        self._disable_rcache(config.setdefault('KRB5_DISABLE_RCACHE', False))
+        if config['KRB5_DISABLE_RCACHE'] and sidecar:
+            log.info('KRB5_DISABLE_RCACHE does not apply to the sidecar, '
+                     'start it with --disable-rcache')
+        detector = config.setdefault('KRB5_REPLAY_DETECTOR', False)
+        config.setdefault('KRB5_REPLAY_CAPACITY', 100000)
+        config.setdefault('KRB5_REPLAY_ERROR_RATE', 1e-6)
+        config.setdefault('KRB5_REPLAY_FILE', None)
+        if self._replay is not None:
+            self._replay.close()
+        if detector == 'sets':
+            self._replay = ReplayDetector(skew)
+        elif detector == 'bloom':
+            self._replay = BloomReplayDetector(
+                skew,
+                capacity=config['KRB5_REPLAY_CAPACITY'],
+                error_rate=config['KRB5_REPLAY_ERROR_RATE'],
+                path=config['KRB5_REPLAY_FILE'],
+            )
+        elif detector:
+            raise ValueError('Invalid KRB5_REPLAY_DETECTOR: {!r}'.format(detector))
+        else:
+            self._replay = None
+            if config['KRB5_DISABLE_RCACHE']:
+                log.warn('KRB5_DISABLE_RCACHE without KRB5_REPLAY_DETECTOR '
+                         'accepts replayed authenticators')
+
+        # Signed cookie carrying the principal, verified with one HMAC
+        # instead of a handshake. The first of KRB5_AUTH_COOKIE_KEYS signs,
+        # all of them verify. pykerberos does not expose the ticket end
+        # time, so keep KRB5_AUTH_COOKIE_MAX_AGE below the ticket lifetime.
+        config.setdefault('KRB5_AUTH_COOKIE', False)
+        config.setdefault('KRB5_AUTH_COOKIE_KEYS', None)
+        config.setdefault('KRB5_AUTH_COOKIE_NAME', 'krb5_auth')
+        config.setdefault('KRB5_AUTH_COOKIE_MAX_AGE', 3600)
+        config.setdefault('KRB5_AUTH_COOKIE_SECURE', True)
+        if config['KRB5_AUTH_COOKIE']:
+            if not config['KRB5_AUTH_COOKIE_KEYS']:
+                raise ValueError('KRB5_AUTH_COOKIE requires KRB5_AUTH_COOKIE_KEYS')
+            self._auth_cookie = AuthCookie(
+                config['KRB5_AUTH_COOKIE_KEYS'],
+                name=config['KRB5_AUTH_COOKIE_NAME'],
+                max_age=config['KRB5_AUTH_COOKIE_MAX_AGE'],
+                clock_skew=skew,
+                secure=config['KRB5_AUTH_COOKIE_SECURE'],
+            )
+        else:
+            self._auth_cookie = None
+
+        # Behind a proxy or a sidecar, workers never read the keytab
+        principal = None
+        if self._proxy is None and self._sidecar is None:
+            try:
+                principal = kerberos.getServerPrincipalDetails(service, hostname)
+            except kerberos.KrbError:
+                log.warn("Error initializing Kerberos for %s", self._service_name, exc_info=True)
+            else:
+                log.info("Server principal is %s", principal)
+
+        # auth_to_local rules, see flask_kerberos_login.mapping. When set, the
+        # save_user callback receives the local name instead of the principal.
+        # The DEFAULT rule applies to KRB5_LOCAL_REALMS, by default the realm
+        # of the server principal. Without either it would map every realm.
+        rules = config.setdefault('KRB5_AUTH_TO_LOCAL', None)
+        local_realms = config.setdefault('KRB5_LOCAL_REALMS', None)
+        if local_realms is None and principal:
+            local_realms = [split_principal(principal)[1]]
+        if rules:
+            self._mapper = PrincipalMapper(rules, local_realms)
+            if local_realms is None and any(rule.default for rule in self._mapper.rules):
+                raise ValueError(
+                    'The DEFAULT auth_to_local rule requires KRB5_LOCAL_REALMS '
+                    'when the server realm is unknown')
+        else:
+            self._mapper = None
 
 
     def extract_token(self):
@@ -109,19 +649,408 @@ class KerberosLoginManager(object):
         Extracts a token from the current HTTP request if it is available.
 
         Invokes the `save_user` callback if authentication is successful.
+        Runs at most once per request, whichever hooks call it.
         '''
-        header = request.headers.get(b'authorization')
-        if header and header.startswith(b'Negotiate '):
-            token = header[10:]
-            user, token = _gssapi_authenticate(token, self._service_name)
-            if token is not None:
-                stack.top.kerberos_token = token
+        token = self._request_token()
+        if token is not None:
+            self._complete(*self._authenticate(
+                token, request.remote_addr, self._negotiation_key(request.environ)))
 
-            if user is not None:
-                self._save_user(user)
+
+    def _disable_rcache(self, disable):
+        '''
+        Sets KRB5RCACHETYPE to 'none' when `disable` is true, remembering the
+        value it replaces, or restores that value
+        '''
+        if disable:
+            if self._saved_rcache_type is None:
+                self._saved_rcache_type = (os.environ.get('KRB5RCACHETYPE'),)
+            os.environ['KRB5RCACHETYPE'] = 'none'
+        elif self._saved_rcache_type is not None:
+            previous, = self._saved_rcache_type
+            if previous is None:
+                os.environ.pop('KRB5RCACHETYPE', None)
             else:
-                # Invalid Kerberos ticket, we could not complete authentication
+                os.environ['KRB5RCACHETYPE'] = previous
+            self._saved_rcache_type = None
+
+
+    def _negotiation_key(self, environ):
+        '''
+        Returns the key under which the negotiation context of the request
+        described by `environ` is kept between legs, when the context table
+        is enabled. A new negotiation cookie is stored in `environ` to be
+        sent with the response. Returns None when the connection cannot be
+        told apart from others, in which case no context is kept.
+        '''
+        if self._contexts is None:
+            return None
+        if self._context_key == 'cookie':
+            key = parse_cookie(environ).get(NEGOTIATION_COOKIE)
+            if not key:
+                key = environ[ENVIRON_NEGOTIATION] = new_negotiation_id()
+            return key
+        port = environ.get('REMOTE_PORT')
+        if not port:
+            return None
+        return '{}:{}'.format(environ.get('REMOTE_ADDR'), port)
+
+
+    def _check_token(self, token):
+        '''
+        Pre-validates a token when KRB5_PREVALIDATE is enabled, aborting
+        with 401 for clients that cannot do Kerberos and 403 for malformed
+        tokens. Tokens that are not even ASCII are always refused.
+        '''
+        try:
+            token.encode('ascii')
+        except UnicodeError:
+            self._counters.incr('rejected_not_base64')
+            self._counters.incr('forbidden')
+            abort(403)
+        if not self._prevalidate:
+            return
+        verdict, reason = inspect_token(token, self._max_token_length)
+        if verdict != VALID:
+            log.debug('Rejected %s Negotiate token', reason)
+            self._counters.incr('rejected_{}'.format(reason))
+            if verdict == UNSUPPORTED:
+                abort(401)
+            self._counters.incr('forbidden')
+            abort(403)
+
+
+    def _request_token(self):
+        '''
+        Returns the GSSAPI token of the current request when a handshake is
+        needed, or None. Aborts with 401 when the route requires
+        authentication and the client did not attempt it.
+
+        Shared by the synchronous and asynchronous paths, it completes
+        requests already authenticated by KerberosMiddleware itself.
+        '''
+        ctx = stack.top
+        if getattr(ctx, 'kerberos_checked', False):
+            return None
+        ctx.kerberos_checked = True
+
+        principal = request.environ.get(ENVIRON_PRINCIPAL)
+        if principal is not None:
+            # KerberosMiddleware also sends the GSSAPI token back
+            self._complete(principal, None)
+            return None
+
+        policy = None
+        if self._policy is not None:
+            policy = self._policy.lookup(request.endpoint, request.blueprint, request.path)
+            if policy == EXEMPT:
+                return None
+
+        if self._auth_cookie is not None:
+            principal = self._auth_cookie.verify(request.cookies.get(self._auth_cookie.name))
+            if principal is not None:
+                self._counters.incr('handshakes_avoided')
+                ctx.kerberos_principal = principal
+                self._resolve_user(principal)
+                return None
+
+        if self._proxy is not None:
+            principal = self._proxy.principal(request.environ)
+            if principal is not None:
+                ctx.kerberos_principal = principal
+                self._resolve_user(principal)
+            elif policy == REQUIRED and not _is_authenticated(flask_login.current_user):
+                abort(401)
+            return None
+
+        header = request.headers.get('Authorization')
+        if header and header.startswith('Negotiate '):
+            if self._session_fast_path and self._has_session():
+                self._counters.incr('handshakes_avoided')
+                return None
+            token = header[10:]
+            self._check_token(token)
+            return token
+        elif policy == REQUIRED and not _is_authenticated(flask_login.current_user):
+            abort(401)
+        return None
+
+
+    def _complete(self, user, token):
+        '''
+        Records the outcome of a handshake for the current request
+        '''
+        if token is not None:
+            stack.top.kerberos_token = token
+
+        if user is None and token is not None:
+            # The negotiation continues, challenge again with our token
+            abort(401)
+        elif user is not None:
+            stack.top.kerberos_principal = user
+            if self._session_fast_path:
+                session[SESSION_PRINCIPAL_KEY] = user
+            if self._auth_cookie is not None:
+                stack.top.kerberos_auth_cookie = self._auth_cookie.issue(user)
+            self._resolve_user(user)
+        else:
+            # Invalid Kerberos ticket, we could not complete authentication
+            self._counters.incr('forbidden')
+            abort(403)
+
+
+    def _resolve_user(self, principal):
+        '''
+        Invokes the `save_user` callback, unless the user cache holds a user
+        recently returned for `principal`
+        '''
+        if self._mapper is not None:
+            local = self._mapper.map(principal)
+            if local is None:
+                log.info('No auth_to_local rule maps %s', principal)
+                self._counters.incr('unmapped')
+                self._counters.incr('forbidden')
                 abort(403)
+            principal = local
+
+        cache = self._user_cache
+        if cache is not None:
+            user = cache.get(principal)
+            if user is not None:
+                flask_login.login_user(user)
+                return user
+
+        user = self._save_user(principal)
+        if self._writer is not None:
+            self._writer.submit(principal)
+        if cache is not None and user is not None:
+            cache.set(principal, user)
+        return user
+
+
+    def _flush_users(self, principals):
+        if self._persist_users is None:
+            log.warn('KRB5_WRITE_BEHIND is enabled without a persist_users callback')
+            return
+        self._persist_users(principals)
+
+
+    def _authenticate(self, token, client=None, negotiation=None):
+        '''
+        Authenticates a GSSAPI token, consulting the verified-token and
+        negative caches first when they are enabled.
+
+        Aborts with 429 when `client`, the remote address, sent too many
+        invalid tokens recently. `negotiation` keys the server context kept
+        between legs when the context table is enabled.
+
+        Returns:
+            tuple of
+            (str | None) username
+            (str | None) GSSAPI token; without a username, the negotiation
+            continues and the token must be sent back with a 401
+        '''
+        cache = self._token_cache
+        negative_cache = self._negative_cache
+        if cache is not None or negative_cache is not None:
+            digest = token_digest(token)
+        if cache is not None:
+            result = cache.get(digest)
+            if result is not None:
+                return result
+        if negative_cache is not None and negative_cache.get(digest):
+            return None, None
+        limiter = self._limiter
+        if limiter is not None and not limiter.allow(client):
+            abort(429)
+
+        self._counters.incr('handshakes')
+        timings = self._timings
+        if timings is not None:
+            start = _monotonic()
+        try:
+            result = self._verify(token, negotiation)
+        except VerificationUnavailable:
+            # Not the client's fault: neither cached nor charged to it
+            self._counters.incr('handshakes_unavailable')
+            raise
+        if timings is not None:
+            timings.observe('total', _monotonic() - start)
+
+        if (result[0] is not None and self._replay is not None and
+                self._replay.check(authenticator_digest(token))):
+            log.warn('Replayed authenticator for %s from %s', result[0], client)
+            self._counters.incr('replays')
+            result = None, None
+
+        if result[0] is None and result[1] is not None:
+            self._counters.incr('handshakes_continued')
+            return result
+        if result[0] is None:
+            self._counters.incr('handshakes_failed')
+            if negative_cache is not None:
+                negative_cache.set(digest, True)
+            if limiter is not None:
+                limiter.failure(client)
+            return result
+        self._counters.incr('handshakes_completed')
+        if cache is not None:
+            cache.set(digest, result)
+        return result
+
+
+    def _verify(self, token, negotiation):
+        '''
+        Runs the handshake for `token` on the configured backend
+        '''
+        if self._engine is not None:
+            return self._engine.verify(token)
+        elif self._sidecar is not None:
+            return self._sidecar_authenticate(token)
+        elif self._contexts is not None and negotiation is not None:
+            if is_initial_token(token):
+                # The client starts over, e.g. after an abandoned negotiation:
+                # stepping the old context with this token would fail it
+                self._contexts.discard(negotiation)
+            user, response, state = _gssapi_step(
+                token, self._service_name, self._contexts.take(negotiation), self._gss)
+            if state is not None:
+                self._contexts.put(negotiation, state)
+            return user, response
+        elif self._acceptor is not None:
+            if self._keytab_watcher is not None:
+                self._keytab_watcher.start()
+            return self._acceptor.authenticate(token)
+        return _gssapi_authenticate(token, self._service_name, self._gss)
+
+
+    def _sidecar_authenticate(self, token):
+        '''
+        Verifies `token` in the sidecar, or in-process when it is unavailable
+        and KRB5_SIDECAR_FALLBACK is enabled. Raises VerificationUnavailable
+        otherwise.
+        '''
+        try:
+            return self._sidecar.authenticate(token)
+        except SidecarUnavailable:
+            if not self._sidecar_fallback:
+                log.warn('Authentication sidecar unavailable', exc_info=True)
+                raise VerificationUnavailable()
+            log.info('Authentication sidecar unavailable, verifying in-process',
+                     exc_info=True)
+            self._counters.incr('sidecar_fallbacks')
+            if self._acceptor is not None:
+                return self._acceptor.authenticate(token)
+            return _gssapi_authenticate(token, self._service_name, self._gss)
+
+
+    def principal(self):
+        '''
+        Returns the Kerberos principal authenticated for the current request,
+        or the one that established the session with KRB5_SESSION_FAST_PATH,
+        or None
+        '''
+        principal = getattr(stack.top, 'kerberos_principal', None)
+        if principal is None and self._session_fast_path:
+            principal = session.get(SESSION_PRINCIPAL_KEY)
+        return principal
+
+
+    def logout(self):
+        '''
+        Forgets the Kerberos principal of the current client: expires the
+        signed auth cookie and drops the principal kept for the session fast
+        path. Call it along with `flask_login.logout_user`, which would
+        otherwise be undone by the next request carrying the cookie.
+        '''
+        stack.top.kerberos_principal = None
+        if self._session_fast_path:
+            session.pop(SESSION_PRINCIPAL_KEY, None)
+        if self._auth_cookie is not None:
+            stack.top.kerberos_auth_cookie = ''
+
+
+    def _has_session(self):
+        '''
+        Returns whether the current request already carries a flask-login
+        session that satisfies the configured fast path
+        '''
+        if self._session_fast_path == 'principal' and not session.get(SESSION_PRINCIPAL_KEY):
+            return False
+        return _is_authenticated(flask_login.current_user)
+
+
+    def stats(self):
+        '''
+        Returns a snapshot of the manager's counters:
+
+        handshakes: GSSAPI handshakes performed, of which
+            handshakes_completed, handshakes_continued, handshakes_failed and
+            handshakes_unavailable, answered 503 because of a server failure
+        challenges: 401 responses carrying a Negotiate challenge
+        forbidden: 403 responses caused by invalid tokens or unmapped
+            principals
+        unmapped: 403 responses for principals no auth_to_local rule maps
+        rejected_<reason>: tokens rejected by KRB5_PREVALIDATE, e.g.
+            rejected_ntlm or rejected_not_base64
+        handshakes_avoided: handshakes skipped thanks to the session fast path
+            or the signed auth cookie
+        auth_cookie: issued, verified, expired and invalid auth cookies, when
+            KRB5_AUTH_COOKIE is enabled
+        proxy: accepted and untrusted principal headers, when
+            KRB5_TRUSTED_PROXY is enabled
+        sidecar: pooled connections, requests and failures, when
+            KRB5_SIDECAR_SOCKET is set
+        sidecar_fallbacks: tokens verified in-process because the sidecar
+            was unavailable
+        replays: completed handshakes refused by KRB5_REPLAY_DETECTOR
+        replay_detector: checked authenticators and, for the Bloom filter,
+            its estimated false positive rate
+        token_cache: hit/miss/eviction statistics, when the cache is enabled
+        negative_cache: hit/miss/eviction statistics, when the cache is enabled
+        limiter: tracked clients and shed requests, when KRB5_FAILURE_RATE is set
+        user_cache: hit/miss/eviction statistics, when the cache is enabled
+        write_behind: queue depth and flush latency, when KRB5_WRITE_BEHIND
+            is enabled
+        keytab_reloads, keytab_last_reload: background keytab reloads and the
+            UNIX time of the last one, when the keytab watcher is enabled
+        timings: latency histograms per GSSAPI phase, when KRB5_TIMINGS is set
+        async: executor queue depth and activity, once async views ran
+        engine: verification engine activity, when KRB5_VERIFY_PROCESSES is set
+        contexts: kept negotiation contexts and their evictions, when
+            KRB5_CONTEXT_TABLE is enabled
+        '''
+        stats = self._counters.snapshot()
+        if self._auth_cookie is not None:
+            stats['auth_cookie'] = self._auth_cookie.stats()
+        if self._proxy is not None:
+            stats['proxy'] = self._proxy.stats()
+        if self._token_cache is not None:
+            stats['token_cache'] = self._token_cache.stats()
+        if self._negative_cache is not None:
+            stats['negative_cache'] = self._negative_cache.stats()
+        if self._limiter is not None:
+            stats['limiter'] = self._limiter.stats()
+        if self._user_cache is not None:
+            stats['user_cache'] = self._user_cache.stats()
+        if self._writer is not None:
+            stats['write_behind'] = self._writer.stats()
+        if self._keytab_watcher is not None:
+            stats['keytab_reloads'] = self._acceptor.reloads
+            stats['keytab_last_reload'] = self._acceptor.last_reload
+        if self._timings is not None:
+            stats['timings'] = self._timings.snapshot()
+        if self.async_authenticator is not None:
+            stats['async'] = self.async_authenticator.stats()
+        if self._engine is not None:
+            stats['engine'] = self._engine.stats()
+        if self._sidecar is not None:
+            stats['sidecar'] = self._sidecar.stats()
+        if self._replay is not None:
+            stats['replay_detector'] = self._replay.stats()
+        if self._contexts is not None:
+            stats['contexts'] = self._contexts.stats()
+        return stats
 
 
     def append_header(self, response):
@@ -131,8 +1060,28 @@ class KerberosLoginManager(object):
         token = getattr(stack.top, 'kerberos_token', None)
         if response.status_code == 401:
             # Negotiate is an additional authenticate method.
-            response.headers.add('WWW-Authenticate', 'Negotiate')
+            self._counters.incr('challenges')
+            if token:
+                # Next leg of a multi-round negotiation
+                response.headers.add('WWW-Authenticate', 'Negotiate {}'.format(token))
+            else:
+                response.headers.add('WWW-Authenticate', 'Negotiate')
         elif token:
             response.headers['WWW-Authenticate'] = 'Negotiate {}'.format(token)
 
+        negotiation = request.environ.get(ENVIRON_NEGOTIATION)
+        if negotiation is not None and response.status_code == 401 and token:
+            response.set_cookie(NEGOTIATION_COOKIE, negotiation, httponly=True)
+
+        auth_cookie = getattr(stack.top, 'kerberos_auth_cookie', None)
+        if auth_cookie == '':
+            # Set by logout()
+            response.set_cookie(
+                self._auth_cookie.name, '', max_age=0, expires=0,
+                httponly=True, secure=self._auth_cookie.secure)
+        elif auth_cookie is not None and response.status_code < 400:
+            response.set_cookie(
+                self._auth_cookie.name, auth_cookie, max_age=self._auth_cookie.max_age,
+                httponly=True, secure=self._auth_cookie.secure)
+
         return response
@@ -0,0 +1,161 @@
+'''
+Maps Kerberos principals to local user names with auth_to_local rules
+
+Rules use the Hadoop `hadoop.security.auth_to_local` syntax::
+
+    RULE:[1:$1@$0](.*@EXAMPLE\\.ORG)s/@.*//
+    RULE:[2:$1](admin)s/^.*$/root/
+    RULE:[1:$1@$0](.*@PARTNER\\.ORG)s/@PARTNER\\.ORG$/_partner/L
+    DEFAULT
+
+`RULE:[n:format]` applies to principals with n components and builds a
+string from `format`, where $0 is the realm and $1..$n the components. The
+rule matches when the optional `(regex)` matches that whole string, which
+is then rewritten by the optional sed-style substitution and lowercased
+with a trailing `/L`. `DEFAULT` maps principals of a local realm to their
+first component. The first matching rule wins.
+'''
+from __future__ import absolute_import, print_function, unicode_literals
+
+import re
+
+from flask_kerberos_login.cache import TTLCache
+
+
+_RULE = re.compile(r'''
+    \s*(?:
+        (?P<default>DEFAULT)
+    |
+        RULE:\[(?P<components>\d+):(?P<format>[^\]]*)\]
+        (?:\((?P<match>[^)]*)\))?
+        (?:s/(?P<pattern>[^/]*)/(?P<replacement>[^/]*)/(?P<global>g)?)?
+    )
+    /?(?P<lower>L)?\s*
+''', re.VERBOSE)
+
+_FORMAT_FIELD = re.compile(r'\$(\d+)')
+_JAVA_GROUP = re.compile(r'\$(\d+)')
+
+
+def split_principal(principal):
+    '''
+    Splits a principal into its components and realm, honoring escapes
+    '''
+    components = []
+    current = []
+    realm = None
+    chars = iter(principal)
+    for char in chars:
+        if char == '\\':
+            current.append(next(chars, ''))
+        elif char == '/' and realm is None:
+            components.append(''.join(current))
+            current = []
+        elif char == '@' and realm is None:
+            components.append(''.join(current))
+            current = []
+            realm = ''
+        else:
+            current.append(char)
+    if realm is None:
+        components.append(''.join(current))
+    else:
+        realm = ''.join(current)
+    return components, realm
+
+
+class Rule(object):
+    '''
+    A single compiled auth_to_local rule
+    '''
+
+    def __init__(self, text):
+        parsed = _RULE.match(text)
+        if parsed is None or parsed.end() != len(text):
+            raise ValueError('Invalid auth_to_local rule: {!r}'.format(text))
+        self.text = text
+        self.default = parsed.group('default') is not None
+        self.lower = parsed.group('lower') is not None
+        if self.default:
+            return
+        self.components = int(parsed.group('components'))
+        self.format = parsed.group('format')
+        match = parsed.group('match')
+        self.match = re.compile(match + r'\Z') if match else None
+        pattern = parsed.group('pattern')
+        self.pattern = re.compile(pattern) if pattern is not None else None
+        # Java replacements refer to groups as $n
+        replacement = parsed.group('replacement') or ''
+        self.replacement = _JAVA_GROUP.sub(r'\\g<\1>', replacement)
+        self.count = 0 if parsed.group('global') else 1
+
+    def apply(self, components, realm, local_realms):
+        '''
+        Returns the local name for a principal, or None if the rule does not
+        apply to it
+        '''
+        if self.default:
+            if local_realms is not None and realm not in local_realms:
+                return None
+            result = components[0]
+        else:
+            if len(components) != self.components:
+                return None
+            try:
+                result = _FORMAT_FIELD.sub(
+                    lambda field: realm if field.group(1) == '0'
+                    else components[int(field.group(1)) - 1],
+                    self.format)
+            except IndexError:
+                return None
+            if self.match is not None and not self.match.match(result):
+                return None
+            if self.pattern is not None:
+                result = self.pattern.sub(self.replacement, result, count=self.count)
+        if self.lower:
+            result = result.lower()
+        if not result or '@' in result or '/' in result:
+            return None
+        return result
+
+
+class PrincipalMapper(object):
+    '''
+    Maps principals to local names with a list of auth_to_local rules,
+    memoizing the result per principal
+
+    Parameters:
+        rules (list | str): rules, or a string with one rule per line
+        local_realms (iterable | None): realms the DEFAULT rule applies to,
+            None to apply it to every realm
+        cache_size (int): principals whose mapping is remembered
+    '''
+
+    def __init__(self, rules, local_realms=None, cache_size=4096):
+        if isinstance(rules, (str, type(''))):
+            rules = rules.splitlines()
+        self.rules = [Rule(rule.strip()) for rule in rules if rule.strip()]
+        self.local_realms = None if local_realms is None else frozenset(local_realms)
+        self._cache = TTLCache(cache_size)
+
+    def map(self, principal):
+        '''
+        Returns the local name of `principal`, or None if no rule matches
+        '''
+        result = self._cache.get(principal)
+        if result is None:
+            result = self._map(principal)
+            # Principals without a mapping are cached as ''
+            self._cache.set(principal, result or '')
+        return result or None
+
+    def _map(self, principal):
+        components, realm = split_principal(principal)
+        for rule in self.rules:
+            result = rule.apply(components, realm, self.local_realms)
+            if result is not None:
+                return result
+        return None
+
+    def stats(self):
+        return self._cache.stats()
@@ -0,0 +1,290 @@
+'''
+Exposes the login manager statistics in the Prometheus text format
+
+Usage::
+
+    from flask_kerberos_login.metrics import metrics_blueprint
+    app.register_blueprint(metrics_blueprint(kerberos_manager))
+
+Under a pre-fork server such as gunicorn every worker keeps its own
+statistics. Pass a `directory` shared by all workers of a host: each worker
+then periodically writes its statistics there, and a scrape served by any
+worker reports the sum over all of them. Counters of workers that exited
+keep counting towards the totals, but their gauges are dropped once their
+process is gone or their file was not refreshed for `max_age` seconds.
+'''
+from __future__ import absolute_import, print_function, unicode_literals
+
+import errno
+import json
+import logging
+import os
+import tempfile
+import time
+
+from flask import Blueprint
+from flask import Response
+
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+#: Statistics that are point-in-time values rather than running totals
+GAUGES = frozenset([
+    'entries',
+    'bytes',
+    'keytab_last_reload',
+    'depth',
+    'running',
+    'workers',
+    'processes',
+    'pending',
+    'clients',
+    'connections',
+    'false_positive_rate',
+])
+
+#: Gauges that are aggregated across workers with max() instead of sum()
+LATEST = frozenset([
+    'keytab_last_reload',
+    'false_positive_rate',
+])
+
+#: Statistics holding histograms, labelled by phase
+HISTOGRAMS = {
+    'timings': 'gssapi_phase_seconds',
+}
+
+
+def merge(stats, other):
+    '''
+    Merges the statistics dictionary `other` into `stats` in place, summing
+    counters, gauges and histograms, except for the LATEST gauges whose
+    maximum is kept
+    '''
+    for key, value in other.items():
+        if key not in stats or stats[key] is None:
+            stats[key] = _copy(value)
+        elif value is None:
+            continue
+        elif isinstance(value, dict):
+            if 'buckets' in value:
+                stats[key] = _merge_histogram(stats[key], value)
+            else:
+                merge(stats[key], value)
+        elif key in LATEST:
+            stats[key] = max(stats[key], value)
+        else:
+            stats[key] += value
+    return stats
+
+
+def strip_gauges(stats):
+    '''
+    Returns a copy of `stats` without its gauges, for a worker that stopped
+    reporting
+    '''
+    stripped = {}
+    for key, value in stats.items():
+        if isinstance(value, dict) and 'buckets' not in value:
+            stripped[key] = strip_gauges(value)
+        elif key not in GAUGES:
+            stripped[key] = value
+    return stripped
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _copy(value):
+    if isinstance(value, dict):
+        return merge({}, value)
+    return value
+
+
+def _merge_histogram(histogram, other):
+    return {
+        'count': histogram['count'] + other['count'],
+        'sum': histogram['sum'] + other['sum'],
+        'buckets': [(bound, count + other_count) for (bound, count), (_, other_count)
+                    in zip(histogram['buckets'], other['buckets'])],
+    }
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return '{}'.format(value)
+
+
+def _is_gauge(name):
+    '''
+    Returns whether the flattened statistic `name`, e.g.
+    replay_detector_false_positive_rate, ends with the name of a gauge
+    '''
+    return any(name == gauge or name.endswith('_' + gauge) for gauge in GAUGES)
+
+
+def _render_value(lines, name, value):
+    if _is_gauge(name):
+        lines.append('# TYPE kerberos_{} gauge'.format(name))
+        lines.append('kerberos_{} {}'.format(name, _format_value(value)))
+    else:
+        lines.append('# TYPE kerberos_{}_total counter'.format(name))
+        lines.append('kerberos_{}_total {}'.format(name, _format_value(value)))
+
+
+def _render_histogram(lines, metric, histogram, labels=''):
+    separator = ',' if labels else ''
+    for bound, count in histogram['buckets']:
+        lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(
+            metric, labels, separator, _format_value(float(bound)), count))
+    labels = '{{{}}}'.format(labels) if labels else ''
+    lines.append('{}_sum{} {}'.format(metric, labels, _format_value(histogram['sum'])))
+    lines.append('{}_count{} {}'.format(metric, labels, histogram['count']))
+
+
+def _render_histograms(lines, name, histograms):
+    metric = 'kerberos_{}'.format(name)
+    lines.append('# TYPE {} histogram'.format(metric))
+    for label in sorted(histograms):
+        _render_histogram(lines, metric, histograms[label], 'phase="{}"'.format(label))
+
+
+def render(stats):
+    '''
+    Renders a statistics dictionary, as returned by
+    `KerberosLoginManager.stats`, in the Prometheus text format
+    '''
+    lines = []
+    for key in sorted(stats):
+        value = stats[key]
+        if value is None:
+            continue
+        if key in HISTOGRAMS:
+            _render_histograms(lines, HISTOGRAMS[key], value)
+        elif isinstance(value, dict):
+            for subkey in sorted(value):
+                name = '{}_{}'.format(key, subkey)
+                if value[subkey] is None:
+                    continue
+                elif isinstance(value[subkey], dict):
+                    # A histogram, e.g. a latency in seconds
+                    metric = 'kerberos_{}'.format(name)
+                    lines.append('# TYPE {} histogram'.format(metric))
+                    _render_histogram(lines, metric, value[subkey])
+                else:
+                    _render_value(lines, name, value[subkey])
+        else:
+            _render_value(lines, key, value)
+    lines.append('')
+    return '\n'.join(lines)
+
+
+class MetricsExporter(object):
+    '''
+    Collects the statistics of a login manager, optionally aggregated over
+    every worker process sharing `directory`
+
+    Parameters:
+        manager (KerberosLoginManager): manager to report on
+        directory (str | None): directory shared by all workers of a host
+        interval (float): minimum seconds between two writes of this worker's
+            statistics to `directory`
+        max_age (float | None): seconds after which the gauges of a worker
+            that did not write its statistics are dropped, by default ten
+            intervals
+    '''
+
+    def __init__(self, manager, directory=None, interval=5, max_age=None):
+        self.manager = manager
+        self.directory = directory
+        self.interval = interval
+        self.max_age = 10 * interval if max_age is None else max_age
+        self._next_flush = 0
+
+    def collect(self):
+        '''
+        Returns the statistics to report
+        '''
+        if self.directory is None:
+            return self.manager.stats()
+        self.flush()
+        stats = {}
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path) as f:
+                    worker = json.load(f)
+                stale = now - os.path.getmtime(path) > self.max_age
+            except (IOError, OSError, ValueError):
+                log.info('Skipping unreadable metrics file %s', name, exc_info=True)
+                continue
+            pid = name[:-len('.json')]
+            if stale or (pid.isdigit() and not _alive(int(pid))):
+                # Totals stay, point-in-time values left with the worker
+                worker = strip_gauges(worker)
+            merge(stats, worker)
+        return stats
+
+    def flush(self):
+        '''
+        Atomically writes this worker's statistics to the shared directory
+        '''
+        self._next_flush = _monotonic() + self.interval
+        path = os.path.join(self.directory, '{}.json'.format(os.getpid()))
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.manager.stats(), f)
+            os.rename(tmp, path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+    def after_request(self, response):
+        if self.directory is not None and _monotonic() >= self._next_flush:
+            try:
+                self.flush()
+            except (IOError, OSError):
+                log.warn('Unable to write metrics to %s', self.directory, exc_info=True)
+        return response
+
+    def view(self):
+        return Response(render(self.collect()), content_type=CONTENT_TYPE)
+
+
+def metrics_blueprint(manager, directory=None, interval=5, url='/metrics',
+                      name='kerberos_metrics', max_age=None):
+    '''
+    Returns a blueprint serving the manager's statistics at `url`
+
+    Parameters:
+        manager (KerberosLoginManager): manager to report on
+        directory (str | None): directory shared by all worker processes of
+            a host, to aggregate their statistics
+        interval (float): minimum seconds between two writes of a worker's
+            statistics to `directory`
+        max_age (float | None): seconds after which the gauges of a worker
+            that did not write its statistics are dropped
+    '''
+    exporter = MetricsExporter(manager, directory, interval, max_age)
+    blueprint = Blueprint(name, __name__)
+    blueprint.add_url_rule(url, 'metrics', exporter.view)
+    blueprint.after_app_request(exporter.after_request)
+    blueprint.exporter = exporter
+    return blueprint
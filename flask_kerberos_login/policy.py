@@ -0,0 +1,95 @@
+'''
+Per-route authentication policies, compiled once for cheap lookups
+'''
+from __future__ import absolute_import, print_function, unicode_literals
+
+
+#: Authenticate, and respond 401 when the request ends up without a user
+REQUIRED = 'required'
+#: Authenticate when the client sends a Negotiate header
+OPTIONAL = 'optional'
+#: Never look at the Authorization header
+EXEMPT = 'exempt'
+
+POLICIES = frozenset([REQUIRED, OPTIONAL, EXEMPT])
+
+
+def _check(policy, what):
+    if policy not in POLICIES:
+        raise ValueError('Invalid policy {!r} for {!r}'.format(policy, what))
+    return policy
+
+
+def _segments(path):
+    return [segment for segment in path.split('/') if segment]
+
+
+class PolicyTable(object):
+    '''
+    Maps endpoint names, blueprint names and URL path prefixes to a policy.
+
+    Endpoint and blueprint names are looked up in dictionaries and path
+    prefixes in a trie of path segments, so a decision never scans the whole
+    table. The most specific match wins: endpoint, then blueprint, then the
+    longest path prefix, then the default.
+
+    Parameters:
+        endpoints (dict | None): endpoint name to policy
+        blueprints (dict | None): blueprint name to policy
+        paths (dict | None): URL path prefix to policy; prefixes match whole
+            path segments, so '/static' matches '/static/app.js' but not
+            '/staticfiles'
+        default (str): policy when nothing matches
+    '''
+
+    def __init__(self, endpoints=None, blueprints=None, paths=None, default=OPTIONAL):
+        self.default = _check(default, 'default')
+        self._endpoints = dict(
+            (name, _check(policy, name)) for name, policy in (endpoints or {}).items())
+        self._blueprints = dict(
+            (name, _check(policy, name)) for name, policy in (blueprints or {}).items())
+        self._paths = {}
+        for prefix, policy in (paths or {}).items():
+            node = self._paths
+            for segment in _segments(prefix):
+                node = node.setdefault(segment, {})
+            node[None] = _check(policy, prefix)
+
+    def __bool__(self):
+        return bool(self._endpoints or self._blueprints or self._paths or
+                    self.default != OPTIONAL)
+    __nonzero__ = __bool__
+
+    def lookup(self, endpoint=None, blueprint=None, path=None):
+        '''
+        Returns the policy for a request
+        '''
+        policy = self._endpoints.get(endpoint)
+        if policy is not None:
+            return policy
+        policy = self._blueprints.get(blueprint)
+        if policy is not None:
+            return policy
+        if self._paths and path:
+            node = self._paths
+            policy = node.get(None)
+            for segment in _segments(path):
+                node = node.get(segment)
+                if node is None:
+                    break
+                policy = node.get(None, policy)
+            if policy is not None:
+                return policy
+        return self.default
+
+    @classmethod
+    def from_config(cls, config):
+        '''
+        Builds a table from the KRB5_POLICY_* configuration keys
+        '''
+        return cls(
+            endpoints=config.setdefault('KRB5_POLICY_ENDPOINTS', {}),
+            blueprints=config.setdefault('KRB5_POLICY_BLUEPRINTS', {}),
+            paths=config.setdefault('KRB5_POLICY_PATHS', {}),
+            default=config.setdefault('KRB5_POLICY_DEFAULT', OPTIONAL),
+        )
@@ -0,0 +1,122 @@
+'''
+Cheap checks of Negotiate tokens before they reach libkrb5
+
+Many failed handshakes come from clients that cannot do Kerberos at all,
+typically Windows clients falling back to NTLM. Their tokens can be told
+apart from Kerberos ones by a few leading bytes, without allocating a GSS
+context.
+'''
+from __future__ import absolute_import, print_function, unicode_literals
+
+import base64
+import binascii
+import re
+
+
+#: The token is acceptable and should go through GSSAPI
+VALID = 'valid'
+#: The token is malformed and should be rejected with 403
+MALFORMED = 'malformed'
+#: The client cannot do Kerberos and should be challenged again with 401
+UNSUPPORTED = 'unsupported'
+
+_BASE64 = re.compile(r'\A[A-Za-z0-9+/]*={0,2}\Z')
+
+# DER encoded mechanism OIDs, including their tag and length
+OID_SPNEGO = b'\x06\x06\x2b\x06\x01\x05\x05\x02'             # 1.3.6.1.5.5.2
+OID_KRB5 = b'\x06\x09\x2a\x86\x48\x86\xf7\x12\x01\x02\x02'   # 1.2.840.113554.1.2.2
+OID_MS_KRB5 = b'\x06\x09\x2a\x86\x48\x82\xf7\x12\x01\x02\x02'  # 1.2.840.48018.1.2.2
+OID_NTLM = b'\x06\x0a\x2b\x06\x01\x04\x01\x82\x37\x02\x02\x0a'  # 1.3.6.1.4.1.311.2.2.10
+
+NTLMSSP_SIGNATURE = b'NTLMSSP\x00'
+
+# Leading bytes of an initial context token: [APPLICATION 0] tag, then a
+# DER length of one to five bytes, then the mechanism OID
+_INITIAL_TOKEN = 0x60
+# SPNEGO NegTokenResp, sent by clients on later legs
+_NEG_TOKEN_RESP = 0xa1
+# How far into a SPNEGO NegTokenInit the mechTypes list is searched
+_MECH_TYPES_WINDOW = 128
+
+
+def _skip_length(data, offset):
+    '''
+    Returns the offset after a DER length field, or None if it is invalid
+    '''
+    if offset >= len(data):
+        return None
+    first = bytearray(data[offset:offset + 1])[0]
+    if first < 0x80:
+        return offset + 1
+    size = first & 0x7f
+    if size == 0 or size > 4:
+        return None
+    return offset + 1 + size
+
+
+def is_initial_token(token):
+    '''
+    Returns whether the base64 Negotiate token `token` opens a new context,
+    a GSSAPI initial context token or SPNEGO NegTokenInit, rather than
+    continuing one
+    '''
+    if not isinstance(token, bytes):
+        token = token.encode('latin-1')
+    try:
+        data = base64.b64decode(token.strip()[:4])
+    except (TypeError, ValueError, binascii.Error):
+        return False
+    return bytearray(data[:1]) == bytearray([_INITIAL_TOKEN])
+
+
+def inspect_token(token, max_length=None):
+    '''
+    Classifies the base64 Negotiate token `token`
+
+    Returns:
+        tuple of
+        (str) VALID, MALFORMED or UNSUPPORTED
+        (str) a short reason, for logging and metrics
+    '''
+    if max_length is not None and len(token) > max_length:
+        return MALFORMED, 'too_long'
+    if not isinstance(token, type('')):
+        token = token.decode('latin-1')
+    token = token.strip()
+    if not token:
+        return UNSUPPORTED, 'empty'
+    if len(token) % 4 or not _BASE64.match(token):
+        return MALFORMED, 'not_base64'
+    try:
+        data = base64.b64decode(token)
+    except (TypeError, ValueError, binascii.Error):
+        return MALFORMED, 'not_base64'
+    if not data:
+        return UNSUPPORTED, 'empty'
+
+    if data.startswith(NTLMSSP_SIGNATURE):
+        return UNSUPPORTED, 'ntlm'
+
+    first = bytearray(data[:1])[0]
+    if first == _NEG_TOKEN_RESP:
+        return VALID, 'spnego_response'
+    if first != _INITIAL_TOKEN:
+        return MALFORMED, 'not_gssapi'
+
+    offset = _skip_length(data, 1)
+    if offset is None:
+        return MALFORMED, 'not_gssapi'
+    mech = data[offset:]
+    if mech.startswith(OID_KRB5) or mech.startswith(OID_MS_KRB5):
+        return VALID, 'kerberos'
+    if not mech.startswith(OID_SPNEGO):
+        return UNSUPPORTED, 'mechanism'
+
+    # SPNEGO NegTokenInit: accept it when Kerberos is among the offered
+    # mechanisms, which come first in the token
+    head = mech[:_MECH_TYPES_WINDOW]
+    if OID_KRB5 in head or OID_MS_KRB5 in head:
+        return VALID, 'spnego'
+    if OID_NTLM in head:
+        return UNSUPPORTED, 'ntlm'
+    return UNSUPPORTED, 'mechanism'
@@ -0,0 +1,151 @@
+'''
+Trusted front-end proxy mode: the principal comes from a request header
+
+When a proxy such as Apache mod_auth_gssapi or nginx with SPNEGO support
+terminates GSSAPI, it passes the authenticated principal in a header. The
+header is only honored from allow-listed peer addresses, or when it comes
+with a valid signature::
+
+    X-Remote-User: user@EXAMPLE.ORG
+    X-Remote-User-Signature: 1700000000:<hex HMAC-SHA256 of "1700000000:user@EXAMPLE.ORG">
+
+The timestamp must be within the clock skew of the server's clock.
+'''
+from __future__ import absolute_import, print_function, unicode_literals
+
+import hashlib
+import hmac
+import logging
+import socket
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+def _address(address):
+    '''
+    Returns (address family, integer value) of an IPv4 or IPv6 address
+    '''
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            packed = socket.inet_pton(family, address)
+        except (socket.error, ValueError):
+            continue
+        return family, int(''.join('{:02x}'.format(b) for b in bytearray(packed)), 16)
+    raise ValueError('Invalid address {!r}'.format(address))
+
+
+def _network(network):
+    '''
+    Returns (address family, prefix value, netmask) of an address or CIDR
+    '''
+    address, _, prefix = network.partition('/')
+    family, value = _address(address.strip())
+    bits = 32 if family == socket.AF_INET else 128
+    prefix = int(prefix) if prefix else bits
+    if not 0 <= prefix <= bits:
+        raise ValueError('Invalid network {!r}'.format(network))
+    mask = ((1 << prefix) - 1) << (bits - prefix)
+    return family, value & mask, mask
+
+
+def _environ_key(header):
+    return 'HTTP_' + header.upper().replace('-', '_')
+
+
+def sign(secret, principal, timestamp=None):
+    '''
+    Returns the signature header value a proxy sends along with `principal`
+    '''
+    timestamp = int(time.time() if timestamp is None else timestamp)
+    if not isinstance(secret, bytes):
+        secret = secret.encode('utf-8')
+    message = '{}:{}'.format(timestamp, principal).encode('utf-8')
+    return '{}:{}'.format(timestamp, hmac.new(secret, message, hashlib.sha256).hexdigest())
+
+
+class TrustedProxy(object):
+    '''
+    Extracts the principal passed by a trusted proxy from a WSGI environ
+
+    Parameters:
+        header (str): header carrying the principal
+        proxies (list): addresses or CIDR networks of the proxies
+        secret (str | None): shared key of signed headers
+        signature_header (str): header carrying the signature
+        max_age (int): seconds a signature stays valid, either way
+    '''
+
+    def __init__(self, header='X-Remote-User', proxies=(), secret=None,
+                 signature_header='X-Remote-User-Signature', max_age=300, clock=time.time):
+        if isinstance(proxies, (bytes, type(''))):
+            proxies = proxies.split(',')
+        self._networks = [_network(network) for network in proxies if network.strip()]
+        if not self._networks and not secret:
+            raise ValueError('A trusted proxy needs proxy addresses or a secret')
+        self.header = header
+        self.signature_header = signature_header
+        self._key = _environ_key(header)
+        self._signature_key = _environ_key(signature_header)
+        self._secret = secret
+        self.max_age = max_age
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.accepted = 0
+        self.untrusted = 0
+
+    def trusted_peer(self, address):
+        '''
+        Returns whether `address` belongs to an allow-listed proxy
+        '''
+        if not self._networks or not address:
+            return False
+        try:
+            family, value = _address(address)
+        except ValueError:
+            return False
+        return any(family == net_family and value & mask == prefix
+                   for net_family, prefix, mask in self._networks)
+
+    def valid_signature(self, principal, signature):
+        '''
+        Returns whether `signature` is a recent signature of `principal`
+        '''
+        if not self._secret or not signature:
+            return False
+        timestamp = signature.split(':', 1)[0]
+        try:
+            if abs(self._clock() - int(timestamp)) > self.max_age:
+                return False
+        except ValueError:
+            return False
+        expected = sign(self._secret, principal, timestamp)
+        try:
+            return hmac.compare_digest(expected, signature)
+        except TypeError:
+            return False
+
+    def principal(self, environ):
+        '''
+        Returns the principal passed by a trusted proxy, or None
+        '''
+        principal = environ.get(self._key)
+        if not principal:
+            return None
+        if not (self.trusted_peer(environ.get('REMOTE_ADDR')) or
+                self.valid_signature(principal, environ.get(self._signature_key))):
+            log.warn('Ignoring %s header from untrusted peer %s',
+                     self.header, environ.get('REMOTE_ADDR'))
+            with self._lock:
+                self.untrusted += 1
+            return None
+        with self._lock:
+            self.accepted += 1
+        return principal
+
+    def stats(self):
+        with self._lock:
+            return {'accepted': self.accepted, 'untrusted': self.untrusted}
@@ -0,0 +1,344 @@
+'''
+In-process replay detection, replacing the libkrb5 replay cache
+
+MIT's default file replay cache writes, and syncs, every accepted
+authenticator to disk, serializing all the processes of a host. With
+KRB5_DISABLE_RCACHE libkrb5 skips it, and one of these detectors remembers
+authenticators instead.
+
+libkrb5 refuses authenticators whose timestamp is more than the clock skew
+away from the server's clock, so an authenticator can only be replayed
+within twice the skew of its first use. Detectors keep digests in buckets
+one skew window wide and forget the oldest bucket as time advances, which
+remembers every digest for two to three windows.
+
+`ReplayDetector` keeps exact sets in the process. `BloomReplayDetector`
+keeps a rotating Bloom filter per bucket, optionally in a file mapped into
+every worker of the host so that a replay sent to another worker is caught
+too. Its false positives (first uses reported as replays) are bounded by
+`error_rate` at `capacity` authenticators per window, and estimated as it
+fills.
+'''
+from __future__ import absolute_import, print_function, unicode_literals
+
+import base64
+import binascii
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from flask_kerberos_login.prevalidate import OID_KRB5
+from flask_kerberos_login.prevalidate import OID_MS_KRB5
+
+
+#: Buckets remembered, each one clock skew window wide
+BUCKETS = 3
+
+# GSSAPI krb5 token id of an AP-REQ, followed by its [APPLICATION 14] tag
+_AP_REQ = b'\x01\x00\x6e'
+
+
+def _element(data, offset):
+    '''
+    Returns (tag, start, end) of the value of the DER element at `offset`
+    '''
+    tag = data[offset]
+    first = data[offset + 1]
+    offset += 2
+    if first < 0x80:
+        length = first
+    else:
+        size = first & 0x7f
+        if not 0 < size <= 4:
+            raise ValueError('Invalid DER length')
+        length = 0
+        for byte in data[offset:offset + size]:
+            length = length << 8 | byte
+        offset += size
+    if offset + length > len(data):
+        raise ValueError('Truncated DER element')
+    return tag, offset, offset + length
+
+
+def _field(data, start, end, tag):
+    '''
+    Returns (start, end) of the value of the element tagged `tag` among
+    the elements between `start` and `end`
+    '''
+    while start < end:
+        element_tag, value_start, value_end = _element(data, start)
+        if element_tag == tag:
+            return value_start, value_end
+        start = value_end
+    raise ValueError('Missing DER field {:#x}'.format(tag))
+
+
+def authenticator_digest(token):
+    '''
+    Returns the SHA-256 digest of the encrypted authenticator in the base64
+    Negotiate token `token`, or of the whole token when it holds no
+    Kerberos AP-REQ
+    '''
+    try:
+        data = base64.b64decode(token)
+    except (TypeError, ValueError, binascii.Error):
+        data = token if isinstance(token, bytes) else token.encode('latin-1')
+    for oid in (OID_KRB5, OID_MS_KRB5):
+        index = data.find(oid + _AP_REQ)
+        if index < 0:
+            continue
+        raw = bytearray(data)
+        try:
+            # AP-REQ ::= [APPLICATION 14] SEQUENCE { ... authenticator [4]
+            # EncryptedData }, EncryptedData ::= SEQUENCE { ... cipher [2] }
+            _, start, end = _element(raw, index + len(oid) + 2)
+            _, start, end = _element(raw, start)
+            start, end = _field(raw, start, end, 0xa4)
+            _, start, end = _element(raw, start)
+            start, end = _field(raw, start, end, 0xa2)
+            _, start, end = _element(raw, start)
+        except (ValueError, IndexError):
+            break
+        return hashlib.sha256(data[start:end]).digest()
+    return hashlib.sha256(data).digest()
+
+
+class ReplayDetector(object):
+    '''
+    Remembers authenticator digests of this process in exact sets
+
+    Parameters:
+        window (int): clock skew, in seconds
+    '''
+
+    def __init__(self, window=300, clock=time.time):
+        self.window = window
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self.checked = 0
+        self.replays = 0
+
+    def check(self, digest):
+        '''
+        Records `digest`, returning whether it was seen before
+        '''
+        bucket = int(self._clock() // self.window)
+        with self._lock:
+            self.checked += 1
+            for old in [b for b in self._buckets if b <= bucket - BUCKETS]:
+                del self._buckets[old]
+            for digests in self._buckets.values():
+                if digest in digests:
+                    self.replays += 1
+                    return True
+            self._buckets.setdefault(bucket, set()).add(digest)
+            return False
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': sum(len(digests) for digests in self._buckets.values()),
+                'checked': self.checked,
+                'replays': self.replays,
+            }
+
+    def close(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class BloomReplayDetector(object):
+    '''
+    Remembers authenticator digests in rotating Bloom filters, optionally
+    shared by all the processes that map the same file
+
+    Parameters:
+        window (int): clock skew, in seconds
+        capacity (int): authenticators per window the filter is sized for
+        error_rate (float): false positive rate at `capacity`
+        path (str | None): file shared by the workers of a host, None to
+            keep the filters in this process
+    '''
+
+    _HEADER = struct.Struct('!8sQII')
+    _SLOT = struct.Struct('!qQ')
+    _MAGIC = b'KRB5RPL1'
+
+    def __init__(self, window=300, capacity=100000, error_rate=1e-6, path=None,
+                 clock=time.time):
+        self.window = window
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.path = path
+        self._clock = clock
+        self._lock = threading.Lock()
+        bits = -capacity * math.log(error_rate) / math.log(2) ** 2
+        self.bits = int(math.ceil(bits / 8.0)) * 8
+        self.hashes = max(1, int(round(self.bits / float(capacity) * math.log(2))))
+        self._slot_size = self._SLOT.size + self.bits // 8
+        self._size = self._HEADER.size + BUCKETS * self._slot_size
+        self._pid = None
+        self._data = None
+        self._chars = False
+        self._fd = None
+        self.checked = 0
+        self.replays = 0
+        self.estimated_false_replays = 0.0
+
+    def _open(self):
+        '''
+        Maps the filters, again after a fork so that each process holds its
+        own file lock
+        '''
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        if self.path is None:
+            if self._data is None:
+                self._data = bytearray(self._size)
+                self._data[:self._HEADER.size] = self._header()
+                for slot in range(BUCKETS):
+                    self._write_slot(slot, -1, 0)
+            return
+        if fcntl is None:
+            raise ImportError('A shared replay detector file requires fcntl')
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            # Another worker may have created it, possibly with other sizes
+            valid = os.fstat(self._fd).st_size == self._size
+            if valid:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                valid = os.read(self._fd, self._HEADER.size) == self._header()
+            if not valid:
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, self._size)
+            self._data = mmap.mmap(self._fd, self._size)
+            # Python 2 mmaps index, and assign, as one character strings
+            self._chars = not isinstance(self._data[0], int)
+            if not valid:
+                self._data[:self._HEADER.size] = self._header()
+                for slot in range(BUCKETS):
+                    self._write_slot(slot, -1, 0)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _header(self):
+        return self._HEADER.pack(self._MAGIC, self.bits, self.hashes, BUCKETS)
+
+    def _slot_offset(self, slot):
+        return self._HEADER.size + slot * self._slot_size
+
+    def _read_slot(self, slot):
+        offset = self._slot_offset(slot)
+        return self._SLOT.unpack(bytes(self._data[offset:offset + self._SLOT.size]))
+
+    def _write_slot(self, slot, bucket, count):
+        offset = self._slot_offset(slot)
+        self._data[offset:offset + self._SLOT.size] = self._SLOT.pack(bucket, count)
+
+    def _byte(self, offset):
+        byte = self._data[offset]
+        return ord(byte) if self._chars else byte
+
+    def _set_byte(self, offset, value):
+        self._data[offset] = chr(value) if self._chars else value
+
+    def _positions(self, digest):
+        # Double hashing over two 64-bit halves of the digest
+        first, second = struct.unpack('!QQ', digest[:16])
+        second |= 1
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    def _false_positive_rate(self, count):
+        return (1 - math.exp(-self.hashes * count / float(self.bits))) ** self.hashes
+
+    def check(self, digest):
+        '''
+        Records `digest`, returning whether it was probably seen before
+        '''
+        bucket = int(self._clock() // self.window)
+        positions = self._positions(digest)
+        with self._lock:
+            self._open()
+            if self._fd is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                return self._check(bucket, positions)
+            finally:
+                if self._fd is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _check(self, bucket, positions):
+        self.checked += 1
+        data = self._data
+        current = bucket % BUCKETS
+        slot_bucket, count = self._read_slot(current)
+        if slot_bucket != bucket:
+            start = self._slot_offset(current) + self._SLOT.size
+            data[start:start + self.bits // 8] = bytes(bytearray(self.bits // 8))
+            self._write_slot(current, bucket, 0)
+            count = 0
+
+        for slot in range(BUCKETS):
+            slot_bucket, slot_count = self._read_slot(slot)
+            if slot_bucket <= bucket - BUCKETS or slot_count == 0:
+                continue
+            start = self._slot_offset(slot) + self._SLOT.size
+            if all(self._byte(start + p // 8) & (1 << p % 8) for p in positions):
+                self.replays += 1
+                # Chance that this was a first use colliding with other digests
+                self.estimated_false_replays += self._false_positive_rate(slot_count)
+                return True
+
+        start = self._slot_offset(current) + self._SLOT.size
+        for p in positions:
+            offset = start + p // 8
+            self._set_byte(offset, self._byte(offset) | 1 << p % 8)
+        self._write_slot(current, bucket, count + 1)
+        return False
+
+    def false_positive_rate(self):
+        '''
+        Returns the estimated probability that a new authenticator is
+        reported as a replay, given how full the filters are
+        '''
+        bucket = int(self._clock() // self.window)
+        with self._lock:
+            self._open()
+            miss = 1.0
+            for slot in range(BUCKETS):
+                slot_bucket, count = self._read_slot(slot)
+                if slot_bucket > bucket - BUCKETS:
+                    miss *= 1 - self._false_positive_rate(count)
+        return 1 - miss
+
+    def stats(self):
+        rate = self.false_positive_rate()
+        with self._lock:
+            return {
+                'checked': self.checked,
+                'replays': self.replays,
+                'estimated_false_replays': self.estimated_false_replays,
+                'false_positive_rate': rate,
+            }
+
+    def close(self):
+        with self._lock:
+            if self.path is not None and self._data is not None:
+                self._data.close()
+            if self._fd is not None:
+                os.close(self._fd)
+            self._data = self._fd = self._pid = None
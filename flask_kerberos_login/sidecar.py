@@ -0,0 +1,407 @@
+'''
+Authentication sidecar: one GSSAPI acceptor per host, behind a Unix socket
+
+The sidecar owns the keytab and runs GSS accept for every worker of the
+host, so a single warm acceptor and replay cache serve all of them and the
+application processes never read the keytab::
+
+    python -m flask_kerberos_login.sidecar --socket /run/krb5-sidecar.sock \\
+        --keytab /etc/krb5.keytab --backend gssapi
+
+Workers set KRB5_SIDECAR_SOCKET to the same path. Each of them keeps a small
+pool of persistent connections and pipelines requests over them.
+
+Every message is a frame made of a header, ``!IIB`` (body length, request
+id, code), and a body. Requests carry the `AUTHENTICATE` code and the token.
+Responses carry the id of their request and a status. A `COMPLETE` body
+holds the principal, prefixed with its ``!H`` length, then the response
+token. Responses can come back in any order.
+'''
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import itertools
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+_HEADER = struct.Struct('!IIB')
+_LENGTH = struct.Struct('!H')
+
+#: Maximum body size, well above any Kerberos token
+MAX_BODY = 1 << 20
+
+#: Request codes
+AUTHENTICATE = 1
+
+#: Response codes
+COMPLETE = 0
+REJECTED = 1
+ERROR = 2
+
+
+class SidecarUnavailable(IOError):
+    '''
+    Raised when the sidecar cannot be reached or does not answer in time
+    '''
+
+
+def _recv_exact(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError('Connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _read_frame(sock):
+    '''
+    Returns (request id, code, body) of the next frame on `sock`
+    '''
+    length, request_id, code = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    if length > MAX_BODY:
+        raise ValueError('Frame of {} bytes'.format(length))
+    return request_id, code, _recv_exact(sock, length)
+
+
+def _frame(request_id, code, body=b''):
+    return _HEADER.pack(len(body), request_id, code) + body
+
+
+def encode_result(user, token):
+    '''
+    Returns the response code and body for a handshake result
+    '''
+    if user is None:
+        return REJECTED, b''
+    principal = user if isinstance(user, bytes) else user.encode('utf-8')
+    token = token or b''
+    if not isinstance(token, bytes):
+        token = token.encode('ascii')
+    return COMPLETE, _LENGTH.pack(len(principal)) + principal + token
+
+
+def decode_result(code, body):
+    '''
+    Returns the (user, token) handshake result of a response
+    '''
+    if code == REJECTED:
+        return None, None
+    if code != COMPLETE:
+        raise SidecarUnavailable('The sidecar failed to verify the token')
+    length, = _LENGTH.unpack(body[:_LENGTH.size])
+    end = _LENGTH.size + length
+    return body[_LENGTH.size:end].decode('utf-8'), body[end:].decode('ascii') or None
+
+
+class SidecarServer(object):
+    '''
+    Serves handshakes on a Unix socket
+
+    Parameters:
+        path (str): socket path, replaced if it exists
+        authenticate (callable): takes a token, returns (user, token) like
+            `_gssapi_authenticate`
+        workers (int): threads running `authenticate`
+        mode (int): permissions of the socket file
+    '''
+
+    def __init__(self, path, authenticate, workers=4, mode=0o660):
+        self.path = path
+        self.authenticate = authenticate
+        self._queue = queue.Queue()
+        self._closed = False
+        if os.path.exists(path):
+            os.unlink(path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Create the socket file with its final permissions: a chmod after
+        # bind would leave it open to other users in between
+        umask = os.umask(0o777 & ~mode)
+        try:
+            self._sock.bind(path)
+        finally:
+            os.umask(umask)
+        self._sock.listen(128)
+        for n in range(workers):
+            self._spawn(self._work, 'krb5-sidecar-worker-{}'.format(n))
+
+    @staticmethod
+    def _spawn(target, name, *args):
+        thread = threading.Thread(target=target, name=name, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def serve_forever(self):
+        while not self._closed:
+            try:
+                conn, _ = self._sock.accept()
+            except socket.error:
+                if self._closed:
+                    break
+                raise
+            self._spawn(self._serve, 'krb5-sidecar-connection', conn)
+
+    def close(self):
+        self._closed = True
+        self._sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def _serve(self, conn):
+        '''
+        Reads the requests of one connection and queues them, so that a
+        client can pipeline many of them
+        '''
+        lock = threading.Lock()
+        try:
+            while True:
+                request_id, code, body = _read_frame(conn)
+                if code == AUTHENTICATE:
+                    self._queue.put((conn, lock, request_id, body))
+                else:
+                    with lock:
+                        conn.sendall(_frame(request_id, ERROR))
+        except (EOFError, ValueError, socket.error):
+            pass
+        finally:
+            with lock:
+                conn.close()
+
+    def _work(self):
+        while True:
+            conn, lock, request_id, body = self._queue.get()
+            try:
+                code, body = encode_result(*self.authenticate(body.decode('ascii')))
+            except Exception:
+                log.exception('Unable to verify a token')
+                code, body = ERROR, b''
+            try:
+                with lock:
+                    conn.sendall(_frame(request_id, code, body))
+            except socket.error:
+                log.info('Client went away before its response', exc_info=True)
+
+
+class _Connection(object):
+    '''
+    A client connection shared by several threads. Requests are written as
+    soon as they come; whichever waiting thread holds the read turn reads
+    responses and hands them to their requesters.
+    '''
+
+    def __init__(self, path, timeout):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        try:
+            self._sock.connect(path)
+        except socket.error:
+            self._sock.close()
+            raise
+        self._ids = itertools.count(1)
+        self._send_lock = threading.Lock()
+        self._cond = threading.Condition(threading.Lock())
+        self._reading = False
+        self._waiting = set()
+        self._results = {}
+        self.broken = False
+
+    def call(self, token, timeout):
+        deadline = _monotonic() + timeout
+        with self._cond:
+            request_id = next(self._ids) & 0xffffffff
+            self._waiting.add(request_id)
+        try:
+            with self._send_lock:
+                self._sock.sendall(_frame(request_id, AUTHENTICATE, token))
+            while True:
+                with self._cond:
+                    while True:
+                        if request_id in self._results:
+                            return self._results.pop(request_id)
+                        if self.broken:
+                            raise SidecarUnavailable('Connection lost')
+                        if not self._reading:
+                            break
+                        remaining = deadline - _monotonic()
+                        if remaining <= 0:
+                            raise SidecarUnavailable('Timed out')
+                        self._cond.wait(remaining)
+                    self._reading = True
+                try:
+                    response_id, code, body = _read_frame(self._sock)
+                except (EOFError, ValueError, socket.error) as e:
+                    with self._cond:
+                        self._reading = False
+                        self.broken = True
+                        self._cond.notify_all()
+                    raise SidecarUnavailable(str(e))
+                with self._cond:
+                    self._reading = False
+                    if response_id in self._waiting:
+                        self._results[response_id] = (code, body)
+                    self._cond.notify_all()
+        except socket.error as e:
+            self.broken = True
+            raise SidecarUnavailable(str(e))
+        finally:
+            with self._cond:
+                self._waiting.discard(request_id)
+                self._results.pop(request_id, None)
+
+    def close(self):
+        self.broken = True
+        self._sock.close()
+
+
+class SidecarClient(object):
+    '''
+    Pool of pipelined connections to a sidecar
+
+    Parameters:
+        path (str): socket path of the sidecar
+        pool_size (int): connections kept open
+        timeout (float): seconds to wait for a response
+        retry_interval (float): seconds during which the sidecar is not
+            tried again after a failure: a refused connection, a timeout or
+            an error response
+    '''
+
+    def __init__(self, path, pool_size=4, timeout=5, retry_interval=5):
+        self.path = path
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._pool = [None] * pool_size
+        self._next = itertools.count()
+        self._down_until = 0
+        self._pid = os.getpid()
+        self.requests = 0
+        self.failures = 0
+
+    def _connection(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Connections inherited through fork are shared with the parent
+                self._pool = [None] * self.pool_size
+                self._pid = os.getpid()
+            if _monotonic() < self._down_until:
+                raise SidecarUnavailable('The sidecar is down')
+            slot = next(self._next) % self.pool_size
+            connection = self._pool[slot]
+            if connection is None or connection.broken:
+                try:
+                    connection = self._pool[slot] = _Connection(self.path, self.timeout)
+                except socket.error as e:
+                    raise SidecarUnavailable(str(e))
+            return connection
+
+    def authenticate(self, token):
+        '''
+        Returns the (user, token) result of the sidecar's handshake
+
+        Raises:
+            SidecarUnavailable: when the sidecar cannot verify the token
+        '''
+        if not isinstance(token, bytes):
+            token = token.encode('ascii')
+        with self._lock:
+            self.requests += 1
+        try:
+            return decode_result(*self._connection().call(token, self.timeout))
+        except SidecarUnavailable:
+            with self._lock:
+                self.failures += 1
+                now = _monotonic()
+                if now >= self._down_until:
+                    self._down_until = now + self.retry_interval
+            raise
+
+    def stats(self):
+        with self._lock:
+            return {
+                'connections': sum(1 for c in self._pool if c is not None and not c.broken),
+                'requests': self.requests,
+                'failures': self.failures,
+            }
+
+    def close(self):
+        with self._lock:
+            for connection in self._pool:
+                if connection is not None:
+                    connection.close()
+            self._pool = [None] * self.pool_size
+
+
+def acceptor(service_name, backend='pykerberos', keytab=None, disable_rcache=False):
+    '''
+    Returns the authentication function of the sidecar. `disable_rcache`
+    turns off the libkrb5 replay cache, like KRB5_DISABLE_RCACHE does in the
+    workers, which should then run KRB5_REPLAY_DETECTOR.
+    '''
+    if disable_rcache:
+        os.environ['KRB5RCACHETYPE'] = 'none'
+    if backend == 'gssapi':
+        from flask_kerberos_login.acceptor import AcceptorCredentials
+        credentials = AcceptorCredentials(service_name, keytab)
+        credentials.credentials()
+        return credentials.authenticate
+    if keytab:
+        os.environ['KRB5_KTNAME'] = keytab
+    from flask_kerberos_login.manager import _gssapi_authenticate
+
+    def authenticate(token):
+        return _gssapi_authenticate(token, service_name)
+    return authenticate
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--socket', required=True, help='Unix socket path')
+    parser.add_argument('--service', default='HTTP', help='service name (default: HTTP)')
+    parser.add_argument('--hostname', default=socket.gethostname(),
+                        help='host name of the service principal')
+    parser.add_argument('--backend', choices=['pykerberos', 'gssapi'], default='pykerberos')
+    parser.add_argument('--keytab', help='keytab, defaults to KRB5_KTNAME')
+    parser.add_argument('--workers', type=int, default=4, help='verification threads')
+    parser.add_argument('--disable-rcache', action='store_true',
+                        help='turn off the libkrb5 replay cache')
+    parser.add_argument('--mode', type=lambda mode: int(mode, 8), default=0o660,
+                        help='octal permissions of the socket (default: 660)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    service_name = '{}@{}'.format(args.service, args.hostname)
+    server = SidecarServer(args.socket, acceptor(service_name, args.backend, args.keytab,
+                                                   args.disable_rcache),
+                           workers=args.workers, mode=args.mode)
+    log.info('Serving %s on %s', service_name, args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+'''
+Lightweight, thread-safe statistics kept by the login manager
+'''
+from __future__ import absolute_import, print_function, unicode_literals
+
+import bisect
+import threading
+
+
+class Counters(object):
+    '''
+    A set of named, monotonically increasing counters
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + amount
+
+    def get(self, name):
+        return self._values.get(name, 0)
+
+    def snapshot(self):
+        '''
+        Returns a copy of all counters as a dictionary
+        '''
+        with self._lock:
+            return dict(self._values)
+
+
+#: Default histogram bucket upper bounds, in seconds
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float('inf'),
+)
+
+
+class Histogram(object):
+    '''
+    A fixed-bucket histogram of observed values, e.g. latencies in seconds
+    '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        buckets = tuple(sorted(buckets))
+        if buckets[-1] != float('inf'):
+            buckets += (float('inf'),)
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counts = [0] * len(buckets)
+        self._sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def snapshot(self):
+        '''
+        Returns a dictionary with the observation count, their sum and the
+        cumulative count for each bucket upper bound
+        '''
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = []
+        running = 0
+        for bound, count in zip(self.buckets, counts):
+            running += count
+            cumulative.append((bound, running))
+        return {'count': running, 'sum': total, 'buckets': cumulative}
+
+
+class Timings(object):
+    '''
+    A histogram per named phase
+    '''
+
+    def __init__(self, phases, buckets=DEFAULT_BUCKETS):
+        self.histograms = dict((phase, Histogram(buckets)) for phase in phases)
+
+    def observe(self, phase, value):
+        self.histograms[phase].observe(value)
+
+    def snapshot(self):
+        return dict((phase, histogram.snapshot())
+                    for phase, histogram in self.histograms.items())
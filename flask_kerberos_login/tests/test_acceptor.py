@@ -0,0 +1,122 @@
+from flask_kerberos_login import acceptor
+import mock
+import os
+import tempfile
+import unittest
+
+
+class AcceptorCredentialsTestCase(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(acceptor, 'gssapi')
+        self.gssapi = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.gssapi.exceptions.GSSError = type('GSSError', (Exception,), {})
+        self.gssapi.Credentials.return_value.lifetime = None
+        context = self.gssapi.SecurityContext.return_value
+        context.complete = True
+        context.initiator_name = 'user@EXAMPLE.ORG'
+        context.step.return_value = b'STOKEN'
+
+        fd, self.keytab = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, self.keytab)
+
+    def test_credentials_reused(self):
+        '''
+        Ensure that acceptor credentials are acquired once and reused for
+        every authentication.
+        '''
+        creds = acceptor.AcceptorCredentials('HTTP@example.org', self.keytab)
+        self.assertEqual(creds.authenticate('Q1RPS0VO'), ('user@EXAMPLE.ORG', 'U1RPS0VO'))
+        self.assertEqual(creds.authenticate('Q1RPS0VO'), ('user@EXAMPLE.ORG', 'U1RPS0VO'))
+        self.assertEqual(self.gssapi.Credentials.call_count, 1)
+        self.assertEqual(creds.acquisitions, 1)
+        self.gssapi.SecurityContext.assert_called_with(
+            creds=self.gssapi.Credentials.return_value, usage='accept')
+
+    def test_keytab_change(self):
+        '''
+        Ensure that credentials are acquired again when the keytab changes.
+        '''
+        creds = acceptor.AcceptorCredentials('HTTP@example.org', 'FILE:' + self.keytab,
+                                              check_interval=0)
+        creds.credentials()
+        stat = os.stat(self.keytab)
+        os.utime(self.keytab, (stat.st_atime, stat.st_mtime + 10))
+        creds.credentials()
+        self.assertEqual(creds.acquisitions, 2)
+
+    def test_failure(self):
+        context = self.gssapi.SecurityContext.return_value
+        context.step.side_effect = self.gssapi.exceptions.GSSError()
+        creds = acceptor.AcceptorCredentials('HTTP@example.org', self.keytab)
+        self.assertEqual(creds.authenticate('Q1RPS0VO'), (None, None))
+
+
+class KeytabWatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(acceptor, 'gssapi')
+        self.gssapi = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.gssapi.exceptions.GSSError = type('GSSError', (Exception,), {})
+        self.gssapi.Credentials.side_effect = lambda **kwargs: mock.Mock(lifetime=None)
+
+        fd, self.keytab = tempfile.mkstemp()
+        os.write(fd, b'kvno 1')
+        os.close(fd)
+        self.addCleanup(os.unlink, self.keytab)
+        self.creds = acceptor.AcceptorCredentials('HTTP@example.org', self.keytab,
+                                                  check_interval=None, overlap=60)
+        self.addCleanup(self.creds.close)
+
+    def rotate(self):
+        with open(self.keytab, 'wb') as f:
+            f.write(b'kvno 2')
+        stat = os.stat(self.keytab)
+        os.utime(self.keytab, (stat.st_atime, stat.st_mtime + 10))
+
+    def test_reload(self):
+        '''
+        Ensure that the watcher reloads credentials from a snapshot of the
+        rotated keytab and records the reload.
+        '''
+        watcher = acceptor.KeytabWatcher(self.creds)
+        self.creds.credentials()
+        self.assertFalse(watcher.check())
+        self.rotate()
+        self.assertTrue(watcher.check())
+        self.assertEqual(self.creds.reloads, 1)
+        self.assertIsNotNone(self.creds.last_reload)
+        store = self.gssapi.Credentials.call_args[1]['store']
+        with open(store['keytab'], 'rb') as f:
+            self.assertEqual(f.read(), b'kvno 2')
+
+    def test_previous_generation_accepted(self):
+        '''
+        Ensure that a token rejected by the new credentials is retried with
+        the previous generation during the overlap window.
+        '''
+        old = self.creds.credentials()
+        self.rotate()
+        self.creds.reload()
+
+        def security_context(creds, usage):
+            context = mock.Mock(complete=True, initiator_name='user@EXAMPLE.ORG')
+            if creds is not old:
+                context.step.side_effect = self.gssapi.exceptions.GSSError()
+            else:
+                context.step.return_value = None
+            return context
+        self.gssapi.SecurityContext.side_effect = security_context
+        self.assertEqual(self.creds.authenticate('Q1RPS0VO'), ('user@EXAMPLE.ORG', None))
+
+
+class KeytabPathTestCase(unittest.TestCase):
+    def test_prefixes(self):
+        self.assertEqual(acceptor.keytab_path('FILE:/etc/http.keytab'), '/etc/http.keytab')
+        self.assertEqual(acceptor.keytab_path('/etc/http.keytab'), '/etc/http.keytab')
+        self.assertEqual(acceptor.keytab_path('MEMORY:foo'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
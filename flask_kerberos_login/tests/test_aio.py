@@ -0,0 +1,137 @@
+import flask
+import flask_login
+from flask_kerberos_login.tests.test_manager import make_app
+import kerberos
+import mock
+import sys
+import threading
+import unittest
+
+try:
+    import asgiref
+except ImportError:
+    asgiref = None
+
+
+class FakeManager(object):
+    def __init__(self):
+        self.release = threading.Event()
+        self.tokens = []
+
+    def _authenticate(self, token, client=None, negotiation=None):
+        self.release.wait(5)
+        self.tokens.append(token)
+        return 'user@EXAMPLE.ORG', 'STOKEN'
+
+
+@unittest.skipIf(sys.version_info < (3, 7), 'requires Python 3.7')
+class AsyncAuthenticatorTestCase(unittest.TestCase):
+    def setUp(self):
+        from flask_kerberos_login.aio import AsyncAuthenticator
+        self.manager = FakeManager()
+        self.authenticator = AsyncAuthenticator(self.manager, workers=1)
+        self.addCleanup(self.authenticator.shutdown)
+
+    def test_authenticate(self):
+        import asyncio
+        self.manager.release.set()
+        result = asyncio.run(self.authenticator.authenticate('CTOKEN'))
+        self.assertEqual(result, ('user@EXAMPLE.ORG', 'STOKEN'))
+        self.assertEqual(self.manager.tokens, ['CTOKEN'])
+        self.assertEqual(self.authenticator.stats()['completed'], 1)
+
+    def test_queue_depth(self):
+        '''
+        Ensure that handshakes waiting for a busy worker are counted, and
+        that the event loop keeps running meanwhile.
+        '''
+        import asyncio
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        tasks = [loop.create_task(self.authenticator.authenticate(token))
+                 for token in ('A', 'B', 'C')]
+        loop.run_until_complete(asyncio.sleep(0.05))
+        stats = self.authenticator.stats()
+        self.manager.release.set()
+        loop.run_until_complete(asyncio.gather(*tasks))
+
+        self.assertEqual(stats['running'], 1)
+        self.assertEqual(stats['queue_depth'], 2)
+        self.assertEqual(self.authenticator.stats()['queue_depth'], 0)
+        self.assertGreaterEqual(self.authenticator.stats()['max_queue_depth'], 2)
+
+
+# Flask 2 runs async views through asgiref
+@unittest.skipIf(sys.version_info < (3, 7) or not hasattr(flask.Flask, 'ensure_sync') or
+                 asgiref is None, 'requires Flask 2 async views')
+class AsyncViewTestCase(unittest.TestCase):
+    def setUp(self):
+        from flask_kerberos_login.aio import async_kerberos_required
+        self.app, self.manager = make_app(login_session=True, KRB5_GLOBAL_HOOK=False)
+
+        @self.app.route('/async')
+        @async_kerberos_required
+        def view():
+            # A plain function returning a coroutine keeps this module
+            # importable on Python 2; the decorated view is async
+            import asyncio
+            return asyncio.sleep(0, result=flask_login.current_user.id)
+
+    def tearDown(self):
+        if self.manager.async_authenticator is not None:
+            self.manager.async_authenticator.shutdown()
+
+    def test_unauthorized(self):
+        r = self.app.test_client().get('/async')
+        self.assertEqual(r.status_code, 401)
+        self.assertEqual(r.headers.get('www-authenticate'), 'Negotiate')
+
+    @mock.patch('kerberos.authGSSServerInit')
+    @mock.patch('kerberos.authGSSServerStep')
+    @mock.patch('kerberos.authGSSServerResponse')
+    @mock.patch('kerberos.authGSSServerUserName')
+    @mock.patch('kerberos.authGSSServerClean')
+    def test_authorized(self, clean, name, response, step, init):
+        '''
+        Ensure that an async view authenticates through the manager, with
+        the handshake running on the executor.
+        '''
+        state = object()
+        init.return_value = (kerberos.AUTH_GSS_COMPLETE, state)
+        step.return_value = kerberos.AUTH_GSS_COMPLETE
+        name.return_value = 'user@EXAMPLE.ORG'
+        response.return_value = 'STOKEN'
+        r = self.app.test_client().get('/async', headers={'Authorization': 'Negotiate CTOKEN'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.data, b'user@EXAMPLE.ORG')
+        self.assertEqual(r.headers.get('WWW-Authenticate'), 'Negotiate STOKEN')
+        self.assertEqual(step.mock_calls, [mock.call(state, 'CTOKEN')])
+        self.assertEqual(self.manager.stats()['async']['completed'], 1)
+
+    @mock.patch('kerberos.authGSSServerInit')
+    @mock.patch('kerberos.authGSSServerStep')
+    @mock.patch('kerberos.authGSSServerResponse')
+    @mock.patch('kerberos.authGSSServerUserName')
+    @mock.patch('kerberos.authGSSServerClean')
+    def test_behind_middleware(self, clean, name, response, step, init):
+        '''
+        Ensure that an async view behind KerberosMiddleware reuses its
+        result instead of running the handshake again.
+        '''
+        from flask_kerberos_login.wsgi import KerberosMiddleware
+        init.return_value = (kerberos.AUTH_GSS_COMPLETE, object())
+        step.return_value = kerberos.AUTH_GSS_COMPLETE
+        name.return_value = 'user@EXAMPLE.ORG'
+        response.return_value = 'STOKEN'
+        self.app.wsgi_app = KerberosMiddleware(self.app.wsgi_app, self.manager)
+        with mock.patch.object(self.manager, '_authenticate',
+                               wraps=self.manager._authenticate) as authenticate:
+            r = self.app.test_client().get('/async', headers={'Authorization': 'Negotiate CTOKEN'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.data, b'user@EXAMPLE.ORG')
+        self.assertEqual(len(authenticate.mock_calls), 1)
+        self.assertEqual(self.app.saved, ['user@EXAMPLE.ORG'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import sys
+import unittest
+
+import mock
+
+
+def http_scope(path='/', headers=()):
+    return {
+        'type': 'http',
+        'path': path,
+        'headers': list(headers),
+        'client': ('192.0.2.1', 40000),
+    }
+
+
+@unittest.skipIf(sys.version_info < (3, 7), 'requires Python 3.7')
+class ASGIMiddlewareTestCase(unittest.TestCase):
+    def setUp(self):
+        import flask_kerberos_login
+        from flask_kerberos_login.asgi import KerberosASGIMiddleware
+        self.manager = flask_kerberos_login.KerberosLoginManager()
+        self.manager._authenticate = mock.Mock(return_value=('user@EXAMPLE.ORG', 'STOKEN'))
+        self.scopes = []
+
+        def app(scope, receive, send):
+            self.scopes.append(scope)
+            return send({'type': 'http.response.start', 'status': 200, 'headers': []})
+
+        self.middleware = KerberosASGIMiddleware(app, self.manager)
+
+    def tearDown(self):
+        if self.manager.async_authenticator is not None:
+            self.manager.async_authenticator.shutdown()
+
+    def request(self, scope):
+        import asyncio
+        messages = []
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        def send(message):
+            messages.append(message)
+            future = loop.create_future()
+            future.set_result(None)
+            return future
+
+        loop.run_until_complete(self.middleware(scope, None, send))
+        return messages
+
+    def test_authorized(self):
+        messages = self.request(http_scope(headers=[(b'authorization', b'Negotiate CTOKEN')]))
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertEqual(messages[0]['headers'], [(b'WWW-Authenticate', b'Negotiate STOKEN')])
+        self.assertEqual(self.scopes[0]['kerberos.principal'], 'user@EXAMPLE.ORG')
+        self.assertEqual(self.scopes[0]['kerberos.user'], 'user@EXAMPLE.ORG')
+        self.manager._authenticate.assert_called_once_with('CTOKEN', '192.0.2.1', None)
+        self.assertEqual(self.manager.async_authenticator.stats()['completed'], 1)
+
+    def test_forbidden(self):
+        self.manager._authenticate.return_value = (None, None)
+        messages = self.request(http_scope(headers=[(b'authorization', b'Negotiate CTOKEN')]))
+        self.assertEqual(messages[0]['status'], 403)
+        self.assertEqual(self.scopes, [])
+        self.assertEqual(self.manager.stats()['forbidden'], 1)
+
+    def test_continue(self):
+        self.manager._authenticate.return_value = (None, 'STOKEN')
+        messages = self.request(http_scope(headers=[(b'authorization', b'Negotiate CTOKEN')]))
+        self.assertEqual(messages[0]['status'], 401)
+        self.assertIn((b'WWW-Authenticate', b'Negotiate STOKEN'), messages[0]['headers'])
+
+    def test_required(self):
+        from flask_kerberos_login.policy import PolicyTable
+        self.manager._policy = PolicyTable(paths={'/private': 'required'})
+        messages = self.request(http_scope('/private'))
+        self.assertEqual(messages[0]['status'], 401)
+        self.assertIn((b'WWW-Authenticate', b'Negotiate'), messages[0]['headers'])
+
+        messages = self.request(http_scope('/public'))
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertEqual(messages[0]['headers'], [])
+        self.assertNotIn('kerberos.principal', self.scopes[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
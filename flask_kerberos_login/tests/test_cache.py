@@ -0,0 +1,104 @@
+from flask_kerberos_login.cache import TTLCache, token_digest
+import unittest
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TTLCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_hit_and_miss(self):
+        cache = TTLCache(2, clock=self.clock)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_lru_eviction(self):
+        '''
+        Ensure the least recently used entry is evicted first.
+        '''
+        cache = TTLCache(2, clock=self.clock)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_expiry(self):
+        cache = TTLCache(2, ttl=10, clock=self.clock)
+        cache.set('a', 1)
+        self.clock.now += 9
+        self.assertEqual(cache.get('a'), 1)
+        self.clock.now += 1
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.stats()['expirations'], 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_purge_oldest(self):
+        '''
+        Ensure that expired entries are purged from the oldest end only,
+        up to the first live entry.
+        '''
+        evicted = []
+        cache = TTLCache(4, ttl=10, clock=self.clock,
+                         on_evict=lambda key, value: evicted.append(key))
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.clock.now += 5
+        cache.set('c', 3)
+        self.clock.now += 5
+        self.assertEqual(cache.purge_oldest(), 2)
+        self.assertEqual(evicted, ['a', 'b'])
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.purge_oldest(), 0)
+
+    def test_ttl_cannot_be_extended(self):
+        cache = TTLCache(2, ttl=10, clock=self.clock)
+        cache.set('a', 1, ttl=100)
+        self.clock.now += 10
+        self.assertEqual(cache.get('a'), None)
+
+    def test_memory_cap(self):
+        '''
+        Ensure entries are evicted to keep the estimated size under the cap,
+        and that entries larger than the cap are never stored.
+        '''
+        cache = TTLCache(100, max_bytes=25, sizeof=lambda k, v: len(v), clock=self.clock)
+        cache.set('a', 'x' * 10)
+        cache.set('b', 'x' * 10)
+        cache.set('c', 'x' * 10)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.stats()['bytes'], 20)
+        self.assertFalse(cache.set('d', 'x' * 30))
+        self.assertEqual(cache.get('d'), None)
+
+    def test_on_evict(self):
+        evicted = []
+        cache = TTLCache(1, on_evict=lambda k, v: evicted.append(k), clock=self.clock)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.invalidate('b')
+        self.assertEqual(evicted, ['a', 'b'])
+
+
+class TokenDigestTestCase(unittest.TestCase):
+    def test_digest(self):
+        self.assertEqual(token_digest('CTOKEN'), token_digest(b'CTOKEN'))
+        self.assertEqual(len(token_digest('CTOKEN\xe9')), 32)
+
+
+if __name__ == '__main__':
+    unittest.main()
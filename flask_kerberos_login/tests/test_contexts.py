@@ -0,0 +1,49 @@
+from flask_kerberos_login.contexts import ContextTable
+from flask_kerberos_login.tests.test_cache import FakeClock
+import unittest
+
+
+class ContextTableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cleaned = []
+        self.clock = FakeClock()
+        self.table = ContextTable(self.cleaned.append, max_contexts=2, ttl=30,
+                                  clock=self.clock)
+
+    def test_take(self):
+        state = object()
+        self.table.put('a', state)
+        self.assertIs(self.table.take('a'), state)
+        self.assertIs(self.table.take('a'), None)
+        self.assertIs(self.table.take(None), None)
+        self.assertEqual(self.cleaned, [])
+
+    def test_expired(self):
+        '''
+        Ensure that expired contexts are never handed out, and are released.
+        '''
+        states = [object(), object()]
+        self.table.put('a', states[0])
+        self.clock.now += 20
+        self.table.put('b', states[1])
+        self.clock.now += 20
+        self.assertIs(self.table.take('a'), None)
+        self.assertEqual(self.cleaned, [states[0]])
+        self.assertIs(self.table.take('b'), states[1])
+        self.assertEqual(self.table.stats()['expirations'], 1)
+
+    def test_eviction_cleans(self):
+        '''
+        Ensure that contexts dropped to respect the size cap are released.
+        '''
+        states = [object(), object(), object()]
+        for key, state in zip('abc', states):
+            self.table.put(key, state)
+        self.assertEqual(self.cleaned, [states[0]])
+        self.assertEqual(self.table.stats()['evictions'], 1)
+        self.table.clear()
+        self.assertEqual(self.cleaned, states)
+
+
+if __name__ == '__main__':
+    unittest.main()
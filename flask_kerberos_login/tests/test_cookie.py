@@ -0,0 +1,52 @@
+from flask_kerberos_login.cookie import AuthCookie
+import unittest
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000000.0
+
+    def __call__(self):
+        return self.now
+
+
+class AuthCookieTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cookie = AuthCookie(['new', 'old'], max_age=60, clock_skew=5, clock=self.clock)
+
+    def test_roundtrip(self):
+        value = self.cookie.issue('user@EXAMPLE.ORG')
+        self.assertEqual(self.cookie.verify(value), 'user@EXAMPLE.ORG')
+        self.assertEqual(self.cookie.stats()['verified'], 1)
+
+    def test_tampered(self):
+        value = self.cookie.issue('user@EXAMPLE.ORG')
+        forged = AuthCookie('other', clock=self.clock).issue('admin@EXAMPLE.ORG')
+        principal, rest = value.split('.', 1)
+        for bad in [forged, forged.split('.', 1)[0] + '.' + rest, value[:-2], 'x', '...']:
+            self.assertEqual(self.cookie.verify(bad), None)
+        self.assertEqual(self.cookie.stats()['invalid'], 5)
+
+    def test_expiry(self):
+        value = self.cookie.issue('user@EXAMPLE.ORG', lifetime=10)
+        self.clock.now += 14
+        self.assertEqual(self.cookie.verify(value), 'user@EXAMPLE.ORG')
+        self.clock.now += 2
+        self.assertEqual(self.cookie.verify(value), None)
+        self.assertEqual(self.cookie.stats()['expired'], 1)
+
+    def test_rotation(self):
+        old = AuthCookie(['old'], clock=self.clock).issue('user@EXAMPLE.ORG')
+        self.assertEqual(self.cookie.verify(old), 'user@EXAMPLE.ORG')
+        retired = AuthCookie(['new'], clock=self.clock)
+        self.assertEqual(retired.verify(old), None)
+        self.assertEqual(retired.verify(self.cookie.issue('user@EXAMPLE.ORG')), 'user@EXAMPLE.ORG')
+
+    def test_no_keys(self):
+        with self.assertRaises(ValueError):
+            AuthCookie([])
+
+
+if __name__ == '__main__':
+    unittest.main()
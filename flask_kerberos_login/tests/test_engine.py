@@ -0,0 +1,97 @@
+from flask_kerberos_login.tests.test_manager import make_app
+import mock
+import os
+import sys
+import time
+import unittest
+
+
+def fake_init_worker(service_name, backend, keytab):
+    from flask_kerberos_login import engine
+
+    def verify(token):
+        if token == 'CRASH':
+            os._exit(1)
+        if token == 'NOCREDS':
+            from flask_kerberos_login.manager import VerificationUnavailable
+            raise VerificationUnavailable()
+        if token == 'SLOW':
+            time.sleep(0.5)
+        if token.startswith('VALID'):
+            return 'user@EXAMPLE.ORG', 'STOKEN'
+        return None, None
+    engine._verify = verify
+
+
+@unittest.skipIf(sys.version_info < (3, 7), 'requires Python 3.7')
+class VerificationEngineTestCase(unittest.TestCase):
+    def setUp(self):
+        from flask_kerberos_login import engine
+        patcher = mock.patch.object(engine, '_init_worker', fake_init_worker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.engine = engine.VerificationEngine('HTTP@example.org', 2, timeout=30)
+        self.addCleanup(self.engine.shutdown)
+
+    def test_verify(self):
+        self.assertEqual(self.engine.verify('VALID'), ('user@EXAMPLE.ORG', 'STOKEN'))
+        self.assertEqual(self.engine.verify('INVALID'), (None, None))
+        self.assertEqual(self.engine.stats()['verified'], 2)
+
+    def test_crash_recovery(self):
+        '''
+        Ensure that a token crashing its worker is rejected and that the pool
+        keeps verifying other tokens afterwards.
+        '''
+        self.assertEqual(self.engine.verify('CRASH'), (None, None))
+        self.assertEqual(self.engine.verify('VALID'), ('user@EXAMPLE.ORG', 'STOKEN'))
+        self.assertGreaterEqual(self.engine.stats()['restarts'], 1)
+
+    def test_unavailable(self):
+        '''
+        Ensure that timeouts and workers unable to verify anything raise
+        VerificationUnavailable instead of rejecting the token.
+        '''
+        from flask_kerberos_login.manager import VerificationUnavailable
+        with self.assertRaises(VerificationUnavailable):
+            self.engine.verify('NOCREDS')
+        self.engine.timeout = 0.05
+        with self.assertRaises(VerificationUnavailable):
+            self.engine.verify('SLOW')
+        self.assertEqual(self.engine.stats()['timeouts'], 1)
+
+    def test_back_pressure(self):
+        from flask_kerberos_login.engine import EngineBusy
+        self.engine.max_pending = 0
+        with self.assertRaises(EngineBusy):
+            self.engine.verify('VALID')
+        self.assertEqual(self.engine.stats()['rejected'], 1)
+
+
+class ManagerEngineTestCase(unittest.TestCase):
+    @unittest.skipIf(sys.version_info >= (3, 7), 'requires Python 2')
+    def test_requires_python3(self):
+        with self.assertRaises(ValueError):
+            make_app(KRB5_VERIFY_PROCESSES=1)
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'requires Python 3.7')
+    def test_verify(self):
+        '''
+        Ensure that a manager configured with KRB5_VERIFY_PROCESSES verifies
+        tokens on its engine.
+        '''
+        from flask_kerberos_login import engine
+        with mock.patch.object(engine, '_init_worker', fake_init_worker):
+            app, manager = make_app(KRB5_VERIFY_PROCESSES=1)
+            self.addCleanup(manager._engine.shutdown)
+            c = app.test_client()
+            r = c.get('/', headers={'Authorization': 'Negotiate VALID'})
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.headers.get('WWW-Authenticate'), 'Negotiate STOKEN')
+            r = c.get('/', headers={'Authorization': 'Negotiate INVALID'})
+            self.assertEqual(r.status_code, 403)
+        self.assertEqual(manager.stats()['engine']['verified'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
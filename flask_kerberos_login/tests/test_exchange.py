@@ -0,0 +1,93 @@
+import flask
+import flask_login
+import flask_kerberos_login
+from flask_kerberos_login import exchange
+import json
+import kerberos
+import mock
+import unittest
+
+
+def private_key():
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    key = rsa.generate_private_key(65537, 2048, default_backend())
+    return key.private_bytes(serialization.Encoding.PEM,
+                             serialization.PrivateFormat.PKCS8,
+                             serialization.NoEncryption())
+
+
+@unittest.skipIf(exchange.jwt is None, 'requires PyJWT')
+class ExchangeTestCase(unittest.TestCase):
+    def setUp(self):
+        app = flask.Flask(__name__)
+        app.config['TESTING'] = True
+        app.config['KRB5_SERVICE_NAME'] = 'HTTP'
+        app.config['KRB5_HOSTNAME'] = 'example.org'
+        app.config['KRB5_GLOBAL_HOOK'] = False
+        app.config['KRB5_AUTH_TO_LOCAL'] = 'RULE:[1:$1@$0](.*@EXAMPLE\\.ORG)s/@.*//'
+        flask_login.LoginManager(app)
+        manager = flask_kerberos_login.KerberosLoginManager(app)
+        manager.save_user(lambda name: None)
+        self.blueprint = exchange.exchange_blueprint(
+            manager, private_key(), issuer='front', audience='api',
+            groups=lambda name: ['staff'])
+        app.register_blueprint(self.blueprint)
+        self.app = app
+
+    @mock.patch('kerberos.authGSSServerInit')
+    @mock.patch('kerberos.authGSSServerStep')
+    @mock.patch('kerberos.authGSSServerResponse')
+    @mock.patch('kerberos.authGSSServerUserName')
+    @mock.patch('kerberos.authGSSServerClean')
+    def test_exchange(self, clean, name, response, step, init):
+        init.return_value = (kerberos.AUTH_GSS_COMPLETE, object())
+        step.return_value = kerberos.AUTH_GSS_COMPLETE
+        name.return_value = 'user@EXAMPLE.ORG'
+        response.return_value = 'STOKEN'
+        c = self.app.test_client()
+        r = c.post('/token', headers={'Authorization': 'Negotiate CTOKEN'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers.get('WWW-Authenticate'), 'Negotiate STOKEN')
+        self.assertEqual(r.headers.get('Cache-Control'), 'no-store')
+        self.assertEqual(r.headers.get('Pragma'), 'no-cache')
+        token = json.loads(r.data.decode('utf-8'))['access_token']
+
+        jwks = json.loads(c.get('/jwks.json').data.decode('utf-8'))
+        verifier = exchange.JWTVerifier(jwks, issuer='front', audience='api')
+        claims = verifier.verify(token)
+        self.assertEqual(claims['sub'], 'user@EXAMPLE.ORG')
+        self.assertEqual(claims['preferred_username'], 'user')
+        self.assertEqual(claims['groups'], ['staff'])
+
+        with self.assertRaises(exchange.jwt.InvalidTokenError):
+            exchange.JWTVerifier(jwks, issuer='other').verify(token)
+
+    def test_unauthorized(self):
+        r = self.app.test_client().post('/token')
+        self.assertEqual(r.status_code, 401)
+        self.assertEqual(r.headers.get('WWW-Authenticate'), 'Negotiate')
+
+    def test_key_refresh(self):
+        issuer = self.blueprint.issuer
+        clock = mock.Mock(return_value=0)
+        verifier = exchange.JWTVerifier('http://front/jwks.json', clock=clock,
+                                        audience='api', min_refresh_interval=60)
+        with mock.patch.object(verifier, '_fetch', return_value=issuer.jwks) as fetch:
+            token = issuer.issue('user@EXAMPLE.ORG')
+            self.assertEqual(verifier.verify(token)['sub'], 'user@EXAMPLE.ORG')
+            self.assertEqual(verifier.verify(token)['sub'], 'user@EXAMPLE.ORG')
+            self.assertEqual(len(fetch.mock_calls), 1)
+
+            self.assertEqual(verifier.key('unknown'), None)
+            clock.return_value = 59
+            self.assertEqual(verifier.key('unknown'), None)
+            self.assertEqual(len(fetch.mock_calls), 1)
+            clock.return_value = 61
+            self.assertEqual(verifier.key('unknown'), None)
+            self.assertEqual(len(fetch.mock_calls), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+from flask_kerberos_login.limiter import TokenBucketLimiter
+import unittest
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TokenBucketLimiterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = TokenBucketLimiter(rate=1, burst=2, max_clients=2, clock=self.clock)
+
+    def test_shedding(self):
+        '''
+        Ensure that a client is refused once its failures exhaust the burst,
+        and allowed again after the bucket refills.
+        '''
+        self.assertTrue(self.limiter.allow('10.0.0.1'))
+        self.limiter.failure('10.0.0.1')
+        self.assertTrue(self.limiter.allow('10.0.0.1'))
+        self.limiter.failure('10.0.0.1')
+        self.assertFalse(self.limiter.allow('10.0.0.1'))
+        self.assertTrue(self.limiter.allow('10.0.0.2'))
+        self.clock.now += 1
+        self.assertTrue(self.limiter.allow('10.0.0.1'))
+        self.assertEqual(self.limiter.stats()['shed'], 1)
+
+    def test_bounded(self):
+        for client in ('a', 'b', 'c'):
+            self.limiter.failure(client)
+        stats = self.limiter.stats()
+        self.assertEqual(stats['clients'], 2)
+        self.assertEqual(stats['evictions'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
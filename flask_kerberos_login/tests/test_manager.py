@@ -1,37 +1,77 @@
 import flask
 import flask_login
 import flask_kerberos_login
+from flask_kerberos_login import manager
+from flask_kerberos_login.metrics import metrics_blueprint
 import kerberos
 import mock
+import os
+import subprocess
+import sys
 import unittest
 
 class User(flask_login.UserMixin):
     def __init__(self, email):
         self.id = email
 
-class BasicAppTestCase(unittest.TestCase):
-    def setUp(self):
-        app = flask.Flask(__name__)
-        app.config['TESTING'] = True
-        app.config['KRB5_SERVICE_NAME'] = 'HTTP'
-        app.config['KRB5_HOSTNAME'] = 'example.org'
 
-        login_manager = flask_login.LoginManager(app)
-        manager = flask_kerberos_login.KerberosLoginManager(app)
+def set_current_user(user):
+    '''
+    Makes `user` the current user of the request without a session, where
+    either flask-login 0.6 or earlier versions look for it
+    '''
+    flask.g._login_user = user
+    flask._request_ctx_stack.top.user = user
 
-        @manager.save_user
-        def save_user(peer_name):
-            user = User(str(peer_name))
-            # persist our user to the login manager
-            login_manager.reload_user(user)
 
-        @app.route('/')
-        @flask_login.login_required
-        def index():
-            return flask_login.current_user.id
+def make_app(login_session=False, **config):
+    '''
+    Returns an app whose index view requires a login, and its
+    KerberosLoginManager configured with `config`. The save_user callback
+    records principals in `app.saved` and logs their user in for the
+    current request, or with a session when `login_session` is set.
+    '''
+    app = flask.Flask(__name__)
+    app.config['TESTING'] = True
+    app.config['SECRET_KEY'] = 'secret'
+    app.config['KRB5_SERVICE_NAME'] = 'HTTP'
+    app.config['KRB5_HOSTNAME'] = 'example.org'
+    app.config.update(config)
+
+    users = {}
+    login_manager = flask_login.LoginManager(app)
+    manager = flask_kerberos_login.KerberosLoginManager(app)
+    app.saved = []
+
+    @login_manager.user_loader
+    def load_user(user_id):
+        return users.get(user_id)
 
-        self.app = app
-        self.manager = manager
+    @manager.save_user
+    def save_user(peer_name):
+        app.saved.append(peer_name)
+        user = users[str(peer_name)] = User(str(peer_name))
+        if login_session:
+            flask_login.login_user(user)
+        else:
+            set_current_user(user)
+        return user
+
+    @app.route('/')
+    @flask_login.login_required
+    def index():
+        return flask_login.current_user.id
+
+    @app.route('/health')
+    def health():
+        return 'ok'
+
+    return app, manager
+
+
+class BasicAppTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app, self.manager = make_app()
 
     def test_unauthorized(self):
         '''
@@ -64,7 +104,7 @@ class BasicAppTestCase(unittest.TestCase):
         c = self.app.test_client()
         r = c.get('/', headers={'Authorization': 'Negotiate CTOKEN'})
         self.assertEqual(r.status_code, 200)
-        self.assertEqual(r.data, 'user@EXAMPLE.ORG')
+        self.assertEqual(r.data, b'user@EXAMPLE.ORG')
         self.assertEqual(r.headers.get('WWW-Authenticate'), 'Negotiate STOKEN')
         self.assertEqual(init.mock_calls, [mock.call('HTTP@example.org')])
         self.assertEqual(step.mock_calls, [mock.call(state, 'CTOKEN')])
@@ -90,7 +130,7 @@ class BasicAppTestCase(unittest.TestCase):
         c = self.app.test_client()
         r = c.get('/', headers={'Authorization': 'Negotiate CTOKEN'})
         self.assertEqual(r.status_code, 200)
-        self.assertEqual(r.data, 'user@EXAMPLE.ORG')
+        self.assertEqual(r.data, b'user@EXAMPLE.ORG')
         self.assertEqual(r.headers.get('WWW-Authenticate'), None)
         self.assertEqual(init.mock_calls, [mock.call('HTTP@example.org')])
         self.assertEqual(step.mock_calls, [mock.call(state, 'CTOKEN')])
@@ -120,6 +160,751 @@ class BasicAppTestCase(unittest.TestCase):
         self.assertEqual(response.mock_calls, [])
         self.assertEqual(clean.mock_calls, [mock.call(state)])
 
+    @mock.patch('kerberos.authGSSServerInit')
+    @mock.patch('kerberos.authGSSServerStep')
+    @mock.patch('kerberos.authGSSServerResponse')
+    @mock.patch('kerberos.authGSSServerUserName')
+    @mock.patch('kerberos.authGSSServerClean')
+    def test_auth_to_local(self, clean, name, response, step, init):
+        '''
+        Ensure that the save_user callback receives the local name, and that
+        principals without a mapping are forbidden.
+        '''
+        self.app.config['KRB5_AUTH_TO_LOCAL'] = ['DEFAULT']
+        self.app.config['KRB5_LOCAL_REALMS'] = ['EXAMPLE.ORG']
+        self.manager.init_config(self.app.config)
+        init.return_value = (kerberos.AUTH_GSS_COMPLETE, object())
+        step.return_value = kerberos.AUTH_GSS_COMPLETE
+        name.return_value = "user@EXAMPLE.ORG"
+        response.return_value = "STOKEN"
+        c = self.app.test_client()
+        r = c.get('/', headers={'Authorization': 'Negotiate CTOKEN'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.data, b'user')
+        name.return_value = "user@OTHER.ORG"
+        r = c.get('/', headers={'Authorization': 'Negotiate CTOKEN'})
+        self.assertEqual(r.status_code, 403)
+        stats = self.manager.stats()
+        self.assertEqual(stats['unmapped'], 1)
+        self.assertEqual(stats['forbidden'], 1)
+
+    @mock.patch('kerberos.getServerPrincipalDetails')
+    def test_default_rule_without_realm(self, details):
+        '''
+        Ensure that the DEFAULT rule is refused when neither KRB5_LOCAL_REALMS
+        nor the server realm tells which realms it applies to.
+        '''
+        details.side_effect = kerberos.KrbError('no keytab')
+        self.app.config['KRB5_AUTH_TO_LOCAL'] = ['DEFAULT']
+        with self.assertRaises(ValueError):
+            self.manager.init_config(self.app.config)
+        self.app.config['KRB5_AUTH_TO_LOCAL'] = ['RULE:[1:$1@$0](.*@EXAMPLE\\.ORG)s/@.*//']
+        self.manager.init_config(self.app.config)
+
+    @mock.patch('kerberos.authGSSServerInit')
+    @mock.patch('kerberos.authGSSServerStep')
+    @mock.patch('kerberos.authGSSServerClean')
+    def test_negative_cache(self, clean, step, init):
+        '''
+        Ensure that a rejected token is rejected again without a handshake.
+        '''
+        self.app.config['KRB5_NEGATIVE_CACHE'] = True
+        self.manager.init_config(self.app.config)
+        init.return_value = (kerberos.AUTH_GSS_COMPLETE, object())
+        step.side_effect = kerberos.GSSError("FAILURE")
+        c = self.app.test_client()
+        for _ in range(2):
+            r = c.get('/', headers={'Authorization': 'Negotiate CTOKEN'})
+            self.assertEqual(r.status_code, 403)
+        self.assertEqual(len(init.mock_calls), 1)
+        self.assertEqual(self.manager.stats()['negative_cache']['hits'], 1)
+
+    @mock.patch('kerberos.authGSSServerInit')
+    def test_non_ascii_token(self, init):
+        '''
+        Ensure that a token with non-ASCII characters is refused with 403
+        before it reaches the negative cache or GSSAPI.
+        '''
+        self.app.config['KRB5_NEGATIVE_CACHE'] = True
+        self.manager.init_config(self.app.config)
+        r = self.app.test_client().get('/', headers={'Authorization': 'Negotiate CTOKEN\xe9'})
+        self.assertEqual(r.status_code, 403)
+        self.assertEqual(init.mock_calls, [])
+        self.assertEqual(self.manager.stats()['rejected_not_base64'], 1)
+
+    @mock.patch('kerberos.authGSSServerInit')
+    @mock.patch('kerberos.authGSSServerStep')
+    @mock.patch('kerberos.authGSSServerClean')
+    def test_failure_rate_limit(self, clean, step, init):
+        '''
+        Ensure that a client exceeding its failure budget gets 429 without a
+        handshake.
+        '''
+        self.app.config['KRB5_FAILURE_RATE'] = 0.001
+        self.app.config['KRB5_FAILURE_BURST'] = 2
+        self.manager.init_config(self.app.config)
+        init.return_value = (kerberos.AUTH_GSS_COMPLETE, object())
+        step.side_effect = kerberos.GSSError("FAILURE")
+        c = self.app.test_client()
+        statuses = [c.get('/', headers={'Authorization': 'Negotiate CTOKEN'}).status_code
+                    for _ in range(3)]
+        self.assertEqual(statuses, [403, 403, 429])
+        self.assertEqual(len(init.mock_calls), 2)
+        self.assertEqual(self.manager.stats()['limiter']['shed'], 1)
+
+    @mock.patch('kerberos.authGSSServerInit')
+    def test_prevalidation(self, init):
+        '''
+        Ensure that NTLM tokens are challenged again and garbage is rejected
+        without creating a GSSAPI context.
+        '''
+        self.app.config['KRB5_PREVALIDATE'] = True
+        self.manager.init_config(self.app.config)
+        c = self.app.test_client()
+        r = c.get('/', headers={'Authorization': 'Negotiate TlRMTVNTUAABAAAA'})
+        self.assertEqual(r.status_code, 401)
+        self.assertEqual(r.headers.get('www-authenticate'), 'Negotiate')
+        r = c.get('/', headers={'Authorization': 'Negotiate CTOKEN'})
+        self.assertEqual(r.status_code, 403)
+        self.assertEqual(init.mock_calls, [])
+        self.assertEqual(self.manager.stats()['rejected_ntlm'], 1)
+
+    @mock.patch('kerberos.authGSSServerInit')
+    @mock.patch('kerberos.authGSSServerStep')
+    @mock.patch('kerberos.authGSSServerClean')
+    def test_metrics(self, clean, step, init):
+        '''
+        Ensure that challenges and rejected tokens are counted and exposed by
+        the metrics blueprint.
+        '''
+        self.app.register_blueprint(metrics_blueprint(self.manager))
+        init.return_value = (kerberos.AUTH_GSS_COMPLETE, object())
+        step.side_effect = kerberos.GSSError("FAILURE")
+        c = self.app.test_client()
+        c.get('/')
+        c.get('/', headers={'Authorization': 'Negotiate CTOKEN'})
+        r = c.get('/metrics')
+        self.assertEqual(r.status_code, 200)
+        self.assertIn(b'kerberos_challenges_total 1\n', r.data)
+        self.assertIn(b'kerberos_forbidden_total 1\n', r.data)
+        self.assertIn(b'kerberos_handshakes_failed_total 1\n', r.data)
+
+    @mock.patch('kerberos.authGSSServerInit')
+    def test_token_cache_non_ascii(self, init):
+        '''
+        Ensure that a non-ASCII token is refused with 403 when only the
+        verified-token cache is enabled.
+        '''
+        self.app.config['KRB5_TOKEN_CACHE'] = True
+        self.manager.init_config(self.app.config)
+        r = self.app.test_client().get('/', headers={'Authorization': 'Negotiate CTOKEN\xe9'})
+        self.assertEqual(r.status_code, 403)
+        self.assertEqual(init.mock_calls, [])
+
+    @mock.patch('kerberos.authGSSServerInit')
+    @mock.patch('kerberos.authGSSServerStep')
+    @mock.patch('kerberos.authGSSServerResponse')
+    @mock.patch('kerberos.authGSSServerUserName')
+    @mock.patch('kerberos.authGSSServerClean')
+    def test_token_cache(self, clean, name, response, step, init):
+        '''
+        Ensure that with the token cache enabled, a resent token is answered
+        from the cache without another GSSAPI handshake.
+        '''
+        self.app.config['KRB5_TOKEN_CACHE'] = True
+        self.manager.init_config(self.app.config)
+        state = object()
+        init.return_value = (kerberos.AUTH_GSS_COMPLETE, state)
+        step.return_value = kerberos.AUTH_GSS_COMPLETE
+        name.return_value = "user@EXAMPLE.ORG"
+        response.return_value = "STOKEN"
+        c = self.app.test_client()
+        for _ in range(2):
+            r = c.get('/', headers={'Authorization': 'Negotiate CTOKEN'})
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.data, b'user@EXAMPLE.ORG')
+            self.assertEqual(r.headers.get('WWW-Authenticate'), 'Negotiate STOKEN')
+        self.assertEqual(init.mock_calls, [mock.call('HTTP@example.org')])
+        stats = self.manager.stats()
+        self.assertEqual(stats['handshakes'], 1)
+        self.assertEqual(stats['token_cache']['hits'], 1)
+        self.assertEqual(stats['token_cache']['misses'], 1)
+
+    @mock.patch('kerberos.authGSSServerInit')
+    @mock.patch('kerberos.authGSSServerStep')
+    @mock.patch('kerberos.authGSSServerResponse')
+    @mock.patch('kerberos.authGSSServerUserName')
+    @mock.patch('kerberos.authGSSServerClean')
+    def test_timings(self, clean, name, response, step, init):
+        '''
+        Ensure that with timings enabled every GSSAPI phase is recorded.
+        '''
+        self.app.config['KRB5_TIMINGS'] = True
+        self.manager.init_config(self.app.config)
+        state = object()
+        init.return_value = (kerberos.AUTH_GSS_COMPLETE, state)
+        step.return_value = kerberos.AUTH_GSS_COMPLETE
+        name.return_value = "user@EXAMPLE.ORG"
+        response.return_value = "STOKEN"
+        r = self.app.test_client().get('/', headers={'Authorization': 'Negotiate CTOKEN'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(step.mock_calls, [mock.call(state, 'CTOKEN')])
+        timings = self.manager.stats()['timings']
+        for phase in ('init', 'step', 'username', 'response', 'clean', 'total'):
+            self.assertEqual(timings[phase]['count'], 1)
+
+    @mock.patch('kerberos.authGSSServerInit')
+    @mock.patch('kerberos.authGSSServerStep')
+    @mock.patch('kerberos.authGSSServerResponse')
+    @mock.patch('kerberos.authGSSServerUserName')
+    @mock.patch('kerberos.authGSSServerClean')
+    def test_multi_leg(self, clean, name, response, step, init):
+        '''
+        Ensure that with the context table enabled, a continued negotiation
+        is challenged with the server token and completed on the same
+        context by the next leg.
+        '''
+        self.app.config['KRB5_CONTEXT_TABLE'] = True
+        self.app.config['KRB5_CONTEXT_KEY'] = 'cookie'
+        self.manager.init_config(self.app.config)
+        state = object()
+        init.return_value = (kerberos.AUTH_GSS_COMPLETE, state)
+        step.side_effect = [kerberos.AUTH_GSS_CONTINUE, kerberos.AUTH_GSS_COMPLETE]
+        name.return_value = "user@EXAMPLE.ORG"
+        response.side_effect = ["STOKEN1", "STOKEN2"]
+        c = self.app.test_client()
+        r = c.get('/', headers={'Authorization': 'Negotiate CTOKEN1'})
+        self.assertEqual(r.status_code, 401)
+        self.assertEqual(r.headers.get('WWW-Authenticate'), 'Negotiate STOKEN1')
+        self.assertEqual(clean.mock_calls, [])
+        r = c.get('/', headers={'Authorization': 'Negotiate CTOKEN2'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers.get('WWW-Authenticate'), 'Negotiate STOKEN2')
+        self.assertEqual(init.mock_calls, [mock.call('HTTP@example.org')])
+        self.assertEqual(step.mock_calls, [mock.call(state, 'CTOKEN1'), mock.call(state, 'CTOKEN2')])
+        self.assertEqual(clean.mock_calls, [mock.call(state)])
+        self.assertEqual(self.manager.stats()['handshakes_continued'], 1)
+
+    @mock.patch('kerberos.authGSSServerInit')
+    @mock.patch('kerberos.authGSSServerStep')
+    @mock.patch('kerberos.authGSSServerResponse')
+    @mock.patch('kerberos.authGSSServerUserName')
+    @mock.patch('kerberos.authGSSServerClean')
+    def test_multi_leg_restart(self, clean, name, response, step, init):
+        '''
+        Ensure that an initial token arriving while a context is stored
+        releases that context and starts a new negotiation.
+        '''
+        self.app.config['KRB5_CONTEXT_TABLE'] = True
+        self.app.config['KRB5_CONTEXT_KEY'] = 'cookie'
+        self.manager.init_config(self.app.config)
+        states = [object(), object()]
+        init.side_effect = [(kerberos.AUTH_GSS_COMPLETE, state) for state in states]
+        step.side_effect = [kerberos.AUTH_GSS_CONTINUE, kerberos.AUTH_GSS_COMPLETE]
+        name.return_value = "user@EXAMPLE.ORG"
+        response.side_effect = ["STOKEN1", "STOKEN2"]
+        c = self.app.test_client()
+        r = c.get('/', headers={'Authorization': 'Negotiate YIIBCTOKEN1'})
+        self.assertEqual(r.status_code, 401)
+        r = c.get('/', headers={'Authorization': 'Negotiate YIIBCTOKEN2'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(step.mock_calls, [mock.call(states[0], 'YIIBCTOKEN1'),
+                                           mock.call(states[1], 'YIIBCTOKEN2')])
+        self.assertEqual(clean.mock_calls, [mock.call(states[0]), mock.call(states[1])])
+
+    @mock.patch('kerberos.authGSSServerInit')
+    @mock.patch('kerberos.authGSSServerStep')
+    @mock.patch('kerberos.authGSSServerResponse')
+    @mock.patch('kerberos.authGSSServerClean')
+    def test_multi_leg_without_port(self, clean, response, step, init):
+        '''
+        Ensure that no context is kept for a connection without a remote
+        port, which cannot be told apart from other connections.
+        '''
+        self.app.config['KRB5_CONTEXT_TABLE'] = True
+        self.manager.init_config(self.app.config)
+        state = object()
+        init.return_value = (kerberos.AUTH_GSS_COMPLETE, state)
+        step.return_value = kerberos.AUTH_GSS_CONTINUE
+        response.return_value = "STOKEN"
+        r = self.app.test_client().get('/', headers={'Authorization': 'Negotiate CTOKEN'})
+        self.assertEqual(r.status_code, 403)
+        self.assertEqual(clean.mock_calls, [mock.call(state)])
+        self.assertEqual(self.manager.stats()['contexts']['entries'], 0)
+
+    @mock.patch('kerberos.authGSSServerInit')
+    @mock.patch('kerberos.authGSSServerStep')
+    @mock.patch('kerberos.authGSSServerResponse')
+    @mock.patch('kerberos.authGSSServerClean')
+    def test_continue_without_context_table(self, clean, response, step, init):
+        '''
+        Ensure that a continued negotiation is refused and its context
+        released when contexts are not kept between legs.
+        '''
+        state = object()
+        init.return_value = (kerberos.AUTH_GSS_COMPLETE, state)
+        step.return_value = kerberos.AUTH_GSS_CONTINUE
+        response.return_value = "STOKEN"
+        r = self.app.test_client().get('/', headers={'Authorization': 'Negotiate CTOKEN'})
+        self.assertEqual(r.status_code, 403)
+        self.assertEqual(clean.mock_calls, [mock.call(state)])
+
+    @mock.patch('kerberos.authGSSServerInit')
+    @mock.patch('kerberos.authGSSServerStep')
+    @mock.patch('kerberos.authGSSServerResponse')
+    @mock.patch('kerberos.authGSSServerUserName')
+    @mock.patch('kerberos.authGSSServerClean')
+    def test_sidecar_fallback(self, clean, name, response, step, init):
+        '''
+        Ensure that tokens are verified in-process while the sidecar is
+        unreachable, and that the sidecar result is used otherwise.
+        '''
+        init.return_value = (kerberos.AUTH_GSS_COMPLETE, object())
+        step.return_value = kerberos.AUTH_GSS_COMPLETE
+        name.return_value = "user@EXAMPLE.ORG"
+        response.return_value = "STOKEN"
+        self.app.config['KRB5_SIDECAR_SOCKET'] = '/nonexistent/sidecar.sock'
+        self.manager.init_config(self.app.config)
+        c = self.app.test_client()
+        r = c.get('/', headers={'Authorization': 'Negotiate CTOKEN'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.manager.stats()['sidecar_fallbacks'], 1)
+
+        with mock.patch.object(self.manager._sidecar, 'authenticate') as authenticate:
+            authenticate.return_value = ('other@EXAMPLE.ORG', 'SIDECAR')
+            r = c.get('/', headers={'Authorization': 'Negotiate CTOKEN2'})
+        self.assertEqual(r.data, b'other@EXAMPLE.ORG')
+        self.assertEqual(r.headers.get('WWW-Authenticate'), 'Negotiate SIDECAR')
+        self.assertEqual(len(step.mock_calls), 1)
+
+    @mock.patch.dict('os.environ')
+    def test_keytab_watch_without_file(self):
+        '''
+        Ensure that the keytab watcher is refused when no keytab file is
+        known, as it would never see a change.
+        '''
+        os.environ.pop('KRB5_KTNAME', None)
+        self.app.config['KRB5_GSSAPI_BACKEND'] = 'gssapi'
+        self.app.config['KRB5_KEYTAB_WATCH_INTERVAL'] = 10
+        with self.assertRaises(ValueError):
+            self.manager.init_config(self.app.config)
+        os.environ['KRB5_KTNAME'] = 'MEMORY:keytab'
+        with self.assertRaises(ValueError):
+            self.manager.init_config(self.app.config)
+
+    @mock.patch('kerberos.getServerPrincipalDetails')
+    def test_sidecar_keytab_untouched(self, details):
+        '''
+        Ensure that workers using a sidecar do not read the keytab.
+        '''
+        self.app.config['KRB5_SIDECAR_SOCKET'] = '/nonexistent/sidecar.sock'
+        self.manager.init_config(self.app.config)
+        self.assertEqual(details.mock_calls, [])
+
+    def test_sidecar_down(self):
+        '''
+        Ensure that while the sidecar is down without fallback, tokens are
+        answered 503 without being negative-cached or charged to the client,
+        and are accepted again once the sidecar is back.
+        '''
+        self.app.config['KRB5_SIDECAR_SOCKET'] = '/nonexistent/sidecar.sock'
+        self.app.config['KRB5_SIDECAR_FALLBACK'] = False
+        self.app.config['KRB5_NEGATIVE_CACHE'] = True
+        self.app.config['KRB5_FAILURE_RATE'] = 0.001
+        self.app.config['KRB5_FAILURE_BURST'] = 1
+        self.manager.init_config(self.app.config)
+        c = self.app.test_client()
+        for _ in range(3):
+            r = c.get('/', headers={'Authorization': 'Negotiate CTOKEN'})
+            self.assertEqual(r.status_code, 503)
+        stats = self.manager.stats()
+        self.assertEqual(stats['handshakes_unavailable'], 3)
+        self.assertEqual(stats['negative_cache']['entries'], 0)
+
+        with mock.patch.object(self.manager._sidecar, 'authenticate') as authenticate:
+            authenticate.return_value = ('user@EXAMPLE.ORG', 'SIDECAR')
+            r = c.get('/', headers={'Authorization': 'Negotiate CTOKEN'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.data, b'user@EXAMPLE.ORG')
+
+    @mock.patch('kerberos.authGSSServerInit')
+    def test_init_failure(self, init):
+        '''
+        Ensure that a server context that cannot be created answers 503.
+        '''
+        init.side_effect = kerberos.GSSError('no credentials')
+        self.app.config['KRB5_NEGATIVE_CACHE'] = True
+        self.manager.init_config(self.app.config)
+        r = self.app.test_client().get('/', headers={'Authorization': 'Negotiate CTOKEN'})
+        self.assertEqual(r.status_code, 503)
+        self.assertEqual(self.manager.stats()['negative_cache']['entries'], 0)
+
+    @mock.patch('kerberos.authGSSServerInit')
+    @mock.patch('kerberos.authGSSServerStep')
+    @mock.patch('kerberos.authGSSServerResponse')
+    @mock.patch('kerberos.authGSSServerUserName')
+    @mock.patch('kerberos.authGSSServerClean')
+    @mock.patch.dict('os.environ')
+    def test_replay_detector(self, clean, name, response, step, init):
+        '''
+        Ensure that with the libkrb5 replay cache disabled, a token accepted
+        once is refused the second time.
+        '''
+        init.return_value = (kerberos.AUTH_GSS_COMPLETE, object())
+        step.return_value = kerberos.AUTH_GSS_COMPLETE
+        name.return_value = "user@EXAMPLE.ORG"
+        response.return_value = "STOKEN"
+        self.app.config['KRB5_DISABLE_RCACHE'] = True
+        self.app.config['KRB5_REPLAY_DETECTOR'] = 'sets'
+        self.manager.init_config(self.app.config)
+        self.assertEqual(os.environ['KRB5RCACHETYPE'], 'none')
+        c = self.app.test_client()
+        r = c.get('/', headers={'Authorization': 'Negotiate CTOKEN'})
+        self.assertEqual(r.status_code, 200)
+        r = c.get('/', headers={'Authorization': 'Negotiate CTOKEN'})
+        self.assertEqual(r.status_code, 403)
+        r = c.get('/', headers={'Authorization': 'Negotiate CTOKEN2'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.manager.stats()['replays'], 1)
+        self.assertEqual(self.manager.stats()['replay_detector']['checked'], 3)
+
+    @mock.patch.dict('os.environ', {'KRB5RCACHETYPE': 'dfl'})
+    def test_rcache_restored(self):
+        '''
+        Ensure that turning KRB5_DISABLE_RCACHE off again restores the
+        replay cache type it replaced.
+        '''
+        self.app.config['KRB5_DISABLE_RCACHE'] = True
+        self.manager.init_config(self.app.config)
+        self.manager.init_config(self.app.config)
+        self.assertEqual(os.environ['KRB5RCACHETYPE'], 'none')
+        self.app.config['KRB5_DISABLE_RCACHE'] = False
+        self.manager.init_config(self.app.config)
+        self.assertEqual(os.environ['KRB5RCACHETYPE'], 'dfl')
+        del os.environ['KRB5RCACHETYPE']
+        self.app.config['KRB5_DISABLE_RCACHE'] = True
+        self.manager.init_config(self.app.config)
+        self.app.config['KRB5_DISABLE_RCACHE'] = False
+        self.manager.init_config(self.app.config)
+        self.assertNotIn('KRB5RCACHETYPE', os.environ)
+
+
+HTTPS = 'https://localhost/'
+
+
+class AuthCookieTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app, self.manager = make_app(
+            KRB5_AUTH_COOKIE=True, KRB5_AUTH_COOKIE_KEYS=['secret'])
+
+    @mock.patch('kerberos.authGSSServerInit')
+    @mock.patch('kerberos.authGSSServerStep')
+    @mock.patch('kerberos.authGSSServerResponse')
+    @mock.patch('kerberos.authGSSServerUserName')
+    @mock.patch('kerberos.authGSSServerClean')
+    def test_cookie_replaces_handshake(self, clean, name, response, step, init):
+        '''
+        Ensure that the signed cookie issued after a handshake authenticates
+        later requests without a handshake, and that a forged one does not.
+        '''
+        init.return_value = (kerberos.AUTH_GSS_COMPLETE, object())
+        step.return_value = kerberos.AUTH_GSS_COMPLETE
+        name.return_value = "user@EXAMPLE.ORG"
+        response.return_value = "STOKEN"
+        c = self.app.test_client()
+        r = c.get('/', headers={'Authorization': 'Negotiate CTOKEN'}, base_url=HTTPS)
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('krb5_auth=', r.headers.get('Set-Cookie'))
+        self.assertIn('HttpOnly', r.headers.get('Set-Cookie'))
+        self.assertIn('Secure', r.headers.get('Set-Cookie'))
+
+        r = c.get('/', base_url=HTTPS)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.data, b'user@EXAMPLE.ORG')
+        self.assertEqual(self.manager.stats()['handshakes'], 1)
+        self.assertEqual(self.manager.stats()['handshakes_avoided'], 1)
+
+        c = self.app.test_client()
+        c.set_cookie('localhost', 'krb5_auth', 'dXNlcg.9999999999.00000000.AAAA')
+        r = c.get('/')
+        self.assertEqual(r.status_code, 401)
+        self.assertEqual(self.manager.stats()['auth_cookie']['invalid'], 1)
+
+    @mock.patch('kerberos.authGSSServerInit')
+    @mock.patch('kerberos.authGSSServerStep')
+    @mock.patch('kerberos.authGSSServerResponse')
+    @mock.patch('kerberos.authGSSServerUserName')
+    @mock.patch('kerberos.authGSSServerClean')
+    def test_logout(self, clean, name, response, step, init):
+        '''
+        Ensure that logout() expires the cookie, so that the next request
+        needs a handshake again.
+        '''
+        self.check_logout(clean, name, response, step, init)
+
+    @mock.patch('kerberos.authGSSServerInit')
+    @mock.patch('kerberos.authGSSServerStep')
+    @mock.patch('kerberos.authGSSServerResponse')
+    @mock.patch('kerberos.authGSSServerUserName')
+    @mock.patch('kerberos.authGSSServerClean')
+    def test_logout_without_session(self, clean, name, response, step, init):
+        '''
+        Ensure that logout() works without a SECRET_KEY, hence without
+        server sessions, which the auth cookie makes unnecessary.
+        '''
+        self.app, self.manager = make_app(
+            SECRET_KEY=None, KRB5_AUTH_COOKIE=True, KRB5_AUTH_COOKIE_KEYS=['secret'])
+        self.check_logout(clean, name, response, step, init)
+
+    def check_logout(self, clean, name, response, step, init):
+        @self.app.route('/logout')
+        def logout():
+            self.manager.logout()
+            return 'bye'
+
+        init.return_value = (kerberos.AUTH_GSS_COMPLETE, object())
+        step.return_value = kerberos.AUTH_GSS_COMPLETE
+        name.return_value = "user@EXAMPLE.ORG"
+        response.return_value = "STOKEN"
+        c = self.app.test_client()
+        r = c.get('/', headers={'Authorization': 'Negotiate CTOKEN'}, base_url=HTTPS)
+        self.assertEqual(r.status_code, 200)
+        r = c.get('/logout', base_url=HTTPS)
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('krb5_auth=;', r.headers.get('Set-Cookie'))
+        r = c.get('/', base_url=HTTPS)
+        self.assertEqual(r.status_code, 401)
+
+    def test_keys_required(self):
+        with self.assertRaises(ValueError):
+            self.manager.init_config({'KRB5_AUTH_COOKIE': True})
+
+
+class TrustedProxyTestCase(unittest.TestCase):
+    @mock.patch('kerberos.getServerPrincipalDetails')
+    def setUp(self, details):
+        self.app, self.manager = make_app(
+            KRB5_TRUSTED_PROXY=True, KRB5_TRUSTED_PROXIES=['127.0.0.0/8'])
+        self.assertEqual(details.mock_calls, [])
+
+    @mock.patch('kerberos.authGSSServerInit')
+    def test_trusted_header(self, init):
+        '''
+        Ensure that the principal header of an allow-listed proxy reaches the
+        save_user callback without any GSSAPI call, and that it is ignored
+        from other peers.
+        '''
+        c = self.app.test_client()
+        r = c.get('/', headers={'X-Remote-User': 'user@EXAMPLE.ORG',
+                                'Authorization': 'Negotiate CTOKEN'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.data, b'user@EXAMPLE.ORG')
+        self.assertEqual(self.app.saved, ['user@EXAMPLE.ORG'])
+        self.assertEqual(init.mock_calls, [])
+
+        r = c.get('/', headers={'X-Remote-User': 'admin@EXAMPLE.ORG'},
+                  environ_base={'REMOTE_ADDR': '192.0.2.1'})
+        self.assertEqual(r.status_code, 401)
+        self.assertEqual(self.app.saved, ['user@EXAMPLE.ORG'])
+        self.assertEqual(self.manager.stats()['proxy'], {'accepted': 1, 'untrusted': 1})
+
+    def test_no_gssapi_import(self):
+        '''
+        Ensure that in proxy mode neither pykerberos nor python-gssapi, hence
+        no libkrb5, is loaded, even with the gssapi backend installed.
+        '''
+        script = '\n'.join([
+            'import sys',
+            'import flask',
+            'import flask_kerberos_login',
+            'app = flask.Flask(__name__)',
+            "app.config.update(KRB5_TRUSTED_PROXY=True, KRB5_TRUSTED_PROXIES=['127.0.0.0/8'])",
+            'flask_kerberos_login.KerberosLoginManager(app)',
+            "app.test_client().get('/', headers={'X-Remote-User': 'user@EXAMPLE.ORG'})",
+            "print(sorted(name for name in ('gssapi', 'kerberos') if name in sys.modules))",
+        ])
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        output = subprocess.check_output([sys.executable, '-c', script], env=env)
+        self.assertEqual(output.strip(), b'[]')
+
+
+class UserCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app, self.manager = make_app(KRB5_USER_CACHE=True)
+
+    @mock.patch('kerberos.authGSSServerInit')
+    @mock.patch('kerberos.authGSSServerStep')
+    @mock.patch('kerberos.authGSSServerResponse')
+    @mock.patch('kerberos.authGSSServerUserName')
+    @mock.patch('kerberos.authGSSServerClean')
+    def test_callback_skipped(self, clean, name, response, step, init):
+        '''
+        Ensure that the save_user callback only runs once per principal
+        until the cached user is invalidated.
+        '''
+        init.return_value = (kerberos.AUTH_GSS_COMPLETE, object())
+        step.return_value = kerberos.AUTH_GSS_COMPLETE
+        name.return_value = "user@EXAMPLE.ORG"
+        response.return_value = "STOKEN"
+        c = self.app.test_client()
+        for _ in range(2):
+            r = c.get('/', headers={'Authorization': 'Negotiate CTOKEN'})
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.data, b'user@EXAMPLE.ORG')
+        self.assertEqual(self.app.saved, ['user@EXAMPLE.ORG'])
+
+        self.manager.invalidate_user('user@EXAMPLE.ORG')
+        r = c.get('/', headers={'Authorization': 'Negotiate CTOKEN'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.app.saved, ['user@EXAMPLE.ORG', 'user@EXAMPLE.ORG'])
+        self.assertEqual(self.manager.stats()['user_cache']['hits'], 1)
+
+
+class SessionFastPathTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app, self.manager = make_app(login_session=True, KRB5_SESSION_FAST_PATH=True)
+
+    @mock.patch('kerberos.authGSSServerInit')
+    @mock.patch('kerberos.authGSSServerStep')
+    @mock.patch('kerberos.authGSSServerResponse')
+    @mock.patch('kerberos.authGSSServerUserName')
+    @mock.patch('kerberos.authGSSServerClean')
+    def test_handshake_skipped_with_session(self, clean, name, response, step, init):
+        '''
+        Ensure that once a handshake established a session, later requests
+        that still carry a Negotiate header do not repeat the handshake.
+        '''
+        state = object()
+        init.return_value = (kerberos.AUTH_GSS_COMPLETE, state)
+        step.return_value = kerberos.AUTH_GSS_COMPLETE
+        name.return_value = "user@EXAMPLE.ORG"
+        response.return_value = "STOKEN"
+        c = self.app.test_client()
+        r = c.get('/', headers={'Authorization': 'Negotiate CTOKEN'})
+        self.assertEqual(r.status_code, 200)
+        r = c.get('/', headers={'Authorization': 'Negotiate CTOKEN'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.data, b'user@EXAMPLE.ORG')
+        self.assertEqual(init.mock_calls, [mock.call('HTTP@example.org')])
+        self.assertEqual(self.manager.stats()['handshakes'], 1)
+        self.assertEqual(self.manager.stats()['handshakes_avoided'], 1)
+
+    @mock.patch('kerberos.authGSSServerInit')
+    @mock.patch('kerberos.authGSSServerStep')
+    @mock.patch('kerberos.authGSSServerResponse')
+    @mock.patch('kerberos.authGSSServerUserName')
+    @mock.patch('kerberos.authGSSServerClean')
+    def test_handshake_without_session(self, clean, name, response, step, init):
+        '''
+        Ensure that clients without a session still perform a handshake.
+        '''
+        state = object()
+        init.return_value = (kerberos.AUTH_GSS_COMPLETE, state)
+        step.return_value = kerberos.AUTH_GSS_COMPLETE
+        name.return_value = "user@EXAMPLE.ORG"
+        response.return_value = "STOKEN"
+        r = self.app.test_client().get('/', headers={'Authorization': 'Negotiate CTOKEN'})
+        self.assertEqual(r.status_code, 200)
+        r = self.app.test_client().get('/', headers={'Authorization': 'Negotiate CTOKEN'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(init.mock_calls), 2)
+        self.assertEqual(self.manager.stats().get('handshakes_avoided', 0), 0)
+
+
+class RouteScopedTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app, self.manager = make_app(KRB5_GLOBAL_HOOK=False)
+
+        @self.app.route('/scoped')
+        @flask_kerberos_login.kerberos_required
+        def scoped():
+            return flask_login.current_user.id
+
+        blueprint = flask.Blueprint('private', __name__)
+
+        @blueprint.route('/private')
+        @flask_login.login_required
+        def private():
+            return flask_login.current_user.id
+
+        self.manager.init_blueprint(blueprint)
+        self.app.register_blueprint(blueprint)
+
+    def test_unauthorized(self):
+        r = self.app.test_client().get('/scoped')
+        self.assertEqual(r.status_code, 401)
+        self.assertEqual(r.headers.get('www-authenticate'), 'Negotiate')
+
+    @mock.patch('kerberos.authGSSServerInit')
+    def test_public_endpoint(self, init):
+        '''
+        Ensure that endpoints without the decorator never attempt a handshake.
+        '''
+        r = self.app.test_client().get('/health', headers={'Authorization': 'Negotiate CTOKEN'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(init.mock_calls, [])
+
+    @mock.patch('kerberos.authGSSServerInit')
+    @mock.patch('kerberos.authGSSServerStep')
+    @mock.patch('kerberos.authGSSServerResponse')
+    @mock.patch('kerberos.authGSSServerUserName')
+    @mock.patch('kerberos.authGSSServerClean')
+    def test_authorized(self, clean, name, response, step, init):
+        state = object()
+        init.return_value = (kerberos.AUTH_GSS_COMPLETE, state)
+        step.return_value = kerberos.AUTH_GSS_COMPLETE
+        name.return_value = "user@EXAMPLE.ORG"
+        response.return_value = "STOKEN"
+        c = self.app.test_client()
+        for path in ('/scoped', '/private'):
+            r = c.get(path, headers={'Authorization': 'Negotiate CTOKEN'})
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.data, b'user@EXAMPLE.ORG')
+            self.assertEqual(r.headers.get('WWW-Authenticate'), 'Negotiate STOKEN')
+        self.assertEqual(len(init.mock_calls), 2)
+
+
+class PolicyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app, self.manager = make_app(
+            KRB5_POLICY_ENDPOINTS={'health': 'exempt'},
+            KRB5_POLICY_PATHS={'/private': 'required'},
+        )
+
+        @self.app.route('/private/data')
+        def data():
+            return 'data'
+
+    @mock.patch('kerberos.authGSSServerInit')
+    def test_exempt(self, init):
+        r = self.app.test_client().get('/health', headers={'Authorization': 'Negotiate CTOKEN'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(init.mock_calls, [])
+
+    def test_required(self):
+        '''
+        Ensure that a required route challenges clients even when the view
+        itself does not require a login.
+        '''
+        r = self.app.test_client().get('/private/data')
+        self.assertEqual(r.status_code, 401)
+        self.assertEqual(r.headers.get('www-authenticate'), 'Negotiate')
+
+
+
+class LazyKerberosTestCase(unittest.TestCase):
+    def test_imports_once(self):
+        '''
+        Ensure that the proxy imports pykerberos once, then serves later
+        lookups from the bound module.
+        '''
+        proxy = manager._LazyKerberos()
+        self.assertEqual(proxy.AUTH_GSS_COMPLETE, kerberos.AUTH_GSS_COMPLETE)
+        self.assertIs(proxy._module, kerberos)
+        self.assertIs(manager.kerberos, kerberos)
+        with mock.patch.dict(sys.modules, {'kerberos': None}):
+            self.assertIs(proxy.authGSSServerInit, kerberos.authGSSServerInit)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,49 @@
+from flask_kerberos_login.mapping import PrincipalMapper, Rule, split_principal
+import unittest
+
+
+class SplitPrincipalTestCase(unittest.TestCase):
+    def test_split(self):
+        self.assertEqual(split_principal('user@EXAMPLE.ORG'), (['user'], 'EXAMPLE.ORG'))
+        self.assertEqual(split_principal('HTTP/web.example.org@EXAMPLE.ORG'),
+                         (['HTTP', 'web.example.org'], 'EXAMPLE.ORG'))
+        self.assertEqual(split_principal('us\\@er'), (['us@er'], None))
+
+
+class PrincipalMapperTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mapper = PrincipalMapper('''
+            RULE:[2:$1](admin)s/^.*$/root/
+            RULE:[1:$1@$0](.*@PARTNER\\.ORG)s/@PARTNER\\.ORG$/_partner/L
+            RULE:[2:$1@$0](.*@EXAMPLE\\.ORG)s/@.*//
+            DEFAULT
+        ''', local_realms=['EXAMPLE.ORG'])
+
+    def test_rules(self):
+        self.assertEqual(self.mapper.map('admin/host.example.org@EXAMPLE.ORG'), 'root')
+        self.assertEqual(self.mapper.map('Bob@PARTNER.ORG'), 'bob_partner')
+        self.assertEqual(self.mapper.map('HTTP/web.example.org@EXAMPLE.ORG'), 'HTTP')
+
+    def test_default(self):
+        self.assertEqual(self.mapper.map('user@EXAMPLE.ORG'), 'user')
+        self.assertEqual(self.mapper.map('user@OTHER.ORG'), None)
+
+    def test_memoized(self):
+        self.assertEqual(self.mapper.map('user@EXAMPLE.ORG'), 'user')
+        self.assertEqual(self.mapper.map('user@EXAMPLE.ORG'), 'user')
+        self.assertEqual(self.mapper.map('user@OTHER.ORG'), None)
+        self.assertEqual(self.mapper.map('user@OTHER.ORG'), None)
+        self.assertEqual(self.mapper.stats()['hits'], 2)
+        self.assertEqual(self.mapper.stats()['misses'], 2)
+
+    def test_group_replacement(self):
+        rule = Rule('RULE:[1:$1@$0](.*@EXAMPLE\\.ORG)s/(.*)@(.*)/$2_$1/g')
+        self.assertEqual(rule.apply(['user'], 'EXAMPLE.ORG', None), 'EXAMPLE.ORG_user')
+
+    def test_invalid_rule(self):
+        with self.assertRaises(ValueError):
+            PrincipalMapper(['RULE:[x:$1]'])
+
+
+if __name__ == '__main__':
+    unittest.main()
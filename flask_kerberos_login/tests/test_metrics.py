@@ -0,0 +1,109 @@
+from flask_kerberos_login import metrics
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+
+def sample_stats():
+    return {
+        'handshakes': 2,
+        'handshakes_completed': 1,
+        'token_cache': {'hits': 3, 'entries': 1},
+        'keytab_last_reload': 100.0,
+        'replay_detector': {'checked': 4, 'false_positive_rate': 0.25},
+        'timings': {
+            'step': {'count': 2, 'sum': 0.5, 'buckets': [(0.1, 1), (float('inf'), 2)]},
+        },
+    }
+
+
+class RenderTestCase(unittest.TestCase):
+    def test_render(self):
+        text = metrics.render(sample_stats())
+        self.assertIn('# TYPE kerberos_handshakes_total counter\nkerberos_handshakes_total 2\n', text)
+        self.assertIn('kerberos_handshakes_completed_total 1\n', text)
+        self.assertIn('kerberos_token_cache_hits_total 3\n', text)
+        self.assertIn('# TYPE kerberos_token_cache_entries gauge\nkerberos_token_cache_entries 1\n', text)
+        self.assertIn('# TYPE kerberos_keytab_last_reload gauge\n', text)
+        self.assertIn('# TYPE kerberos_replay_detector_false_positive_rate gauge\n'
+                      'kerberos_replay_detector_false_positive_rate 0.25\n', text)
+        self.assertIn('kerberos_gssapi_phase_seconds_bucket{phase="step",le="0.1"} 1\n', text)
+        self.assertIn('kerberos_gssapi_phase_seconds_bucket{phase="step",le="+Inf"} 2\n', text)
+        self.assertIn('kerberos_gssapi_phase_seconds_count{phase="step"} 2\n', text)
+
+    def test_render_nested_histogram(self):
+        text = metrics.render({'write_behind': {
+            'depth': 1,
+            'flush_seconds': {'count': 1, 'sum': 0.5, 'buckets': [(float('inf'), 1)]},
+        }})
+        self.assertIn('# TYPE kerberos_write_behind_depth gauge\n', text)
+        self.assertIn('# TYPE kerberos_write_behind_flush_seconds histogram\n', text)
+        self.assertIn('kerberos_write_behind_flush_seconds_bucket{le="+Inf"} 1\n', text)
+        self.assertIn('kerberos_write_behind_flush_seconds_count 1\n', text)
+
+    def test_merge(self):
+        other = sample_stats()
+        other['keytab_last_reload'] = 50.0
+        other['replay_detector']['false_positive_rate'] = 0.5
+        other['forbidden'] = 1
+        stats = metrics.merge(metrics.merge({}, sample_stats()), other)
+        self.assertEqual(stats['handshakes'], 4)
+        self.assertEqual(stats['forbidden'], 1)
+        self.assertEqual(stats['token_cache'], {'hits': 6, 'entries': 2})
+        self.assertEqual(stats['keytab_last_reload'], 100.0)
+        self.assertEqual(stats['replay_detector'], {'checked': 8, 'false_positive_rate': 0.5})
+        self.assertEqual(stats['timings']['step']['buckets'], [(0.1, 2), (float('inf'), 4)])
+
+
+class FakeManager(object):
+    def stats(self):
+        return sample_stats()
+
+
+class ExporterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_shared_directory(self):
+        '''
+        Ensure that statistics written by other workers are aggregated.
+        '''
+        with open('{}/1.json'.format(self.directory), 'w') as f:
+            f.write('{"handshakes": 5}')
+        exporter = metrics.MetricsExporter(FakeManager(), self.directory)
+        self.assertEqual(exporter.collect()['handshakes'], 7)
+
+    def write_worker(self, pid, age=0):
+        path = '{}/{}.json'.format(self.directory, pid)
+        with open(path, 'w') as f:
+            f.write('{"handshakes": 5, "token_cache": {"hits": 1, "entries": 3}}')
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+
+    def test_dead_worker(self):
+        '''
+        Ensure that an exited worker's counters still count, but not its
+        gauges.
+        '''
+        child = subprocess.Popen([sys.executable, '-c', ''])
+        child.wait()
+        self.write_worker(child.pid)
+        stats = metrics.MetricsExporter(FakeManager(), self.directory).collect()
+        self.assertEqual(stats['handshakes'], 7)
+        self.assertEqual(stats['token_cache'], {'hits': 4, 'entries': 1})
+
+    def test_stale_worker(self):
+        self.write_worker(os.getppid(), age=100)
+        exporter = metrics.MetricsExporter(FakeManager(), self.directory, max_age=60)
+        self.assertEqual(exporter.collect()['token_cache'], {'hits': 4, 'entries': 1})
+        self.write_worker(os.getppid())
+        self.assertEqual(exporter.collect()['token_cache'], {'hits': 4, 'entries': 4})
+
+
+if __name__ == '__main__':
+    unittest.main()
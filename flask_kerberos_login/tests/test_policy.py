@@ -0,0 +1,37 @@
+from flask_kerberos_login.policy import PolicyTable, REQUIRED, OPTIONAL, EXEMPT
+import unittest
+
+
+class PolicyTableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.table = PolicyTable(
+            endpoints={'login': REQUIRED, 'static': EXEMPT},
+            blueprints={'admin': REQUIRED},
+            paths={'/api': REQUIRED, '/api/public/': EXEMPT, '/': OPTIONAL},
+            default=EXEMPT,
+        )
+
+    def test_endpoint(self):
+        self.assertEqual(self.table.lookup('login', None, '/api/public/login'), REQUIRED)
+        self.assertEqual(self.table.lookup('static', 'admin', '/static/app.js'), EXEMPT)
+
+    def test_blueprint(self):
+        self.assertEqual(self.table.lookup('admin.index', 'admin', '/api/public/'), REQUIRED)
+
+    def test_longest_prefix(self):
+        self.assertEqual(self.table.lookup(None, None, '/api/users'), REQUIRED)
+        self.assertEqual(self.table.lookup(None, None, '/api/public/status'), EXEMPT)
+        self.assertEqual(self.table.lookup(None, None, '/apis'), OPTIONAL)
+
+    def test_default(self):
+        table = PolicyTable(default=EXEMPT)
+        self.assertEqual(table.lookup('index', None, '/'), EXEMPT)
+        self.assertFalse(PolicyTable())
+
+    def test_invalid_policy(self):
+        with self.assertRaises(ValueError):
+            PolicyTable(endpoints={'index': 'sometimes'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+from flask_kerberos_login.prevalidate import inspect_token, MALFORMED, UNSUPPORTED, VALID
+from flask_kerberos_login.prevalidate import is_initial_token
+import unittest
+
+
+# SPNEGO NegTokenInit offering Kerberos, then NTLM
+SPNEGO_KERBEROS = 'YCcGBisGAQUFAqAdMBugGTAXBgkqhkiG9xIBAgIGCisGAQQBgjcCAgo='
+# SPNEGO NegTokenInit offering NTLM only
+SPNEGO_NTLM = 'YBwGBisGAQUFAqASMBCgDjAMBgorBgEEAYI3AgIK'
+# Raw Kerberos initial context token
+KERBEROS = 'YBAGCSqGSIb3EgECAgEAbgMCAQU='
+# Raw NTLMSSP negotiate message
+NTLMSSP = 'TlRMTVNTUAABAAAA'
+
+
+class InspectTokenTestCase(unittest.TestCase):
+    def test_valid(self):
+        self.assertEqual(inspect_token(SPNEGO_KERBEROS), (VALID, 'spnego'))
+        self.assertEqual(inspect_token(KERBEROS), (VALID, 'kerberos'))
+
+    def test_ntlm(self):
+        self.assertEqual(inspect_token(NTLMSSP), (UNSUPPORTED, 'ntlm'))
+        self.assertEqual(inspect_token(SPNEGO_NTLM), (UNSUPPORTED, 'ntlm'))
+
+    def test_empty(self):
+        self.assertEqual(inspect_token(''), (UNSUPPORTED, 'empty'))
+
+    def test_malformed(self):
+        self.assertEqual(inspect_token('CTOKEN'), (MALFORMED, 'not_base64'))
+        self.assertEqual(inspect_token('Q1RPS0VO'), (MALFORMED, 'not_gssapi'))
+        self.assertEqual(inspect_token(KERBEROS, max_length=8), (MALFORMED, 'too_long'))
+
+
+class InitialTokenTestCase(unittest.TestCase):
+    def test_initial(self):
+        self.assertTrue(is_initial_token(SPNEGO_KERBEROS))
+        self.assertTrue(is_initial_token(KERBEROS))
+
+    def test_continued(self):
+        self.assertFalse(is_initial_token('oRswGaADCgEB'))
+        self.assertFalse(is_initial_token(NTLMSSP))
+        self.assertFalse(is_initial_token('CTOKEN'))
+        self.assertFalse(is_initial_token(''))
+
+
+if __name__ == '__main__':
+    unittest.main()
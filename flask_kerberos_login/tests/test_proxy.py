@@ -0,0 +1,52 @@
+from flask_kerberos_login.proxy import TrustedProxy, sign
+import unittest
+
+
+class TrustedProxyTestCase(unittest.TestCase):
+    def test_networks(self):
+        proxy = TrustedProxy(proxies=['10.0.0.0/8', '192.0.2.1', '2001:db8::/32'])
+        self.assertTrue(proxy.trusted_peer('10.1.2.3'))
+        self.assertTrue(proxy.trusted_peer('192.0.2.1'))
+        self.assertTrue(proxy.trusted_peer('2001:db8::1'))
+        self.assertFalse(proxy.trusted_peer('192.0.2.2'))
+        self.assertFalse(proxy.trusted_peer('11.0.0.1'))
+        self.assertFalse(proxy.trusted_peer('2001:db9::1'))
+        self.assertFalse(proxy.trusted_peer('not an address'))
+        self.assertFalse(proxy.trusted_peer(None))
+
+    def test_principal(self):
+        proxy = TrustedProxy(proxies='127.0.0.1')
+        environ = {'REMOTE_ADDR': '127.0.0.1', 'HTTP_X_REMOTE_USER': 'user@EXAMPLE.ORG'}
+        self.assertEqual(proxy.principal(environ), 'user@EXAMPLE.ORG')
+        environ['REMOTE_ADDR'] = '192.0.2.1'
+        self.assertEqual(proxy.principal(environ), None)
+        self.assertEqual(proxy.stats(), {'accepted': 1, 'untrusted': 1})
+
+    def test_signature(self):
+        now = [1000000]
+        proxy = TrustedProxy(secret='secret', max_age=30, clock=lambda: now[0])
+        environ = {
+            'REMOTE_ADDR': '192.0.2.1',
+            'HTTP_X_REMOTE_USER': 'user@EXAMPLE.ORG',
+            'HTTP_X_REMOTE_USER_SIGNATURE': sign('secret', 'user@EXAMPLE.ORG', now[0]),
+        }
+        self.assertEqual(proxy.principal(environ), 'user@EXAMPLE.ORG')
+        now[0] += 31
+        self.assertEqual(proxy.principal(environ), None)
+        now[0] -= 31
+        environ['HTTP_X_REMOTE_USER'] = 'admin@EXAMPLE.ORG'
+        self.assertEqual(proxy.principal(environ), None)
+        environ['HTTP_X_REMOTE_USER_SIGNATURE'] = sign('other', 'admin@EXAMPLE.ORG', now[0])
+        self.assertEqual(proxy.principal(environ), None)
+        environ['HTTP_X_REMOTE_USER_SIGNATURE'] = 'garbage'
+        self.assertEqual(proxy.principal(environ), None)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            TrustedProxy()
+        with self.assertRaises(ValueError):
+            TrustedProxy(proxies=['10.0.0.0/33'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import base64
+from flask_kerberos_login import replay
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+
+def der(tag, value):
+    if len(value) < 0x80:
+        return bytearray([tag, len(value)]) + value
+    return bytearray([tag, 0x82, len(value) >> 8, len(value) & 0xff]) + value
+
+
+def ap_req_token(cipher, spnego=True):
+    authenticator = der(0x30, der(0xa0, der(0x02, bytearray(b'\x12'))) +
+                        der(0xa2, der(0x04, bytearray(cipher))))
+    ap_req = der(0x6e, der(0x30, der(0xa0, der(0x02, bytearray(b'\x05'))) +
+                           der(0xa3, der(0x61, bytearray(b'ticket' * 40))) +
+                           der(0xa4, authenticator)))
+    token = der(0x60, bytearray(replay.OID_KRB5) + bytearray(b'\x01\x00') + ap_req)
+    if spnego:
+        token = der(0x60, bytearray(b'\x06\x06\x2b\x06\x01\x05\x05\x02') +
+                    der(0xa0, der(0x30, der(0xa2, der(0x04, token)))))
+    return base64.b64encode(bytes(token)).decode('ascii')
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000000.0
+
+    def __call__(self):
+        return self.now
+
+
+class AuthenticatorDigestTestCase(unittest.TestCase):
+    def test_authenticator(self):
+        expected = hashlib.sha256(b'authenticator').digest()
+        self.assertEqual(replay.authenticator_digest(ap_req_token(b'authenticator')), expected)
+        self.assertEqual(
+            replay.authenticator_digest(ap_req_token(b'authenticator', spnego=False)), expected)
+
+    def test_other_token(self):
+        token = base64.b64encode(b'not kerberos').decode('ascii')
+        self.assertEqual(replay.authenticator_digest(token),
+                         hashlib.sha256(b'not kerberos').digest())
+
+
+class ReplayDetectorTestCase(unittest.TestCase):
+    def make(self, clock):
+        return replay.ReplayDetector(window=300, clock=clock)
+
+    def test_replay(self):
+        clock = Clock()
+        detector = self.make(clock)
+        first = hashlib.sha256(b'first').digest()
+        second = hashlib.sha256(b'second').digest()
+        self.assertFalse(detector.check(first))
+        self.assertTrue(detector.check(first))
+        self.assertFalse(detector.check(second))
+        # Still remembered two windows later, forgotten after three
+        clock.now += 600
+        self.assertTrue(detector.check(first))
+        clock.now += 300
+        self.assertFalse(detector.check(first))
+        self.assertEqual(detector.stats()['replays'], 2)
+
+
+class BloomReplayDetectorTestCase(ReplayDetectorTestCase):
+    def make(self, clock):
+        return replay.BloomReplayDetector(window=300, capacity=1000, error_rate=1e-4,
+                                          clock=clock)
+
+    def test_false_positive_accounting(self):
+        detector = self.make(Clock())
+        self.assertEqual(detector.false_positive_rate(), 0)
+        for n in range(1000):
+            detector.check(hashlib.sha256(str(n).encode('ascii')).digest())
+        rate = detector.stats()['false_positive_rate']
+        self.assertGreater(rate, 1e-5)
+        self.assertLess(rate, 1e-3)
+
+    def test_shared_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'replay')
+        clock = Clock()
+        first = replay.BloomReplayDetector(capacity=1000, path=path, clock=clock)
+        second = replay.BloomReplayDetector(capacity=1000, path=path, clock=clock)
+        self.addCleanup(first.close)
+        self.addCleanup(second.close)
+        digest = hashlib.sha256(b'first').digest()
+        self.assertFalse(first.check(digest))
+        self.assertTrue(second.check(digest))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+from flask_kerberos_login import sidecar
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import unittest
+
+
+class FakeAcceptor(object):
+    def __init__(self):
+        self.tokens = []
+
+    def __call__(self, token):
+        self.tokens.append(token)
+        if token.startswith('SLOW'):
+            time.sleep(0.2)
+        if token == 'CRASH':
+            raise RuntimeError(token)
+        if token.startswith('BAD'):
+            return None, None
+        return 'user{}@EXAMPLE.ORG'.format(token[-1]), 'S' + token
+
+
+class SidecarTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'sidecar.sock')
+        self.acceptor = FakeAcceptor()
+        self.server = sidecar.SidecarServer(self.path, self.acceptor, workers=4)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.close)
+        self.client = sidecar.SidecarClient(self.path, pool_size=1, timeout=2)
+        self.addCleanup(self.client.close)
+
+    def test_authenticate(self):
+        self.assertEqual(self.client.authenticate('TOKEN1'), ('user1@EXAMPLE.ORG', 'STOKEN1'))
+        self.assertEqual(self.client.authenticate('BAD'), (None, None))
+        with self.assertRaises(sidecar.SidecarUnavailable):
+            self.client.authenticate('CRASH')
+        self.assertEqual(self.client.stats(), {'connections': 1, 'requests': 3, 'failures': 1})
+
+    def test_pipelining(self):
+        '''
+        Ensure that requests of several threads share one connection and
+        that a slow token does not hold back the responses sent after it.
+        '''
+        results = {}
+
+        def call(token):
+            start = time.time()
+            results[token] = self.client.authenticate(token), time.time() - start
+
+        threads = [threading.Thread(target=call, args=(token,))
+                   for token in ['SLOW1', 'TOKEN2', 'TOKEN3']]
+        threads[0].start()
+        time.sleep(0.05)
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results['SLOW1'][0], ('user1@EXAMPLE.ORG', 'SSLOW1'))
+        self.assertEqual(results['TOKEN3'][0], ('user3@EXAMPLE.ORG', 'STOKEN3'))
+        self.assertLess(results['TOKEN2'][1], 0.15)
+        self.assertEqual(self.client.stats()['connections'], 1)
+
+    def test_timeout(self):
+        '''
+        Ensure that the sidecar is not tried again for a while after a
+        timeout or an error response.
+        '''
+        client = sidecar.SidecarClient(self.path, timeout=0.05, retry_interval=0.1)
+        self.addCleanup(client.close)
+        for token in ['SLOW1', 'CRASH']:
+            with self.assertRaises(sidecar.SidecarUnavailable):
+                client.authenticate(token)
+            with self.assertRaises(sidecar.SidecarUnavailable):
+                client.authenticate('TOKEN1')
+            time.sleep(0.1)
+        self.assertEqual(client.authenticate('TOKEN1'), ('user1@EXAMPLE.ORG', 'STOKEN1'))
+        self.assertEqual(self.acceptor.tokens.count('TOKEN1'), 1)
+
+    def test_mode(self):
+        path = os.path.join(self.directory, 'private.sock')
+        server = sidecar.SidecarServer(path, self.acceptor, workers=1, mode=0o600)
+        self.addCleanup(server.close)
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+
+    def test_unavailable(self):
+        client = sidecar.SidecarClient(os.path.join(self.directory, 'missing.sock'),
+                                       retry_interval=60)
+        for n in range(2):
+            with self.assertRaises(sidecar.SidecarUnavailable):
+                client.authenticate('TOKEN1')
+        self.assertEqual(client.stats()['failures'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
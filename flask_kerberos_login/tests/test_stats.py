@@ -0,0 +1,29 @@
+from flask_kerberos_login.stats import Counters, Histogram
+import unittest
+
+
+class CountersTestCase(unittest.TestCase):
+    def test_incr(self):
+        counters = Counters()
+        counters.incr('a')
+        counters.incr('a', 2)
+        self.assertEqual(counters.get('a'), 3)
+        self.assertEqual(counters.get('b'), 0)
+        self.assertEqual(counters.snapshot(), {'a': 3})
+
+
+class HistogramTestCase(unittest.TestCase):
+    def test_cumulative_buckets(self):
+        histogram = Histogram(buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.1)
+        histogram.observe(0.5)
+        histogram.observe(10)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['count'], 4)
+        self.assertAlmostEqual(snapshot['sum'], 10.65)
+        self.assertEqual(snapshot['buckets'], [(0.1, 2), (1.0, 3), (float('inf'), 4)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+from flask_kerberos_login.writer import WriteBehindQueue
+import threading
+import unittest
+
+
+class WriteBehindQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.queue = WriteBehindQueue(self.batches.append, interval=60)
+        self.addCleanup(self.queue.close)
+
+    def test_coalescing(self):
+        '''
+        Ensure that principals submitted within a flush window are persisted
+        once, in submission order.
+        '''
+        for principal in ('a@EXAMPLE.ORG', 'b@EXAMPLE.ORG', 'a@EXAMPLE.ORG'):
+            self.queue.submit(principal)
+        self.assertEqual(self.queue.stats()['depth'], 2)
+        self.queue.flush()
+        self.assertEqual(self.batches, [['a@EXAMPLE.ORG', 'b@EXAMPLE.ORG']])
+        stats = self.queue.stats()
+        self.assertEqual(stats['depth'], 0)
+        self.assertEqual(stats['coalesced'], 1)
+        self.assertEqual(stats['flushed'], 2)
+        self.assertEqual(stats['flush_seconds']['count'], 1)
+
+    def test_flush_on_close(self):
+        self.queue.submit('a@EXAMPLE.ORG')
+        self.queue.close()
+        self.assertEqual(self.batches, [['a@EXAMPLE.ORG']])
+
+    def test_early_flush(self):
+        '''
+        Ensure that a full batch is flushed by the background thread without
+        waiting for the interval.
+        '''
+        flushed = threading.Event()
+        queue = WriteBehindQueue(lambda batch: flushed.set(), interval=60, max_batch=2)
+        self.addCleanup(queue.close)
+        queue.submit('a@EXAMPLE.ORG')
+        queue.submit('b@EXAMPLE.ORG')
+        self.assertTrue(flushed.wait(5))
+
+    def test_failed_flush_requeued(self):
+        def fail(batch):
+            raise IOError('database unavailable')
+        queue = WriteBehindQueue(fail, interval=60)
+        queue.submit('a@EXAMPLE.ORG')
+        queue.flush()
+        self.assertEqual(queue.stats()['depth'], 1)
+        self.assertEqual(queue.stats()['failures'], 1)
+        queue._flush = self.batches.append
+        queue.close()
+        self.assertEqual(self.batches, [['a@EXAMPLE.ORG']])
+
+    def test_bounded_while_failing(self):
+        '''
+        Ensure that while the callback fails, the queue stays bounded by
+        dropping principals, never flushes from `submit` and backs off.
+        '''
+        attempts = []
+
+        def fail(batch):
+            attempts.append(batch)
+            raise IOError('database unavailable')
+        queue = WriteBehindQueue(fail, interval=60, max_batch=2, max_pending=3,
+                                 max_backoff=100)
+        queue.submit('a@EXAMPLE.ORG')
+        queue.flush()
+        self.assertGreaterEqual(queue._retry_at, 60)
+        for n in range(50):
+            queue.submit('{}@EXAMPLE.ORG'.format(n))
+        self.assertEqual(len(attempts), 1)
+        stats = queue.stats()
+        self.assertEqual(stats['depth'], 3)
+        self.assertEqual(stats['dropped'], 48)
+        queue.flush()
+        self.assertEqual(attempts[1][0], 'a@EXAMPLE.ORG')
+        self.assertEqual(queue._backoff, 100)
+        queue._flush = self.batches.append
+        queue.close()
+        self.assertEqual(self.batches, [['a@EXAMPLE.ORG', '0@EXAMPLE.ORG', '1@EXAMPLE.ORG']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import flask
+import flask_login
+import flask_kerberos_login
+import flask_kerberos_login.policy
+from flask_kerberos_login.tests.test_manager import make_app
+from flask_kerberos_login.wsgi import KerberosMiddleware
+import kerberos
+import mock
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+import unittest
+
+
+def make_wsgi_app(saved):
+    '''
+    Returns an app of `make_app` recording principals in `saved`, with a
+    view showing the current user and the REMOTE_USER set by the middleware
+    '''
+    app, _ = make_app()
+    app.saved = saved
+
+    @app.route('/whoami')
+    @flask_login.login_required
+    def whoami():
+        return '{} {}'.format(flask_login.current_user.id,
+                              flask.request.environ.get('REMOTE_USER'))
+
+    return app
+
+
+class MiddlewareTestCase(unittest.TestCase):
+    def setUp(self):
+        self.manager = flask_kerberos_login.KerberosLoginManager()
+        self.manager.init_config({
+            'KRB5_SERVICE_NAME': 'HTTP',
+            'KRB5_HOSTNAME': 'example.org',
+            'KRB5_TOKEN_CACHE': True,
+            'KRB5_AUTH_TO_LOCAL': 'RULE:[1:$1@$0](.*@EXAMPLE\\.ORG)s/@.*//',
+            'KRB5_POLICY_PATHS': {'/api/public': 'exempt'},
+        })
+        self.saved = []
+        dispatcher = DispatcherMiddleware(make_wsgi_app(self.saved),
+                                          {'/api': make_wsgi_app(self.saved)})
+        self.client = Client(KerberosMiddleware(dispatcher, self.manager), Response)
+
+    @mock.patch('kerberos.authGSSServerInit')
+    @mock.patch('kerberos.authGSSServerStep')
+    @mock.patch('kerberos.authGSSServerResponse')
+    @mock.patch('kerberos.authGSSServerUserName')
+    @mock.patch('kerberos.authGSSServerClean')
+    def test_shared_manager(self, clean, name, response, step, init):
+        init.return_value = (kerberos.AUTH_GSS_COMPLETE, object())
+        step.return_value = kerberos.AUTH_GSS_COMPLETE
+        name.return_value = 'user@EXAMPLE.ORG'
+        response.return_value = 'STOKEN'
+        for path in ['/whoami', '/api/whoami', '/api/whoami']:
+            r = self.client.get(path, headers={'Authorization': 'Negotiate CTOKEN'})
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.data, b'user@EXAMPLE.ORG user')
+            self.assertEqual(r.headers.get('WWW-Authenticate'), 'Negotiate STOKEN')
+        self.assertEqual(len(step.mock_calls), 1)
+        self.assertEqual(self.saved, ['user@EXAMPLE.ORG'] * 3)
+        self.assertEqual(self.manager.stats()['token_cache']['hits'], 2)
+
+    @mock.patch('kerberos.authGSSServerInit')
+    @mock.patch('kerberos.authGSSServerStep')
+    @mock.patch('kerberos.authGSSServerUserName')
+    @mock.patch('kerberos.authGSSServerClean')
+    def test_short_circuit(self, clean, name, step, init):
+        init.return_value = (kerberos.AUTH_GSS_COMPLETE, object())
+        step.side_effect = kerberos.GSSError(('', 0), ('', 0))
+        with mock.patch('flask.Flask.request_context') as request_context:
+            r = self.client.get('/', headers={'Authorization': 'Negotiate CTOKEN'})
+            self.assertEqual(r.status_code, 403)
+            self.assertEqual(request_context.mock_calls, [])
+
+        name.return_value = 'user@OTHER.ORG'
+        step.side_effect = None
+        step.return_value = kerberos.AUTH_GSS_COMPLETE
+        r = self.client.get('/', headers={'Authorization': 'Negotiate OTHER'})
+        self.assertEqual(r.status_code, 403)
+        self.assertEqual(self.saved, [])
+        self.assertEqual(self.manager.stats()['unmapped'], 1)
+
+    def test_unauthorized(self):
+        r = self.client.get('/api/')
+        self.assertEqual(r.status_code, 401)
+        self.assertEqual(r.headers.get_all('WWW-Authenticate'), ['Negotiate'])
+
+    def test_required(self):
+        self.manager._policy = flask_kerberos_login.policy.PolicyTable(paths={'/': 'required'})
+        r = self.client.get('/api/')
+        self.assertEqual(r.status_code, 401)
+        self.assertEqual(r.headers.get_all('WWW-Authenticate'), ['Negotiate'])
+        self.assertEqual(self.manager.stats()['challenges'], 1)
+
+    def test_exempt(self):
+        with mock.patch.object(self.manager, '_authenticate') as authenticate:
+            self.client.get('/api/public', headers={'Authorization': 'Negotiate CTOKEN'})
+        self.assertEqual(authenticate.mock_calls, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+'''
+Write-behind persistence of authenticated principals
+
+Persisting a user inside the request that first authenticates it puts a
+database round trip on the hot path. The `WriteBehindQueue` instead collects
+principals and hands them to a persistence callback in batches, from a
+background thread. A principal submitted several times within a flush window
+is written once.
+
+When the callback fails, the batch is queued again and the thread backs off
+before retrying. The queue never grows beyond `max_pending` principals:
+further principals are dropped, and counted, rather than written from the
+request.
+'''
+from __future__ import absolute_import, print_function, unicode_literals
+
+from collections import OrderedDict
+import logging
+import os
+import threading
+import time
+
+from flask_kerberos_login.stats import Histogram
+
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+class WriteBehindQueue(object):
+    '''
+    Parameters:
+        flush (callable): persists a list of principals
+        interval (float): seconds between two flushes
+        max_batch (int): pending principals that trigger an early flush
+        max_pending (int): pending principals beyond which new principals
+            are dropped, so memory stays bounded when `flush` is slow or fails
+        max_backoff (float): maximum seconds between two attempts after
+            failed flushes; the delay doubles from `interval` on each failure
+    '''
+
+    def __init__(self, flush, interval=1.0, max_batch=500, max_pending=10000,
+                 max_backoff=60):
+        self._flush = flush
+        self.interval = interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        # Serializes flushes, so batches are written in submission order
+        self._flush_lock = threading.Lock()
+        self._pending = OrderedDict()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._backoff = 0
+        self._retry_at = 0
+        self.submitted = 0
+        self.coalesced = 0
+        self.flushed = 0
+        self.failures = 0
+        self.dropped = 0
+        self.flush_seconds = Histogram()
+
+    def submit(self, principal):
+        '''
+        Queues `principal` for persistence
+        '''
+        self._start()
+        with self._lock:
+            self.submitted += 1
+            if principal in self._pending:
+                self.coalesced += 1
+                return
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            self._pending[principal] = True
+            wakeup = len(self._pending) >= self.max_batch and _monotonic() >= self._retry_at
+        if wakeup:
+            self._wakeup.set()
+
+    def flush(self):
+        '''
+        Persists all pending principals now. Principals of a failed batch are
+        queued again, ahead of newer ones, and the background thread waits
+        before the next attempt.
+        '''
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                batch = list(self._pending)
+                self._pending.clear()
+            start = _monotonic()
+            try:
+                self._flush(batch)
+            except Exception:
+                log.warn('Unable to persist %d users', len(batch), exc_info=True)
+                with self._lock:
+                    self.failures += 1
+                    self._backoff = min(max(2 * self._backoff, self.interval), self.max_backoff)
+                    self._retry_at = _monotonic() + self._backoff
+                    pending = OrderedDict((principal, True) for principal in batch)
+                    for principal in self._pending:
+                        pending.setdefault(principal, True)
+                    while len(pending) > self.max_pending:
+                        pending.popitem()
+                        self.dropped += 1
+                    self._pending = pending
+                return
+            finally:
+                self.flush_seconds.observe(_monotonic() - start)
+            with self._lock:
+                self.flushed += len(batch)
+                self._backoff = 0
+                self._retry_at = 0
+
+    def close(self):
+        '''
+        Stops the background thread and flushes pending principals
+        '''
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join()
+        self._thread = None
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'depth': len(self._pending),
+                'submitted': self.submitted,
+                'coalesced': self.coalesced,
+                'flushed': self.flushed,
+                'failures': self.failures,
+                'dropped': self.dropped,
+            }
+        stats['flush_seconds'] = self.flush_seconds.snapshot()
+        return stats
+
+    def _start(self):
+        # Threads do not survive a fork, e.g. by a pre-fork server
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name='krb5-write-behind')
+                self._thread.daemon = True
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if _monotonic() >= self._retry_at:
+                self.flush()
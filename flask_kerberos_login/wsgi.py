@@ -0,0 +1,167 @@
+'''
+Authenticates requests in a WSGI middleware, before any Flask dispatch
+
+Usage::
+
+    from werkzeug.middleware.dispatcher import DispatcherMiddleware
+    from flask_kerberos_login import KerberosLoginManager
+    from flask_kerberos_login.wsgi import KerberosMiddleware
+
+    manager = KerberosLoginManager()
+    manager.init_config({'KRB5_TOKEN_CACHE': True})
+    application = KerberosMiddleware(
+        DispatcherMiddleware(frontend, {'/api': api}), manager)
+
+The middleware runs the handshake with the manager's caches, limiter and
+context table, then sets ``REMOTE_USER`` and ``kerberos.principal`` in the
+WSGI environ. Rejected requests are answered directly, without a Flask
+request context. Flask apps behind it that use their own
+`KerberosLoginManager` trust ``kerberos.principal`` and only run their
+`save_user` callback.
+'''
+from __future__ import absolute_import, print_function, unicode_literals
+
+import logging
+
+from werkzeug.exceptions import Forbidden
+from werkzeug.exceptions import HTTPException
+from werkzeug.exceptions import Unauthorized
+from werkzeug.http import dump_cookie
+
+from flask_kerberos_login.manager import ENVIRON_NEGOTIATION
+from flask_kerberos_login.manager import ENVIRON_PRINCIPAL
+from flask_kerberos_login.manager import ENVIRON_TOKEN
+from flask_kerberos_login.manager import NEGOTIATION_COOKIE
+from flask_kerberos_login.policy import EXEMPT
+from flask_kerberos_login.policy import REQUIRED
+
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+def local_name(manager, principal, token):
+    '''
+    Returns the local user name of `principal`, the result of a handshake
+    of `manager`
+
+    Raises
+    ------
+    Unauthorized
+        when the negotiation continues, the response carrying `token`
+    Forbidden
+        when the handshake failed or no auth_to_local rule maps `principal`
+    '''
+    if principal is None:
+        if token:
+            raise Unauthorized()
+        manager._counters.incr('forbidden')
+        raise Forbidden()
+    if manager._mapper is None:
+        return principal
+    name = manager._mapper.map(principal)
+    if name is None:
+        log.info('No auth_to_local rule maps %s', principal)
+        manager._counters.incr('unmapped')
+        manager._counters.incr('forbidden')
+        raise Forbidden()
+    return name
+
+
+def negotiate_headers(manager, status, negotiates, token, negotiation):
+    '''
+    Returns the headers to add to a response with `status`, the way
+    `KerberosLoginManager.append_header` does
+
+    Parameters
+    ----------
+    negotiates: bool
+        whether the response already carries a Negotiate header
+    token: str | None
+        GSSAPI token of the handshake
+    negotiation: str | None
+        new negotiation id, sent as a cookie with continued negotiations
+    '''
+    headers = []
+    challenge = status == 401
+    if not negotiates:
+        if challenge:
+            manager._counters.incr('challenges')
+        if token:
+            headers.append(('WWW-Authenticate', 'Negotiate {}'.format(token)))
+        elif challenge:
+            headers.append(('WWW-Authenticate', 'Negotiate'))
+    if negotiation is not None and challenge and token:
+        headers.append(('Set-Cookie', dump_cookie(
+            NEGOTIATION_COOKIE, negotiation, httponly=True)))
+    return headers
+
+
+class KerberosMiddleware(object):
+    '''
+    WSGI middleware running the GSSAPI handshake of a `KerberosLoginManager`
+
+    Parameters
+    ----------
+    app: callable
+        The WSGI application to wrap
+    manager: KerberosLoginManager
+        A configured manager, with or without a Flask app. Only path
+        policies (KRB5_POLICY_PATHS and KRB5_POLICY_DEFAULT) apply here.
+    '''
+    def __init__(self, app, manager):
+        self.app = app
+        self.manager = manager
+
+
+    def __call__(self, environ, start_response):
+        try:
+            self._authenticate(environ)
+        except HTTPException as e:
+            return e(environ, self._start_response(environ, start_response))
+        return self.app(environ, self._start_response(environ, start_response))
+
+
+    def _authenticate(self, environ):
+        '''
+        Authenticates the request described by `environ`, raising an
+        `HTTPException` to reject it
+        '''
+        manager = self.manager
+        policy = None
+        if manager._policy is not None:
+            policy = manager._policy.lookup(path=environ.get('PATH_INFO'))
+            if policy == EXEMPT:
+                return
+
+        header = environ.get('HTTP_AUTHORIZATION')
+        if not header or not header.startswith('Negotiate '):
+            if policy == REQUIRED:
+                raise Unauthorized()
+            return
+
+        token = header[10:]
+        manager._check_token(token)
+        user, token = manager._authenticate(
+            token, environ.get('REMOTE_ADDR'), manager._negotiation_key(environ))
+        environ[ENVIRON_TOKEN] = token
+        environ['REMOTE_USER'] = local_name(manager, user, token)
+        environ[ENVIRON_PRINCIPAL] = user
+
+
+    def _start_response(self, environ, start_response):
+        '''
+        Wraps `start_response` to add the Negotiate challenge or response
+        token to the headers
+        '''
+        def wrapped(status, headers, exc_info=None):
+            negotiates = any(
+                key.lower() == 'www-authenticate' and value.startswith('Negotiate')
+                for key, value in headers)
+            headers.extend(negotiate_headers(
+                self.manager, int(status[:3]), negotiates,
+                environ.get(ENVIRON_TOKEN), environ.get(ENVIRON_NEGOTIATION)))
+            if exc_info is None:
+                return start_response(status, headers)
+            return start_response(status, headers, exc_info)
+        return wrapped
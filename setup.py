@@ -16,5 +16,9 @@ setup(
         'flask-login',
         'pykerberos',
     ],
+    extras_require={
+        'gssapi': ['gssapi'],
+        'jwt': ['PyJWT[crypto]'],
+    },
 )
 